@@ -1,38 +1,46 @@
-from contextlib import contextmanager
 from datetime import (
     datetime,
     timedelta)
-from os import (
-    path,
-    makedirs)
-from timeit import Timer
-from time import clock
-from sys import getsizeof, stdout
-
-from fastavro import writer
-from pymongo import MongoClient
-from yaml import safe_load as yaml_load
-
-with open('mongo_creds.yml') as credsfile:
-    creds = yaml_load(credsfile)
-
-client = MongoClient(host='uphsvlndc058.uphs.upenn.edu',port=27017)
-is_authed = client.admin.authenticate(creds['user'],creds['pass'])
-
-psPreds = client.psPreds.preds
-
-
-def generate_avro_schema():
-    q = {'modelName':'sepsismodel_noEpoch'}
-    predictions = list(psPreds.find(q).limit(1))
-
+from os import environ
+
+from mongo_avro.codecs import avro_options
+from mongo_avro.engine import (
+    Exporter,
+    FeatureTransform,
+    LocalSink,
+    Source)
+from mongo_avro.metrics import configure_logging, job_metrics
+from mongo_avro.profiling import profiler_from_environ
+from mongo_avro.schema_cache import SchemaCache
+from mongo_avro.sepsis import MODEL, SCHEMA_MODEL, sample_feature_keys
+from mongo_avro.timestamps import EpochConverter, TIMESTAMP_MILLIS, logical_unit
+
+# Avro codec and block size, from AVRO_CODEC and AVRO_SYNC_INTERVAL
+AVRO_OPTIONS = avro_options(environ)
+# RAW_BSON=1 reads documents as raw BSON, which still decodes the whole
+# features subdocument, most of each document, so it is off by default
+RAW_BSON = environ.get('RAW_BSON', '0') == '1'
+# 'flat' writes a field per feature; 'vector' or 'packed' one feature vector
+# per record and 'sparse' the indices and values of the present features,
+# with the feature dictionary in the file metadata; 'auto' sparse or vector
+# records by each partition's density, never flat ones
+FEATURE_LAYOUT = environ.get('FEATURE_LAYOUT', 'flat')
+
+schema_cache = SchemaCache('features', version=2)
+
+
+# Avro fields filled from the Mongo document rather than its features
+METADATA = (
+    ('WCT', EpochConverter('WCT', logical_unit(TIMESTAMP_MILLIS))),
+    ('VISIT_NUMBER', lambda prediction: prediction['VISIT_NUMBER']))
+
+def build_avro_schema(keys):
     fields = [{'name': key, 'type': ['float', 'null']}
-        for key in predictions[0]['features'].keys()]
+        for key in keys]
 
     fields.append({
         'name': 'WCT',
-        'type': ['int', 'null'],
-        'logicalType': 'time-millis'})
+        'type': [TIMESTAMP_MILLIS, 'null']})
     fields.append({'name': 'VISIT_NUMBER', 'type': ['int', 'null']})
     return {
         'type': 'record',
@@ -44,38 +52,29 @@ def generate_avro_schema():
         'fields': fields
     }
 
-def get_mongo_predictions(starttime, endtime, limit=None):
-    q = {'modelName':'sepsismodel',
-         'WCT':{'$gt':starttime,'$lt':endtime}}
-    r = psPreds.find(q,{'WCT':1,'VISIT_NUMBER':1,'features':1,
-        '_id':0})
-    return r if limit is None else r.limit(limit)
-
-def get_features(directory, file_name, predictions):
-    schema = generate_avro_schema()
-    if not path.exists(directory):
-        makedirs(directory)
-    with open(file_name, 'wb') as out:
-        writer(out, schema, to_avro(predictions))
-
-def to_avro(predictions):
-    for i in predictions:
-        data = {key: float(value) for key, value in i['features'].items()}
-        data['WCT'] = int(i['WCT'].timestamp())
-        data['VISIT_NUMBER'] = i['VISIT_NUMBER']
-        yield data
-
-
-@contextmanager
-def timer(name):
-    start = clock()
-    try:
-        yield
-    finally:
-        print('{} {} log'.format(name, clock() - start))
+features = Exporter(
+    Source({'modelName':MODEL},
+        {'WCT':1,'VISIT_NUMBER':1,'features':1,'_id':0},
+        raw=RAW_BSON, start='$gt'),
+    FeatureTransform(schema_cache, SCHEMA_MODEL, sample_feature_keys,
+        lambda keys: (build_avro_schema(keys), None), METADATA,
+        layout=FEATURE_LAYOUT),
+    LocalSink(**AVRO_OPTIONS),
+    lambda starttime, endtime: ''.join((
+        starttime.strftime("%Y_%m_%d"), '-',
+        endtime.strftime("%Y_%m_%d"), '/features.avro')))
+
+# Generates avro schema, reusing the cached one while the feature keys match
+def generate_avro_schema(window=None):
+    return features.transform.schema(window)
+
+
+metrics = job_metrics('fastavro_mongo', environ)
+timer = metrics.timer
 
 
 if __name__=='__main__':
+    configure_logging(environ)
 
     with timer('Schema:'):
         generate_avro_schema()
@@ -83,18 +82,16 @@ if __name__=='__main__':
     endtime = datetime.now()
     endtime = datetime(endtime.year,endtime.month,endtime.day)
 
-    for i in range(1):
-        starttime = endtime - timedelta(8)
-        directory = ''.join((
-            starttime.strftime("%Y_%m_%d"), '-',
-            endtime.strftime("%Y_%m_%d")))
-        file_name = ''.join((
-            starttime.strftime("%Y_%m_%d"), '-',
-            endtime.strftime("%Y_%m_%d"), '/features.avro'))
-        print(starttime)
-        print(endtime)
-        with timer('Mongo: '):
-            predictions = list(get_mongo_predictions(starttime, endtime, 10))
-        with timer('Avro:  '):
-            get_features(directory, file_name, predictions)
-        endtime=starttime
+    profiler = profiler_from_environ(environ)
+    export = profiler.wrap(features.export)
+    with profiler.sampling():
+        for i in range(1):
+            starttime = endtime - timedelta(8)
+            print(starttime)
+            print(endtime)
+            with timer('Export:'):
+                stats = export(starttime, endtime, 10)
+            print('Streamed {records} records, {bytes} bytes'.format(**stats))
+            metrics.add(stats)
+            endtime=starttime
+    metrics.emit()
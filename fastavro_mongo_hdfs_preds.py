@@ -1,133 +1,148 @@
 '''This script exports data from a mongoDB, generates avro schema, and stores predictions
 into HDFS as Avro files using fastavro extension for hdfs.
 '''
-from contextlib import contextmanager
+from argparse import ArgumentParser
+from functools import partial
 from datetime import (
     datetime,
     timedelta)
-from os import (
-    path,
-    makedirs)
-from timeit import Timer
-from time import clock, mktime
+from os import environ
+from sys import exit
 
-from hdfs import InsecureClient
-from hdfs.ext.avro import AvroReader, AvroWriter
-from pymongo import MongoClient
-from yaml import safe_load as yaml_load
+from mongo_avro.aggregate import FETCH_MODES
+from mongo_avro.backfill import day_windows, run_backfill, summarize
+from mongo_avro.checkpoint import Checkpoint, run_incremental
+from mongo_avro.codecs import CODECS, avro_options
+from mongo_avro.engine import (
+    Exporter,
+    PredictionTransform,
+    Source,
+    hdfs_sink)
+from mongo_avro.metrics import configure_logging, job_metrics
+from mongo_avro.profiling import Profiler
+from mongo_avro.rolling import HDFS_BLOCK_SIZE
+from mongo_avro.sepsis import (
+    MODEL,
+    aggregate_pipeline,
+    prediction_schema,
+    to_record)
+from mongo_avro.upload import RETRIES, UPLOADS
 
-with open('mongo_creds.yml') as credsfile:
-    creds = yaml_load(credsfile)
+# Avro codec and block size, from AVRO_CODEC and AVRO_SYNC_INTERVAL
+AVRO_OPTIONS = avro_options(environ)
 
-hdfs_client = InsecureClient('http://localhost:14000', user='cloudera')
-mongo_client = MongoClient(host='uphsvlndc058.uphs.upenn.edu',port=27017)
-is_authed = mongo_client.admin.authenticate(creds['user'],creds['pass'])
-
-psPreds = mongo_client.psPreds.preds
+# 'find' reshapes predictions in python, 'aggregate' has Mongo reshape them
+FETCH_MODE = environ.get('FETCH_MODE', 'find')
 
 
+# The prediction schema has no feature fields, so it is built without
+# querying Mongo
 def generate_avro_schema():
-    q = {'modelName':'sepsismodel_noEpoch'}
-    predictions = list(psPreds.find(q).limit(1))
-    fields = []
-    fields.append({
-        'name': 'event_id',
-        'type': 'string'})
-    fields.append({
-        'name': 'valid_on',
-        'type': ['int', 'null'],
-        'logicalType': 'time-millis'})
-    fields.append({
-        'name': 'created_on',
-        'type': ['int', 'null'],
-        'logicalType': 'time-millis'})
-    fields.append({
-        'name': 'input_events',
-        'type': 'string',
-        'doc': 'Array of the penn signal event_ids that we\'re used as input into the transform output'})
-    fields.append({'name': 'patient_id', 'type': ['int', 'null']})
-    fields.append({
-        'name': 'provenance',
-        'type':{
-            'type': 'array',
-            'items': {
-                'name': 'source',
-                'type': 'string'
-            }}
-        })
-    fields.append({
-        'name': 'Prediction',
-        'doc': 'Prediction type could be a classification or regression.',
-        'type': 'float'
-        })
-    fields.append({
-        'name': 'Score',
-        'doc': 'Prediction type could be a classification, regression, or a string txt.',
-        'type': 'float'
-        })
-    fields.append({
-        'name': 'heuristic_rule',
-        'doc': 'True or False to report the predicted outcome.  The Data Scientist can create heuristic rules that determines if the predictive is reported or not.  True=Report, False=Do not report.',
-        'type': 'boolean'
-        })
+    return prediction_schema()
 
-    return {
-        'type': 'record',
-        'name': 'Predictions',
-        'doc': 'The transform is either scalar or vector (array). The ' +
-            'indices are held in key value pairs in the schema.  The types ' +
-            'of the values are unique to the transform component.  ' +
-            'Typically the values will be floats.',
-        'fields': fields
-    }
+prediction_source = Source({'modelName':MODEL},
+    {'WCT':1,'VISIT_NUMBER':1,'result':1,'_id':1},
+    pipeline=aggregate_pipeline if FETCH_MODE == 'aggregate' else None)
+prediction_transform = PredictionTransform(generate_avro_schema(), to_record)
 
-def get_mongo_predictions(starttime, endtime, limit=None):
-    q = {'modelName':'sepsismodel',
-         'WCT':{'$gt':starttime,'$lt':endtime}}
-    r = psPreds.find(q,{'WCT':1,'VISIT_NUMBER':1,'result':1,
-        '_id':1})
-    return r if limit is None else r.limit(limit)
+# HDFS path, without extension, of the partition starting at starttime
+def partition_name(starttime):
+    return ''.join(('predictions/',
+        starttime.strftime("%Y"), '/',
+        starttime.strftime("%m"), '/',
+        starttime.strftime("%Y_%m_%d"), '_predict'))
 
-def write_avro(file_name, predictions):
-    avro_schema = generate_avro_schema()
-    with AvroWriter(hdfs_client, file_name, schema=avro_schema, overwrite=True) as writer:
-        for prediction in predictions:
-            data = {}
-            data['event_id'] = 'pred_' + str(prediction['_id'])
-            data['valid_on'] = int(prediction['WCT'].timestamp())
-            data['created_on'] = int(prediction['WCT'].timestamp())
-            data['input_events'] = str(prediction['_id'])
-            data['patient_id'] = prediction['VISIT_NUMBER']
-            data['provenance'] = ['psPredsExtract', 'PredictSepsis']
-            data['Prediction'] = float(prediction['result']['result']['predict'])
-            data['Score'] = float(prediction['result']['result']['score'])
-            data['heuristic_rule'] = prediction['result']['result']['heuristic_alert']
-            writer.write(data)
+# Exports one day window to its HDFS partition file, skipping documents up
+# to the after watermark when one is given. avro holds the avro writer
+# options and parts the max_bytes/max_records splitting the partition into
+# part files. With uploads the parts are staged locally and that many are
+# uploaded at a time, each retried up to retries times.
+def export_day(starttime, endtime, limit=None, after=None, avro=None,
+        parts=None, uploads=None, retries=RETRIES):
+    sink, extension = hdfs_sink(avro or AVRO_OPTIONS, parts, uploads,
+        retries)
+    return Exporter(prediction_source, prediction_transform, sink,
+        lambda starttime, endtime: partition_name(starttime) + extension
+        ).export(starttime, endtime, limit, after)
 
-@contextmanager
-def timer(name):
-    start = clock()
-    try:
-        yield
-    finally:
-        print('{} {}'.format(name, clock() - start))
+metrics = job_metrics('fastavro_mongo_hdfs_preds', environ)
+timer = metrics.timer
 
 
 if __name__=='__main__':
+    configure_logging(environ)
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--days', type=int, default=30,
+        help='number of day partitions to export, walking back from today')
+    parser.add_argument('--processes', type=int, default=1,
+        help='worker processes exporting day partitions in parallel')
+    parser.add_argument('--limit', type=int, default=10000,
+        help='maximum number of predictions exported per day')
+    parser.add_argument('--incremental', action='store_true',
+        help='export, without a limit, every day since the last committed '
+             'partition recorded in --state (the last --days days on the '
+             'first run)')
+    parser.add_argument('--state', default='.export_state.json',
+        help='watermark state file used by --incremental')
+    parser.add_argument('--codec', default=AVRO_OPTIONS['codec'],
+        choices=CODECS, help='avro block compression codec')
+    parser.add_argument('--sync-interval', type=int,
+        default=AVRO_OPTIONS['sync_interval'],
+        help='uncompressed bytes per avro block')
+    parser.add_argument('--part-bytes', type=int,
+        help='split each day into _partNNNN.avro files of about this many '
+             'bytes, with a manifest (default one HDFS block when '
+             '--part-records is given)')
+    parser.add_argument('--part-records', type=int,
+        help='split each day into _partNNNN.avro files of at most this '
+             'many records, with a manifest')
+    parser.add_argument('--uploads', type=int, default=0,
+        help='stage part files locally and upload this many to HDFS at a '
+             'time (e.g. {}) instead of streaming one file'.format(UPLOADS))
+    parser.add_argument('--retries', type=int, default=RETRIES,
+        help='retries of a failed part upload')
+    parser.add_argument('--profile', metavar='DIRECTORY',
+        default=environ.get('EXPORT_PROFILE'),
+        help='write a cProfile .prof and the top allocating lines of every '
+             'partition into DIRECTORY (or set EXPORT_PROFILE)')
+    parser.add_argument('--profile-sample', type=float, metavar='SECONDS',
+        default=float(environ.get('EXPORT_PROFILE_SAMPLE', 0)),
+        help='with --profile, also sample every thread\'s stack this often '
+             'into a folded flame graph file (or set EXPORT_PROFILE_SAMPLE)')
+    args = parser.parse_args()
+    if FETCH_MODE not in FETCH_MODES:
+        parser.error('FETCH_MODE must be one of {}, not {!r}'.format(
+            ', '.join(FETCH_MODES), FETCH_MODE))
+    parts = None
+    if args.part_bytes or args.part_records:
+        parts = {
+            'max_bytes': args.part_bytes or HDFS_BLOCK_SIZE,
+            'max_records': args.part_records}
+    avro = {'codec': args.codec, 'sync_interval': args.sync_interval}
+    export = partial(export_day, avro=avro, parts=parts,
+        uploads=args.uploads, retries=args.retries)
+    profiler = Profiler(args.profile, args.profile_sample)
+    export = profiler.wrap(export)
+
     with timer('Schema:'):
         generate_avro_schema()
 
     endtime = datetime.now()
     endtime = datetime(endtime.year,endtime.month,endtime.day)
 
-    for i in range(30):
-        starttime = endtime - timedelta(1)
-        file_name = ''.join(('predictions/',
-            starttime.strftime("%Y"), '/',
-            starttime.strftime("%m"), '/',
-            starttime.strftime("%Y_%m_%d"), '_predict.avro'))
-        with timer('Mongo: '):
-            predictions = list(get_mongo_predictions(starttime, endtime, 10000))
-        with timer('Avro:  '):
-            write_avro(file_name, predictions)
-        endtime=starttime
+    with timer('Export:'), profiler.sampling():
+        if args.incremental:
+            results = run_incremental(
+                Checkpoint(args.state),
+                'sepsismodel.predict',
+                export,
+                endtime - timedelta(args.days),
+                endtime)
+        else:
+            results = run_backfill(
+                partial(export, limit=args.limit),
+                day_windows(endtime, args.days),
+                args.processes)
+    metrics.collect(results)
+    metrics.emit()
+    exit(1 if summarize(results) else 0)
@@ -1,118 +1,83 @@
-from contextlib import contextmanager
 from datetime import (
     datetime,
     timedelta)
-from os import (
-    path,
-    makedirs)
-from timeit import Timer
-from time import clock, mktime
+from os import environ
 
-from hdfs import InsecureClient
-from hdfs.ext.avro import AvroReader, AvroWriter
-from pymongo import MongoClient
-from yaml import safe_load as yaml_load
+from mongo_avro.codecs import avro_options
+from mongo_avro.engine import (
+    Exporter,
+    FeatureTransform,
+    HdfsSink,
+    Source)
+from mongo_avro.metrics import configure_logging, job_metrics
+from mongo_avro.profiling import profiler_from_environ
+from mongo_avro.schema_cache import SchemaCache
+from mongo_avro.sepsis import (
+    MODEL,
+    SCHEMA_MODEL,
+    sample_feature_keys,
+    transform_metadata,
+    transform_schema)
 
-with open('mongo_creds.yml') as credsfile:
-    creds = yaml_load(credsfile)
+# Avro codec and block size, from AVRO_CODEC and AVRO_SYNC_INTERVAL
+AVRO_OPTIONS = avro_options(environ)
+# RAW_BSON=1 reads documents as raw BSON, which still decodes the whole
+# features subdocument, most of each document, so it is off by default
+RAW_BSON = environ.get('RAW_BSON', '0') == '1'
+# 'flat' writes a field per feature; 'vector' or 'packed' one feature vector
+# per record and 'sparse' the indices and values of the present features,
+# with the feature dictionary in the file metadata; 'auto' sparse or vector
+# records by each partition's density, never flat ones
+FEATURE_LAYOUT = environ.get('FEATURE_LAYOUT', 'flat')
 
-hdfs_client = InsecureClient('http://localhost:14000', user='cloudera')
-mongo_client = MongoClient(host='uphsvlndc058.uphs.upenn.edu',port=27017)
-is_authed = mongo_client.admin.authenticate(creds['user'],creds['pass'])
+# Each script builds its own schema, so each caches it under its own kind
+schema_cache = SchemaCache('hdfs_transform', version=2)
 
-psPreds = mongo_client.psPreds.preds
 
+# Avro fields filled from the Mongo document rather than its features
+METADATA = transform_metadata()
 
-def generate_avro_schema():
-    q = {'modelName':'sepsismodel_noEpoch'}
-    predictions = list(psPreds.find(q).limit(1))
-    # FIXME: use extend instead
-    fields = [{'name': key, 'type': ['float', 'null']}
-        for key in predictions[0]['features'].keys()]
-    fields.append({
-        'name': 'event_id',
-        'type': 'string'})
-    fields.append({
-        'name': 'valid_on',
-        'type': ['int', 'null'],
-        'logicalType': 'time-millis'})
-    fields.append({
-        'name': 'created_on',
-        'type': ['int', 'null'],
-        'logicalType': 'time-millis'})
-    fields.append({
-        'name': 'input_events',
-        'type': 'string',
-        'doc': 'Array of the penn signal event_ids that we\'re used as input into the transform output'})
-    fields.append({'name': 'patient_id', 'type': ['int', 'null']})
-    fields.append({
-        'name': 'provenance',
-        'type':{
-            'type': 'array',
-            'items': {
-                'name': 'source',
-                'type': 'string'
-            }}
-        })
-    return {
-        'type': 'record',
-        'name': 'Transform',
-        'doc': 'The transform is either scalar or vector (array). The ' +
-            'indices are held in key value pairs in the schema.  The types ' +
-            'of the values are unique to the transform component.  ' +
-            'Typically the values will be floats.',
-        'fields': fields
-    }
+def build_avro_schema(keys):
+    return transform_schema(
+        {'name': key, 'type': ['float', 'null']} for key in keys)
 
-def get_mongo_predictions(starttime, endtime, limit=None):
-    q = {'modelName':'sepsismodel',
-         'WCT':{'$gte':starttime,'$lt':endtime}}
-    r = psPreds.find(q,{'WCT':1,'VISIT_NUMBER':1,'features':1,
-        '_id':1})
-    return r if limit is None else r.limit(limit)
+transform = Exporter(
+    Source({'modelName':MODEL},
+        {'WCT':1,'VISIT_NUMBER':1,'features':1,'_id':1},
+        raw=RAW_BSON),
+    FeatureTransform(schema_cache, SCHEMA_MODEL, sample_feature_keys,
+        lambda keys: (build_avro_schema(keys), None), METADATA,
+        layout=FEATURE_LAYOUT),
+    HdfsSink(**AVRO_OPTIONS),
+    lambda starttime, endtime: ''.join(('transforms/',
+        starttime.strftime("%Y"), '/',
+        starttime.strftime("%m"), '/',
+        starttime.strftime("%Y_%m_%d"), '_transform.avro')))
 
+# Generates avro schema, reusing the cached one while the feature keys match
+def generate_avro_schema(window=None):
+    return transform.transform.schema(window)
 
-def write_avro(file_name, predictions):
-    avro_schema = generate_avro_schema()
-    print('predictions type: ', type(predictions))
-    print('predictions length: ', len(predictions))
-    with AvroWriter(hdfs_client, file_name, schema=avro_schema, overwrite=True) as writer:
-        for prediction in predictions:
-            print(len(prediction))
-            print(type(prediction['features']))
-            data = {key: float(value) for key, value in prediction['features'].items()}
-            data['event_id'] = str(prediction['_id'])
-            data['valid_on'] = int(prediction['WCT'].timestamp())
-            data['created_on'] = int(prediction['WCT'].timestamp())
-            data['input_events'] = str(prediction['_id'])
-            data['patient_id'] = prediction['VISIT_NUMBER']
-            data['provenance'] = ['psPredsExtract', 'TransformSepsis']
-            writer.write(data)
-
-@contextmanager
-def timer(name):
-    start = clock()
-    try:
-        yield
-    finally:
-        print('{} {}'.format(name, clock() - start))
+metrics = job_metrics('fastavro_mongo_hdfs_transform', environ)
+timer = metrics.timer
 
 
 if __name__=='__main__':
+    configure_logging(environ)
     with timer('Schema:'):
         generate_avro_schema()
 
     endtime = datetime.now()
     endtime = datetime(endtime.year,endtime.month,endtime.day)
 
-    for i in range(1):
-        starttime = endtime - timedelta(1)
-        file_name = ''.join(('transforms/',
-            starttime.strftime("%Y"), '/',
-            starttime.strftime("%m"), '/',
-            starttime.strftime("%Y_%m_%d"), '_transform.avro'))
-        with timer('Mongo: '):
-            predictions = list(get_mongo_predictions(starttime, endtime, 1))
-        with timer('Avro:  '):
-            write_avro(file_name, predictions)
-        endtime=starttime
+    profiler = profiler_from_environ(environ)
+    export = profiler.wrap(transform.export)
+    with profiler.sampling():
+        for i in range(1):
+            starttime = endtime - timedelta(1)
+            with timer('Export:'):
+                stats = export(starttime, endtime, 1)
+            print('Streamed {records} records, {bytes} bytes'.format(**stats))
+            metrics.add(stats)
+            endtime=starttime
+    metrics.emit()
@@ -1,209 +1,440 @@
 '''This script exports data from a mongoDB, generates avro schema, normalized the Transform's features
 and convert to avro files on HDFS using fastavro extension for hdfs
 '''
-from contextlib import contextmanager
-from collections import Counter
+import json
+from argparse import ArgumentParser
+from functools import partial
 from datetime import (
     datetime,
     timedelta)
 from os import (
+    environ,
     path,
-    makedirs)
-from keyword import iskeyword
-from re import compile as re_compile
-from timeit import Timer
-from time import clock, mktime
+    makedirs,
+    remove,
+    rmdir,
+    urandom)
+from sys import exit
 
-from hdfs import InsecureClient
-from hdfs.ext.avro import AvroReader, AvroWriter
-from pymongo import MongoClient
-from yaml import safe_load as yaml_load
+from mongo_avro.aio import CONCURRENCY, AvroSink, run_async_backfill
+from mongo_avro.backfill import day_windows, run_backfill, summarize
+from mongo_avro.checkpoint import Checkpoint, run_incremental
+from mongo_avro.codecs import (
+    CODECS,
+    avro_options,
+    benchmark_codecs,
+    print_benchmark)
+from mongo_avro.engine import (
+    BATCH_SIZE,
+    Exporter,
+    FeatureTransform,
+    HdfsSink,
+    LocalSink,
+    Source,
+    connections,
+    hdfs_sink)
+from mongo_avro.metrics import configure_logging, job_metrics
+from mongo_avro.parquet import COMPRESSION, ROW_GROUP_SIZE
+from mongo_avro.pipeline import QUEUE_DEPTH
+from mongo_avro.profiling import Profiler
+from mongo_avro.rawbson import RAW_CODEC_OPTIONS
+from mongo_avro.rolling import HDFS_BLOCK_SIZE
+from mongo_avro.schema_cache import SchemaCache
+from mongo_avro.sepsis import (
+    MODEL,
+    SCHEMA_MODEL,
+    sample_feature_keys,
+    transform_metadata,
+    transform_schema)
+from mongo_avro.split import (
+    combine_stats,
+    merge_avro,
+    range_query,
+    run_ranges,
+    split_ranges)
+from mongo_avro.symbols import SymbolTable, rename_duplicates
+from mongo_avro.upload import (
+    RETRIES,
+    STAGING_DIRECTORY,
+    UPLOADS)
+from mongo_avro.vector import (
+    DENSITY_SAMPLE_SIZE,
+    LAYOUTS,
+    SPARSE_DENSITY,
+    layout_for)
 
-with open('mongo_creds.yml') as credsfile:
-    creds = yaml_load(credsfile)
+# Predictions exported per day when --limit is not given, except by --split
+# which always exports whole days
+LIMIT = 1000
+# Avro codec and block size, from AVRO_CODEC and AVRO_SYNC_INTERVAL
+AVRO_OPTIONS = avro_options(environ)
+# RAW_BSON=1 reads documents as raw BSON, which still decodes the whole
+# features subdocument, most of each document, so it is off by default
+RAW_BSON = environ.get('RAW_BSON', '0') == '1'
+# 'flat' writes a field per feature; 'vector' or 'packed' one feature vector
+# per record and 'sparse' the indices and values of the present features,
+# with the feature dictionary in the file metadata; 'auto' sparse or vector
+# records by each partition's density, never flat ones
+FEATURE_LAYOUT = environ.get('FEATURE_LAYOUT', 'flat')
 
-hdfs_client = InsecureClient('http://localhost:14000', user='cloudera')
-mongo_client = MongoClient(host='uphsvlndc058.uphs.upenn.edu',port=27017)
-is_authed = mongo_client.admin.authenticate(creds['user'],creds['pass'])
+schema_cache = SchemaCache('normalized', version=2)
+symbol_table = SymbolTable(path.join(schema_cache.directory, 'to_symbol.json'))
 
-psPreds = mongo_client.psPreds.preds
+# Avro fields filled from the Mongo document rather than its features
+METADATA = transform_metadata()
 
-# Generates avro schema from a simple query
-def generate_avro_schema(symbols=None):
-    q = {'modelName':'sepsismodel_noEpoch'}
-    predictions = list(psPreds.find(q).limit(1))
+# Manual feature key to symbol overrides shared by every partition
+symbols = {
+    #'Urine Appearance >>> clear': 'urine-appearance_is_clear'
+    #'Urine Appearance >>> Clear': 'urine-appearance_is_clear_new'
+}
 
-    if symbols is None:
-        symbols = {}
+def build_avro_schema(keys, symbols=None):
+    symbols = dict(symbols or {})
 
-    for key in predictions[0]['features'].keys():
-        if key not in symbols.keys():
-            symbols[key] = to_symbol(key)
+    for key in keys:
+        if key not in symbols:
+            symbols[key] = symbol_table.symbol(key)
+    symbol_table.save()
 
-    symbols = rename_duplicates(symbols)
+    symbols = rename_duplicates(
+        symbols, schema_cache.previous_symbols(SCHEMA_MODEL))
     fields = [{'name': symbol_key, 'type': ['float', 'null']}
         for symbol_key in symbols.values()]
+    return transform_schema(fields), symbols
 
-    fields.append({
-        'name': 'event_id',
-        'type': 'string'})
-    fields.append({
-        'name': 'valid_on',
-        'type': ['int', 'null'],
-        'logicalType': 'time-millis'})
-    fields.append({
-        'name': 'created_on',
-        'type': ['int', 'null'],
-        'logicalType': 'time-millis'})
-    fields.append({
-        'name': 'input_events',
-        'type': 'string',
-        'doc': 'Array of the penn signal event_ids that we\'re used as input into the transform output'})
-    fields.append({'name': 'patient_id', 'type': ['int', 'null']})
-    fields.append({
-        'name': 'provenance',
-        'type':{
-            'type': 'array',
-            'items': {
-                'name': 'source',
-                'type': 'string'
-            }}
-        })
-    schema = {
-        'type': 'record',
-        'name': 'Transform',
-        'doc': 'The transform is either scalar or vector (array). The ' +
-            'indices are held in key value pairs in the schema.  The types ' +
-            'of the values are unique to the transform component.  ' +
-            'Typically the values will be floats.',
-        'fields': fields
-    }
-    return schema, symbols
-
-
-sub_res = (
-    (r'\1_\2', re_compile('(.)([A-Z][a-z]+)')), # first_cap
-    (r'\1_\2', re_compile('([a-z0-9])([A-Z])')), # all cap
-    (r'_', re_compile('(_+)')), # dunder
-    (r'\1', re_compile('^_(.*)')), # lead _
-    (r'\1', re_compile('(.*)_$'))) # trail _
-
-subs = {
-    '(' : '_lp_',
-    ')' : '_rp_',
-    '%' : '_pct_',
-    '\'' : '_squo_',
-    '[' : '_lb_',
-    ']' : '_rb_',
-    '.' : '_dot_',
-    '?' : '_question_',
-    ',' : '_comma_',
-    ':' : '_colon_',
-    ';' : '_semicolon_',
-    '*' : '_asterisk_',
-    '>>>': '_is_',
-    '+++': '_derived_',
-    '+' : '_plus_',
-    '-' : '_hyphen_',
-    '>' : '_gt_',
-    '<' : '_lt_',
-    '/' : '_slash_'}
-
-sub_keys = tuple(reversed(sorted(subs.keys())))
-
-# Performs normalization on returned key
-def to_symbol(old):
-    new = old.lower().replace(' ', '_')
-    for i in sub_keys:
-        new = new.replace(i, subs[i])
-
-    for i, j in sub_res:
-        new = j.sub(i, new)
-
-    if iskeyword(new):
-        new = new + '_'
-
-    if not new.isidentifier():
-        raise TypeError('%s is not a valid symbol for \'%s\'' % (new, old))
-    return new
-
-# Query mongodb for a date range and get predictions
-def get_mongo_predictions(starttime, endtime, limit=None):
-    q = {'modelName':'sepsismodel',
-         'WCT':{'$gte':starttime,'$lt':endtime}}
-    r = psPreds.find(q,{'WCT':1,'VISIT_NUMBER':1,'features':1,
-        '_id':1})
-    return r if limit is None else r.limit(limit)
-
-# Write to avro file using fastavro
-def write_avro(file_name, predictions, symbols):
-    avro_schema, symbols = generate_avro_schema(symbols)
-    with AvroWriter(
-        hdfs_client,
-        file_name,
-        schema=avro_schema,
-        overwrite=True) as writer:
-        for prediction in predictions:
-            features = rekey_features(symbols, prediction['features'])
-            data = {key: float(value) for key, value in features.items()}
-            data['event_id'] = str(prediction['_id'])
-            data['valid_on'] = int(prediction['WCT'].timestamp())
-            data['created_on'] = int(prediction['WCT'].timestamp())
-            data['input_events'] = str(prediction['_id'])
-            data['patient_id'] = prediction['VISIT_NUMBER']
-            data['provenance'] = ['psPredsExtract', 'TransformSepsis']
-            writer.write(data)
-
-# Rename duplicate values since they cause conflicts in PySpark
-def rename_duplicates(symbols):
-    deferred = symbols
-    completed = {}
-    i, suffix = 1, ''
-    while deferred:
-        current, deferred = deferred, {}
-        for key, value in current.items():
-            symbol = value + suffix
-            if symbol in completed.values():
-                deferred[key] = value
-            else:
-                completed[key] = symbol
-        i, suffix = i+1, '_v' + str(i)
-    return completed
-
-# Change feature keys
-def rekey_features(symbols, features):
-    keyed_predictions = {
-        symbols[key]: value for key, value in features.items()}
-    return keyed_predictions
-
-@contextmanager
-def timer(name):
-    start = clock()
+# Lays predictions out in layout through the normalized schema, reusing the
+# cached one while the sampled feature keys and the symbol overrides match
+def feature_transform(layout=FEATURE_LAYOUT):
+    return FeatureTransform(schema_cache, SCHEMA_MODEL, sample_feature_keys,
+        lambda keys: build_avro_schema(keys, symbols), METADATA, symbols,
+        layout)
+
+# Generates avro schema and feature symbols, inferred from every document in
+# window when one is given
+def generate_avro_schema(window=None):
+    return feature_transform().load(window)
+
+
+PROJECTION = {'WCT':1,'VISIT_NUMBER':1,'features':1,'_id':1}
+prediction_source = Source({'modelName':MODEL}, PROJECTION, raw=RAW_BSON)
+
+# Async view of psPreds for the asyncio exporter
+def connect_async():
+    preds = connections.open_async_mongo().psPreds.preds
+    if RAW_BSON:
+        preds = preds.with_options(codec_options=RAW_CODEC_OPTIONS)
+    return preds
+
+# HDFS path, without extension, of the partition starting at starttime
+def partition_name(starttime):
+    return ''.join(('transforms_test/',
+        starttime.strftime("%Y"), '/',
+        starttime.strftime("%m"), '/',
+        starttime.strftime("%Y_%m_%d"), '_transform'))
+
+# Opens the HDFS avro file the asyncio exporter writes a window to
+def open_window_sink(window, avro_schema, feature_symbols,
+        layout=FEATURE_LAYOUT, **options):
+    plan = layout_for(avro_schema, METADATA, feature_symbols, layout)
+    return AvroSink(
+        HdfsSink().open,
+        partition_name(window[0]) + '.avro',
+        plan.schema,
+        lambda predictions: plan.rows(predictions, BATCH_SIZE),
+        metadata=plan.file_metadata,
+        **options)
+
+# Local file part index of base_name is staged in for merging
+def staged_part_name(base_name, index):
+    return path.join(STAGING_DIRECTORY,
+        '{}_part{:04d}.avro'.format(base_name, index).replace('/', '__'))
+
+# Exports the low <= WCT < high sub-range of a split day's query as part
+# index of base_name, straight to HDFS or, given a sync_marker, to a local
+# staged file for merging
+def export_part(index, low, high, base_name, query, sync_marker=None,
+        avro=None, layout=FEATURE_LAYOUT):
+    options = avro or AVRO_OPTIONS
+    if sync_marker is None:
+        file_name = '{}_part{:04d}.avro'.format(base_name, index)
+        sink = HdfsSink(**options)
+    else:
+        file_name = staged_part_name(base_name, index)
+        sink = LocalSink(sync_marker=sync_marker, **options)
+    stats = Exporter(prediction_source, feature_transform(layout), sink,
+        lambda starttime, endtime: file_name).export(low, high,
+            query=range_query(query, 'WCT', low, high))
+    stats['file'] = file_name
+    return stats
+
+# Exports one day cut into parts sub-ranges of about the same size, read by
+# processes workers at once. The parts are merged in WCT order into the day's
+# single avro file, or with merge unset kept as _partNNNN.avro files listed
+# in a manifest. A split day is always exported whole: cutting a limit over
+# the sub-ranges would pick other documents than the unsplit export does.
+def export_day_split(starttime, endtime, limit=None, after=None, avro=None,
+        parts=4, processes=4, merge=True, layout=FEATURE_LAYOUT):
+    if limit is not None:
+        raise ValueError('a split day is exported whole, without a limit')
+    base_name = partition_name(starttime)
+    q = prediction_source.query(starttime, endtime, after)
+    ranges = split_ranges(prediction_source.collection(), q, 'WCT', parts)
+    if layout == 'auto':
+        # Every part of the day is written in the layout the day's density
+        # picks, so the parts can be merged
+        layout = feature_transform(layout).plan(
+            prediction_source.find_query(q, DENSITY_SAMPLE_SIZE))[0].layout
+    sync_marker = None
+    if merge:
+        sync_marker = urandom(16)
+        if not path.exists(STAGING_DIRECTORY):
+            makedirs(STAGING_DIRECTORY)
     try:
-        yield
+        part_stats = run_ranges(
+            partial(export_part, base_name=base_name, query=q,
+                sync_marker=sync_marker, avro=avro, layout=layout),
+            ranges, processes)
+        stats = combine_stats(part_stats)
+        hdfs = HdfsSink()
+        if merge:
+            file_name = base_name + '.avro'
+            with hdfs.open(file_name) as out:
+                merge_avro([part['file'] for part in part_stats], out,
+                    sync_marker)
+            stats['bytes'] = hdfs.size(file_name)
+        else:
+            manifest = dict(stats, parts=[
+                {'file': part['file'], 'records': part['records'],
+                    'bytes': part['bytes']} for part in part_stats])
+            manifest.pop('last', None)
+            manifest.pop('metrics', None)
+            with hdfs.open(base_name + '_manifest.json') as out:
+                out.write(json.dumps(manifest, indent=2, sort_keys=True)
+                    .encode('utf-8'))
     finally:
-        print('{} {}'.format(name, clock() - start))
+        if merge:
+            remove_staged_parts(base_name, len(ranges))
+    return stats
+
+# Removes the staged files of a split day's parts, whether they were merged
+# or a part failed, and the staging directory once no other export uses it
+def remove_staged_parts(base_name, parts):
+    for index in range(parts):
+        file_name = staged_part_name(base_name, index)
+        if path.exists(file_name):
+            remove(file_name)
+    try:
+        rmdir(STAGING_DIRECTORY)
+    except OSError:
+        # Still holding another export's files
+        pass
+
+# Exports one day window to its HDFS partition file, skipping documents up
+# to the after watermark when one is given. avro holds the avro writer
+# options and parts the max_bytes/max_records splitting the partition into
+# part files. With uploads the parts are staged locally and that many are
+# uploaded at a time, each retried up to retries times. parquet holds
+# ParquetSink options and writes a parquet partition instead of an avro one.
+# A depth runs the fetch, encoding and writes as a pipeline with queues that
+# deep and reports how busy each stage was. layout is the feature layout.
+def export_day(starttime, endtime, limit=None, after=None, avro=None,
+        parts=None, uploads=None, retries=RETRIES, parquet=None, depth=None,
+        layout=FEATURE_LAYOUT):
+    sink, extension = hdfs_sink(avro or AVRO_OPTIONS, parts, uploads,
+        retries, parquet)
+    return Exporter(prediction_source, feature_transform(layout), sink,
+        lambda starttime, endtime: partition_name(starttime) + extension,
+        depth or 0).export(starttime, endtime, limit, after)
+
+# Writes a sample of the newest day with every codec and prints how they
+# compare
+def benchmark_day(endtime, limit, sync_interval, layout=FEATURE_LAYOUT):
+    plan, predictions = feature_transform(layout).plan(
+        prediction_source.find(endtime - timedelta(1), endtime, limit))
+    records = list(plan.rows(predictions, BATCH_SIZE))
+    print_benchmark(
+        benchmark_codecs(plan.schema, records, CODECS, sync_interval),
+        len(records))
+
+# Exits with a usage error naming the given options, (flag, value) pairs,
+# that mode would ignore
+def reject_options(parser, mode, options):
+    given = [flag for flag, value in options if value]
+    if given:
+        parser.error('{} cannot be combined with {}'.format(
+            mode, ', '.join(given)))
+
+metrics = job_metrics('fastavro_mongo_hdfs_transform_normalized', environ)
+timer = metrics.timer
 
 
 if __name__=='__main__':
-    symbols = {
-        #'Urine Appearance >>> clear': 'urine-appearance_is_clear'
-        #'Urine Appearance >>> Clear': 'urine-appearance_is_clear_new'
-    }
-    #with timer('Schema:'):
-        #generate_avro_schema(symbols)
+    configure_logging(environ)
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--days', type=int, default=40,
+        help='number of day partitions to export, walking back from today')
+    parser.add_argument('--processes', type=int, default=1,
+        help='worker processes exporting day partitions in parallel')
+    parser.add_argument('--limit', type=int,
+        help='maximum number of predictions exported per day (default '
+             '{}, not with --split, which exports whole days)'.format(LIMIT))
+    parser.add_argument('--schema-window', action='store_true',
+        help='infer the feature keys from every document being exported '
+             'rather than a sample')
+    parser.add_argument('--incremental', action='store_true',
+        help='export, without a limit, every day since the last committed '
+             'partition recorded in --state (the last --days days on the '
+             'first run)')
+    parser.add_argument('--state', default='.export_state.json',
+        help='watermark state file used by --incremental')
+    parser.add_argument('--format', choices=('avro', 'parquet'),
+        default='avro', help='output file format')
+    parser.add_argument('--layout', choices=LAYOUTS, default=FEATURE_LAYOUT,
+        help='write a field per feature (flat), or each record\'s features '
+             'as a float array (vector) or float32 bytes (packed) with a null '
+             'bitmap, or as the indices and values of the present ones '
+             '(sparse), with the feature dictionary in the file metadata; '
+             'auto writes sparse records for days sparser than {:.0%}, '
+             'vectors otherwise, never flat fields'.format(SPARSE_DENSITY))
+    parser.add_argument('--codec', default=AVRO_OPTIONS['codec'],
+        choices=CODECS, help='avro block compression codec')
+    parser.add_argument('--sync-interval', type=int,
+        default=AVRO_OPTIONS['sync_interval'],
+        help='uncompressed bytes per avro block')
+    parser.add_argument('--part-bytes', type=int,
+        help='split each day into _partNNNN.avro files of about this many '
+             'bytes, with a manifest (default one HDFS block when '
+             '--part-records is given)')
+    parser.add_argument('--part-records', type=int,
+        help='split each day into _partNNNN.avro files of at most this '
+             'many records, with a manifest')
+    parser.add_argument('--pipeline-depth', type=int, default=0,
+        help='overlap the Mongo fetch, encoding and HDFS writes through '
+             'queues this deep (e.g. {}) and report each stage\'s busy and '
+             'idle time'.format(QUEUE_DEPTH))
+    parser.add_argument('--async-windows', type=int, default=0,
+        help='export up to this many day windows at once on asyncio '
+             '(e.g. {}) instead of --processes'.format(CONCURRENCY))
+    parser.add_argument('--split', type=int, default=0,
+        help='cut each day into this many WCT sub-ranges of about equal '
+             'size, read by --processes workers at once and merged into the '
+             'day\'s file')
+    parser.add_argument('--keep-parts', action='store_true',
+        help='with --split, keep the sub-ranges as _partNNNN.avro files and '
+             'a manifest instead of merging them')
+    parser.add_argument('--benchmark-codecs', action='store_true',
+        help='write --limit predictions of the newest day with every avro '
+             'codec, report size and encode/decode time, then exit')
+    parser.add_argument('--row-group-size', type=int, default=ROW_GROUP_SIZE,
+        help='rows per parquet row group')
+    parser.add_argument('--compression', default=COMPRESSION,
+        help='parquet compression codec')
+    parser.add_argument('--uploads', type=int, default=0,
+        help='stage part files locally and upload this many to HDFS at a '
+             'time (e.g. {}) instead of streaming one file'.format(UPLOADS))
+    parser.add_argument('--retries', type=int, default=RETRIES,
+        help='retries of a failed part upload')
+    parser.add_argument('--profile', metavar='DIRECTORY',
+        default=environ.get('EXPORT_PROFILE'),
+        help='write a cProfile .prof and the top allocating lines of every '
+             'partition into DIRECTORY (or set EXPORT_PROFILE)')
+    parser.add_argument('--profile-sample', type=float, metavar='SECONDS',
+        default=float(environ.get('EXPORT_PROFILE_SAMPLE', 0)),
+        help='with --profile, also sample every thread\'s stack this often '
+             'into a folded flame graph file (or set EXPORT_PROFILE_SAMPLE)')
+    args = parser.parse_args()
+    if args.async_windows and args.layout == 'auto':
+        parser.error('--layout auto needs a window\'s documents before its '
+            'file is opened, pick another layout for --async-windows')
+    if args.format == 'parquet':
+        reject_options(parser, '--format parquet', (
+            ('--codec', args.codec != AVRO_OPTIONS['codec']),
+            ('--sync-interval',
+                args.sync_interval != AVRO_OPTIONS['sync_interval']),
+            ('--part-bytes', args.part_bytes),
+            ('--part-records', args.part_records),
+            ('--uploads', args.uploads),
+            ('--pipeline-depth', args.pipeline_depth),
+            ('--split', args.split)))
+    if args.split:
+        reject_options(parser, '--split', (
+            ('--limit', args.limit is not None),
+            ('--part-bytes', args.part_bytes),
+            ('--part-records', args.part_records),
+            ('--uploads', args.uploads),
+            ('--pipeline-depth', args.pipeline_depth)))
+    if args.async_windows:
+        reject_options(parser, '--async-windows', (
+            ('--format parquet', args.format == 'parquet'),
+            ('--part-bytes', args.part_bytes),
+            ('--part-records', args.part_records),
+            ('--uploads', args.uploads),
+            ('--pipeline-depth', args.pipeline_depth),
+            ('--split', args.split),
+            ('--incremental', args.incremental)))
+    if args.limit is None and not args.split:
+        args.limit = LIMIT
+
+    parts = None
+    if args.part_bytes or args.part_records:
+        parts = {
+            'max_bytes': args.part_bytes or HDFS_BLOCK_SIZE,
+            'max_records': args.part_records}
+    avro = {'codec': args.codec, 'sync_interval': args.sync_interval}
+    export = partial(export_day, avro=avro, parts=parts,
+        uploads=args.uploads, retries=args.retries,
+        depth=args.pipeline_depth, layout=args.layout)
+    if args.split:
+        export = partial(export_day_split, avro=avro, parts=args.split,
+            processes=args.processes, merge=not args.keep_parts,
+            layout=args.layout)
+    if args.format == 'parquet':
+        export = partial(export_day, parquet={
+            'row_group_size': args.row_group_size,
+            'compression': args.compression}, layout=args.layout)
+    profiler = Profiler(args.profile, args.profile_sample)
+    export = profiler.wrap(export)
 
     endtime = datetime.now()
     endtime = datetime(endtime.year,endtime.month,endtime.day)
 
-    for i in range(40):
-        starttime = endtime - timedelta(1)
-        file_name = ''.join(('transforms_test/',
-            starttime.strftime("%Y"), '/',
-            starttime.strftime("%m"), '/',
-            starttime.strftime("%Y_%m_%d"), '_transform.avro'))
-        with timer('Mongo: '):
-            predictions = list(get_mongo_predictions(starttime, endtime, 1000))
-        with timer('Avro:  '):
-           write_avro(file_name, predictions, symbols)
-        endtime=starttime
+    if args.benchmark_codecs:
+        benchmark_day(endtime, args.limit, args.sync_interval, args.layout)
+        exit()
+
+    with timer('Schema:'):
+        window = None
+        if args.schema_window:
+            window = (endtime - timedelta(args.days), endtime)
+        avro_schema, feature_symbols = generate_avro_schema(window)
+
+    with timer('Export:'), profiler.sampling():
+        if args.incremental:
+            results = run_incremental(
+                Checkpoint(args.state),
+                'sepsismodel.transform',
+                export,
+                endtime - timedelta(args.days),
+                endtime)
+        elif args.async_windows:
+            results = run_async_backfill(
+                connect_async,
+                lambda window: prediction_source.query(*window),
+                partial(open_window_sink, avro_schema=avro_schema,
+                    feature_symbols=feature_symbols, layout=args.layout,
+                    **avro),
+                day_windows(endtime, args.days),
+                args.async_windows,
+                projection=PROJECTION,
+                limit=args.limit,
+                batch_size=BATCH_SIZE)
+        else:
+            # Split days already spread each day over the processes
+            results = run_backfill(
+                partial(export, limit=args.limit),
+                day_windows(endtime, args.days),
+                1 if args.split else args.processes)
+    metrics.collect(results)
+    metrics.emit()
+    exit(1 if summarize(results) else 0)
@@ -1,131 +1,128 @@
-from contextlib import contextmanager
+from argparse import ArgumentParser
 from datetime import (
     datetime,
     timedelta)
-from os import (
-    path,
-    makedirs)
-from timeit import Timer
-from time import clock, mktime
-
-from fastavro import writer
-from pymongo import MongoClient
-from yaml import safe_load as yaml_load
-
-with open('mongo_creds.yml') as credsfile:
-    creds = yaml_load(credsfile)
-
-client = MongoClient(host='uphsvlndc058.uphs.upenn.edu',port=27017)
-is_authed = client.admin.authenticate(creds['user'],creds['pass'])
-
-psPreds = client.psPreds.preds
-
-
+from os import environ
+from sys import exit
+
+from mongo_avro.aggregate import FETCH_MODES
+from mongo_avro.checkpoint import Checkpoint
+from mongo_avro.codecs import avro_options
+from mongo_avro.engine import (
+    BATCH_SIZE,
+    Exporter,
+    LocalSink,
+    PredictionTransform,
+    Source)
+from mongo_avro.metrics import configure_logging, job_metrics
+from mongo_avro.profiling import profiler_from_environ
+from mongo_avro.tail import RollingAvroFile, Tail, TAIL_SORT, tail_query
+from mongo_avro.sepsis import (
+    MODEL,
+    aggregate_pipeline,
+    prediction_schema,
+    to_record)
+
+# Predictions the tail exports per poll at most, from --poll-limit
+POLL_LIMIT = 10000
+# Avro codec and block size, from AVRO_CODEC and AVRO_SYNC_INTERVAL
+AVRO_OPTIONS = avro_options(environ)
+
+# 'find' reshapes predictions in python, 'aggregate' has Mongo reshape them
+FETCH_MODE = environ.get('FETCH_MODE', 'find')
+
+
+# The prediction schema has no feature fields, so it is built without
+# querying Mongo
 def generate_avro_schema():
-    q = {'modelName':'sepsismodel_noEpoch'}
-    predictions = list(psPreds.find(q).limit(1))
-    fields = []
-    fields.append({
-        'name': 'event_id',
-        'type': 'string'})
-    fields.append({
-        'name': 'valid_on',
-        'type': ['int', 'null'],
-        'logicalType': 'time-millis'})
-    fields.append({
-        'name': 'created_on',
-        'type': ['int', 'null'],
-        'logicalType': 'time-millis'})
-    fields.append({
-        'name': 'input_events',
-        'type': 'string',
-        'doc': 'Array of the penn signal event_ids that we\'re used as input into the transform output'})
-    fields.append({'name': 'patient_id', 'type': ['int', 'null']})
-    fields.append({
-        'name': 'provenance',
-        'type':{
-            'type': 'array',
-            'items': {
-                'name': 'source',
-                'type': 'string'
-            }}
-        })
-    fields.append({
-        'name': 'Prediction',
-        'doc': 'Prediction type could be a classification or regression.',
-        'type': 'float'
-        })
-    fields.append({
-        'name': 'Score',
-        'doc': 'Prediction type could be a classification, regression, or a string txt.',
-        'type': 'float'
-        })
-    fields.append({
-        'name': 'heuristic_rule',
-        'doc': 'True or False to report the predicted outcome.  The Data Scientist can create heuristic rules that determines if the predictive is reported or not.  True=Report, False=Do not report.',
-        'type': 'boolean'
-        })
-
-    return {
-        'type': 'record',
-        'name': 'Predictions',
-        'doc': 'The transform is either scalar or vector (array). The ' +
-            'indices are held in key value pairs in the schema.  The types ' +
-            'of the values are unique to the transform component.  ' +
-            'Typically the values will be floats.',
-        'fields': fields
-    }
-
-def get_mongo_predictions(starttime, endtime, limit=None):
-    q = {'modelName':'sepsismodel',
-         'WCT':{'$gt':starttime,'$lt':endtime}}
-    r = psPreds.find(q,{'WCT':1,'VISIT_NUMBER':1,'result':1,
-        '_id':1})
-    return r if limit is None else r.limit(limit)
-
-def get_features(file_name, predictions):
-    schema = generate_avro_schema()
-    with open(file_name, 'wb') as out:
-        writer(out, schema, to_avro(predictions))
-
-def to_avro(predictions):
-    for prediction in predictions:
-        data = {}
-        data['event_id'] = 'pred_' + str(prediction['_id'])
-        data['valid_on'] = int(prediction['WCT'].timestamp())
-        data['created_on'] = int(prediction['WCT'].timestamp())
-        data['input_events'] = str(prediction['_id'])
-        data['patient_id'] = prediction['VISIT_NUMBER']
-        data['provenance'] = ['psPredsExtract', 'PredictSepsis']
-        data['Prediction'] = float(prediction['result']['result']['predict'])
-        data['Score'] = float(prediction['result']['result']['score'])
-        data['heuristic_rule'] = prediction['result']['result']['heuristic_alert']
-        yield data
-
-
-@contextmanager
-def timer(name):
-    start = clock()
-    try:
-        yield
-    finally:
-        print('{} {}'.format(name, clock() - start))
+    return prediction_schema()
+
+# Query mongodb for the predictions past the tail watermark, oldest first
+# (or after since on the first run), reshaped by Mongo under
+# FETCH_MODE=aggregate
+def tail_mongo_predictions(mark, since, limit=POLL_LIMIT,
+        batch_size=BATCH_SIZE):
+    q = {'modelName':MODEL}
+    if not mark or 'WCT' not in mark:
+        q['WCT'] = {'$gte':since}
+    q = tail_query(q, mark)
+    if FETCH_MODE == 'aggregate':
+        return predictions.source.collection().aggregate(
+            aggregate_pipeline(q, limit, sort=TAIL_SORT),
+            batchSize=batch_size)
+    return predictions.source.collection().find(q,
+        predictions.source.projection).sort(
+        TAIL_SORT).batch_size(batch_size).limit(limit)
+
+
+predictions = Exporter(
+    Source({'modelName':MODEL},
+        {'WCT':1,'VISIT_NUMBER':1,'result':1,'_id':1},
+        pipeline=aggregate_pipeline if FETCH_MODE == 'aggregate' else None,
+        start='$gt'),
+    PredictionTransform(generate_avro_schema(), to_record),
+    LocalSink(**AVRO_OPTIONS),
+    lambda starttime, endtime: ''.join(('',
+        starttime.strftime("%Y_%m_%d"), '-',
+        endtime.strftime("%Y_%m_%d"), '_preds.avro')))
+
+
+metrics = job_metrics('fastavro_mongo_preds', environ)
+timer = metrics.timer
 
 
 if __name__=='__main__':
+    configure_logging(environ)
+    parser = ArgumentParser()
+    parser.add_argument('--tail', metavar='DIRECTORY',
+        help='keep running, exporting new predictions into rolling avro '
+             'files in DIRECTORY')
+    parser.add_argument('--poll-interval', type=float, default=1.0,
+        help='seconds between polls when the tail has caught up')
+    parser.add_argument('--rotate-bytes', type=int, default=128 << 20,
+        help='size at which the tail starts a new avro file')
+    parser.add_argument('--rotate-seconds', type=int, default=3600,
+        help='age at which the tail starts a new avro file')
+    parser.add_argument('--state', default='.export_state.json',
+        help='file holding the tail watermark across restarts')
+    parser.add_argument('--poll-limit', type=int, default=POLL_LIMIT,
+        help='most predictions the tail exports per poll; a full poll is '
+             'followed by the next one without waiting')
+    args = parser.parse_args()
+    if args.poll_limit < 1:
+        parser.error('--poll-limit must be at least 1')
+    if FETCH_MODE not in FETCH_MODES:
+        parser.error('FETCH_MODE must be one of {}, not {!r}'.format(
+            ', '.join(FETCH_MODES), FETCH_MODE))
+
+    if args.tail:
+        since = datetime.utcnow()
+        output = RollingAvroFile(args.tail, 'preds', generate_avro_schema(),
+            args.rotate_bytes, args.rotate_seconds, **AVRO_OPTIONS)
+        Tail(lambda mark: tail_mongo_predictions(mark, since,
+                args.poll_limit),
+            to_record,
+            output,
+            Checkpoint(args.state),
+            'sepsismodel.tail',
+            args.poll_interval,
+            metrics).run()
+        exit()
+
     with timer('Schema:'):
         generate_avro_schema()
 
     endtime = datetime.now()
     endtime = datetime(endtime.year,endtime.month,endtime.day)
 
-    for i in range(10):
-        starttime = endtime - timedelta(5)
-        file_name = ''.join(('',
-            starttime.strftime("%Y_%m_%d"), '-',
-            endtime.strftime("%Y_%m_%d"), '_preds.avro'))
-        with timer('Mongo: '):
-            predictions = list(get_mongo_predictions(starttime, endtime, 1000))
-        with timer('Avro:  '):
-            get_features(file_name, predictions)
-        endtime=starttime
+    profiler = profiler_from_environ(environ)
+    export = profiler.wrap(predictions.export)
+    with profiler.sampling():
+        for i in range(10):
+            starttime = endtime - timedelta(5)
+            with timer('Export:'):
+                stats = export(starttime, endtime, 1000)
+            print('Streamed {records} records, {bytes} bytes'.format(**stats))
+            metrics.add(stats)
+            endtime=starttime
+    metrics.emit()
@@ -1,137 +1,73 @@
-from contextlib import contextmanager
+from functools import partial
 from datetime import (
     datetime,
     timedelta)
-from os import (
-    path,
-    makedirs)
-from timeit import Timer
-from time import clock, mktime
-from sys import getsizeof
-
-from fastavro import writer
-from pymongo import MongoClient
-from yaml import safe_load as yaml_load
-
-with open('mongo_creds.yml') as credsfile:
-    creds = yaml_load(credsfile)
-
-client = MongoClient(host='uphsvlndc058.uphs.upenn.edu',port=27017)
-is_authed = client.admin.authenticate(creds['user'],creds['pass'])
-
-psPreds = client.psPreds.preds
-
-
+from os import environ
+from sys import exit
+
+from mongo_avro.aggregate import FETCH_MODES
+from mongo_avro.codecs import avro_options
+from mongo_avro.engine import (
+    Exporter,
+    LocalSink,
+    PredictionTransform,
+    Source)
+from mongo_avro.metrics import configure_logging, job_metrics
+from mongo_avro.profiling import profiler_from_environ
+from mongo_avro.sepsis import (
+    MODEL,
+    aggregate_pipeline,
+    prediction_schema,
+    to_record)
+
+# Avro codec and block size, from AVRO_CODEC and AVRO_SYNC_INTERVAL
+AVRO_OPTIONS = avro_options(environ)
+
+# 'find' reshapes predictions in python, 'aggregate' has Mongo reshape them
+FETCH_MODE = environ.get('FETCH_MODE', 'find')
+
+
+# The prediction schema has no feature fields, so it is built without
+# querying Mongo
 def generate_avro_schema():
-    q = {'modelName':'sepsismodel_noEpoch'}
-    predictions = list(psPreds.find(q).limit(1))
-    fields = []
-    fields.append({
-        'name': 'event_id',
-        'type': 'string'})
-    fields.append({
-        'name': 'valid_on',
-        'type': ['int', 'null'],
-        'logicalType': 'time-millis'})
-    fields.append({
-        'name': 'created_on',
-        'type': ['int', 'null'],
-        'logicalType': 'time-millis'})
-    fields.append({
-        'name': 'input_events',
-        'type': 'null',
-        'doc': 'Array of the penn signal event_ids that we\'re used as input into the transform output'})
-    fields.append({'name': 'patient_id', 'type': ['int', 'null']})
-    fields.append({
-        'name': 'provenance',
-        'type':{
-            'type': 'array',
-            'items': {
-                'name': 'source',
-                'type': 'string'
-            }}
-        })
-    fields.append({
-        'name': 'Prediction',
-        'doc': 'Prediction type could be a classification or regression.',
-        'type': 'float'
-        })
-    fields.append({
-        'name': 'Score',
-        'doc': 'Prediction type could be a classification, regression, or a string txt.',
-        'type': 'float'
-        })
-    fields.append({
-        'name': 'heuristic_rule',
-        'doc': 'True or False to report the predicted outcome.  The Data Scientist can create heuristic rules that determines if the predictive is reported or not.  True=Report, False=Do not report.',
-        'type': 'boolean'
-        })
-
-    return {
-        'type': 'record',
-        'name': 'Transform',
-        'doc': 'The transform is either scalar or vector (array). The ' +
-            'indices are held in key value pairs in the schema.  The types ' +
-            'of the values are unique to the transform component.  ' +
-            'Typically the values will be floats.',
-        'fields': fields
-    }
-
-def get_mongo_predictions(starttime, endtime, limit=None):
-    q = {'modelName':'sepsismodel',
-         'WCT':{'$gt':starttime,'$lt':endtime}}
-    r = psPreds.find(q,{'WCT':1,'VISIT_NUMBER':1,'result':1,
-        '_id':1})
-    return r if limit is None else r.limit(limit)
-
-def get_features(file_name, predictions):
-    schema = generate_avro_schema()
-    with open(file_name, 'wb') as out:
-        writer(out, schema, to_avro(predictions))
-
-def to_avro(predictions):
-    for i in predictions:
-        data = {}
-        time = to_timestamp(i['WCT'])
-        data['event_id'] = 'pred_' + str(i['_id'])
-        data['valid_on'] = time
-        data['created_on'] = time
-        data['input_events'] = ''
-        data['patient_id'] = i['VISIT_NUMBER']
-        data['provenance'] = ['psPredsExtract', 'PredictSepsis']
-        data['Prediction'] = float(i['result']['result']['predict'])
-        data['Score'] = float(i['result']['result']['score'])
-        data['heuristic_rule'] = i['result']['result']['heuristic_alert']
-        yield data
+    return prediction_schema('Transform', ['null', 'string'])
 
-def to_timestamp(date):
-    raw_date = str(date).split(".")[0]
-    time_format = "%Y-%m-%d %H:%M:%S"
-    return int(mktime(datetime.strptime(raw_date, time_format).timetuple()))
+predictions = Exporter(
+    Source({'modelName':MODEL},
+        {'WCT':1,'VISIT_NUMBER':1,'result':1,'_id':1},
+        pipeline=aggregate_pipeline if FETCH_MODE == 'aggregate' else None,
+        start='$gt'),
+    # Records carry an empty input_events
+    PredictionTransform(generate_avro_schema(),
+        partial(to_record, input_events=lambda prediction: '')),
+    LocalSink(**AVRO_OPTIONS),
+    lambda starttime, endtime: ''.join(('',
+        starttime.strftime("%Y_%m_%d"), '-',
+        endtime.strftime("%Y_%m_%d"), '_preds.avro')))
 
-@contextmanager
-def timer(name):
-    start = clock()
-    try:
-        yield
-    finally:
-        print('{} {}'.format(name, clock() - start))
+metrics = job_metrics('fastavro_mongo_preds_py2', environ)
+timer = metrics.timer
 
 
 if __name__=='__main__':
+    if FETCH_MODE not in FETCH_MODES:
+        exit('FETCH_MODE must be one of {}, not {!r}'.format(
+            ', '.join(FETCH_MODES), FETCH_MODE))
+    configure_logging(environ)
     with timer('Schema:'):
         generate_avro_schema()
 
     endtime = datetime.now()
     endtime = datetime(endtime.year,endtime.month,endtime.day)
 
-    for i in range(1):
-        starttime = endtime - timedelta(10)
-        file_name = ''.join(('',
-            starttime.strftime("%Y_%m_%d"), '-',
-            endtime.strftime("%Y_%m_%d"), '_preds.avro'))
-        with timer('Mongo: '):
-            predictions = list(get_mongo_predictions(starttime, endtime, 1000))
-        with timer('Avro:  '):
-            get_features(file_name, predictions)
-        endtime=starttime
+    profiler = profiler_from_environ(environ)
+    export = profiler.wrap(predictions.export)
+    with profiler.sampling():
+        for i in range(1):
+            starttime = endtime - timedelta(10)
+            with timer('Export:'):
+                stats = export(starttime, endtime, 1000)
+            print('Streamed {records} records, {bytes} bytes'.format(**stats))
+            metrics.add(stats)
+            endtime=starttime
+    metrics.emit()
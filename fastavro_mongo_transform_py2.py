@@ -1,121 +1,77 @@
-from contextlib import contextmanager
 from datetime import (
     datetime,
     timedelta)
-from os import (
-    path,
-    makedirs)
-from timeit import Timer
-from time import clock, mktime
-from sys import getsizeof
-
-from fastavro import writer
-from pymongo import MongoClient
-from yaml import safe_load as yaml_load
-
-with open('mongo_creds.yml') as credsfile:
-    creds = yaml_load(credsfile)
-
-client = MongoClient(host='uphsvlndc058.uphs.upenn.edu',port=27017)
-is_authed = client.admin.authenticate(creds['user'],creds['pass'])
-
-psPreds = client.psPreds.preds
-
-
-def generate_avro_schema():
-    q = {'modelName':'sepsismodel_noEpoch'}
-    predictions = list(psPreds.find(q).limit(1))
-
-    fields = [{'name': key, 'type': ['float', 'null']}
-        for key in predictions[0]['features'].keys()]
-    fields.append({
-        'name': 'event_id',
-        'type': 'string'})
-    fields.append({
-        'name': 'valid_on',
-        'type': ['int', 'null'],
-        'logicalType': 'time-millis'})
-    fields.append({
-        'name': 'created_on',
-        'type': ['int', 'null'],
-        'logicalType': 'time-millis'})
-    fields.append({
-        'name': 'input_events',
-        'type': 'null',
-        'doc': 'Array of the penn signal event_ids that we\'re used as input into the transform output'})
-    fields.append({'name': 'patient_id', 'type': ['int', 'null']})
-    fields.append({
-        'name': 'provenance',
-        'type':{
-            'type': 'array',
-            'items': {
-                'name': 'source',
-                'type': 'string'
-            }}
-        })
-    return {
-        'type': 'record',
-        'name': 'Transform',
-        'doc': 'The transform is either scalar or vector (array). The ' +
-            'indices are held in key value pairs in the schema.  The types ' +
-            'of the values are unique to the transform component.  ' +
-            'Typically the values will be floats.',
-        'fields': fields
-    }
-
-def get_mongo_predictions(starttime, endtime, limit=None):
-    q = {'modelName':'sepsismodel',
-         'WCT':{'$gt':starttime,'$lt':endtime}}
-    r = psPreds.find(q,{'WCT':1,'VISIT_NUMBER':1,'features':1,
-        '_id':1})
-    return r if limit is None else r.limit(limit)
-
-def get_features(file_name, predictions):
-    schema = generate_avro_schema()
-    with open(file_name, 'wb') as out:
-        writer(out, schema, to_avro(predictions))
-
-def to_avro(predictions):
-    for prediction in predictions:
-        time = to_timestamp(prediction['WCT'])
-        data = {key: float(value) for key, value in prediction['features'].items()}
-        data['event_id'] = str(prediction['_id'])
-        data['valid_on'] = time
-        data['created_on'] = time
-        data['input_events'] = ''
-        data['patient_id'] = prediction['VISIT_NUMBER']
-        data['provenance'] = ['psPredsExtract', 'TransformSepsis']
-        yield data
-
-def to_timestamp(date):
-    raw_date = str(date).split(".")[0]
-    time_format = "%Y-%m-%d %H:%M:%S"
-    return int(mktime(datetime.strptime(raw_date, time_format).timetuple()))
-
-@contextmanager
-def timer(name):
-    start = clock()
-    try:
-        yield
-    finally:
-        print('{} {}'.format(name, clock() - start))
+from os import environ
+
+from mongo_avro.codecs import avro_options
+from mongo_avro.engine import (
+    Exporter,
+    FeatureTransform,
+    LocalSink,
+    Source)
+from mongo_avro.metrics import configure_logging, job_metrics
+from mongo_avro.profiling import profiler_from_environ
+from mongo_avro.schema_cache import SchemaCache
+from mongo_avro.sepsis import (
+    MODEL,
+    SCHEMA_MODEL,
+    sample_feature_keys,
+    transform_metadata,
+    transform_schema)
+
+# Avro codec and block size, from AVRO_CODEC and AVRO_SYNC_INTERVAL
+AVRO_OPTIONS = avro_options(environ)
+# RAW_BSON=1 reads documents as raw BSON, which still decodes the whole
+# features subdocument, most of each document, so it is off by default
+RAW_BSON = environ.get('RAW_BSON', '0') == '1'
+
+# Each script builds its own schema, so each caches it under its own kind
+schema_cache = SchemaCache('transform_py2', version=2)
+
+
+# Avro fields filled from the Mongo document rather than its features
+METADATA = transform_metadata(input_events=lambda prediction: '')
+
+def build_avro_schema(keys):
+    return transform_schema(
+        ({'name': key, 'type': ['float', 'null']} for key in keys), 'null')
+
+transform = Exporter(
+    Source({'modelName':MODEL},
+        {'WCT':1,'VISIT_NUMBER':1,'features':1,'_id':1},
+        raw=RAW_BSON, start='$gt'),
+    FeatureTransform(schema_cache, SCHEMA_MODEL, sample_feature_keys,
+        lambda keys: (build_avro_schema(keys), None), METADATA),
+    LocalSink(**AVRO_OPTIONS),
+    lambda starttime, endtime: ''.join(('',
+        starttime.strftime("%Y_%m_%d"), '-',
+        endtime.strftime("%Y_%m_%d"), '_transform.avro')))
+
+# Generates avro schema, reusing the cached one while the feature keys match
+def generate_avro_schema(window=None):
+    return transform.transform.schema(window)
+
+metrics = job_metrics('fastavro_mongo_transform_py2', environ)
+timer = metrics.timer
 
 
 if __name__=='__main__':
+    configure_logging(environ)
     with timer('Schema:'):
         generate_avro_schema()
 
     endtime = datetime.now()
     endtime = datetime(endtime.year,endtime.month,endtime.day)
 
-    for i in range(365):
-        starttime = endtime - timedelta(10)
-        #feats = get_features(starttime,endtime)
-        file_name = ''.join(('',
-            starttime.strftime("%Y_%m_%d"), '-',
-            endtime.strftime("%Y_%m_%d"), '_transform.avro'))
-        with timer('Mongo: '):
-            predictions = list(get_mongo_predictions(starttime, endtime, 1000))
-        with timer('Avro:  '):
-            get_features(file_name, predictions)
-        endtime=starttime
+    profiler = profiler_from_environ(environ)
+    export = profiler.wrap(transform.export)
+    with profiler.sampling():
+        for i in range(365):
+            starttime = endtime - timedelta(10)
+            #feats = get_features(starttime,endtime)
+            with timer('Export:'):
+                stats = export(starttime, endtime, 1000)
+            print('Streamed {records} records, {bytes} bytes'.format(**stats))
+            metrics.add(stats)
+            endtime=starttime
+    metrics.emit()
@@ -0,0 +1,2 @@
+'''Shared helpers for the fastavro_mongo export scripts.
+'''
@@ -0,0 +1,49 @@
+'''Builds the aggregation that reshapes prediction documents on the server.
+
+Instead of shipping the whole result subdocument and flattening it in
+python, $project digs out predict/score/heuristic_alert, converts WCT to an
+epoch integer and builds the pred_ event id, so each document crosses the
+wire already shaped like an avro record. Needs MongoDB 4.0 for $toString,
+$toLong and $toDouble.
+'''
+from bson.son import SON
+
+from mongo_avro.timestamps import EPOCH
+
+# Switches exporters between find() plus python reshaping and the pipeline
+FETCH_MODES = ('find', 'aggregate')
+
+
+# Expression turning the WCT date into an epoch integer in unit
+def epoch_expression(unit='millis'):
+    millis = {'$subtract': ['$WCT', EPOCH]}
+    if unit == 'seconds':
+        return {'$toLong': {'$floor': {'$divide': [millis, 1000]}}}
+    if unit == 'micros':
+        return {'$toLong': {'$multiply': [millis, 1000]}}
+    return {'$toLong': millis}
+
+# Pipeline returning prediction records ready for the avro writer, in sort
+# order when given as (field, direction) pairs. WCT and _id are kept
+# alongside so watermarks can still be tracked.
+def prediction_pipeline(query, provenance, unit='millis', limit=None,
+        event_prefix='pred_', sort=None):
+    pipeline = [{'$match': query}]
+    if sort:
+        pipeline.append({'$sort': SON(sort)})
+    if limit is not None:
+        pipeline.append({'$limit': limit})
+    epoch = epoch_expression(unit)
+    pipeline.append({'$project': {
+        '_id': 1,
+        'WCT': 1,
+        'event_id': {'$concat': [event_prefix, {'$toString': '$_id'}]},
+        'valid_on': epoch,
+        'created_on': epoch,
+        'input_events': {'$toString': '$_id'},
+        'patient_id': '$VISIT_NUMBER',
+        'provenance': {'$literal': provenance},
+        'Prediction': {'$toDouble': '$result.result.predict'},
+        'Score': {'$toDouble': '$result.result.score'},
+        'heuristic_rule': '$result.result.heuristic_alert'}})
+    return pipeline
@@ -0,0 +1,124 @@
+'''Exports many windows at once on asyncio, for backfills that spend their
+time waiting on Mongo round trips rather than encoding.
+
+Up to concurrency windows keep a cursor open at a time over one async client
+(pymongo's AsyncMongoClient or Motor) and its connection pool. Each batch
+that arrives is converted and encoded on an executor thread while the event
+loop carries on with the other cursors, so a backfill of many small windows
+takes roughly as long as its slowest windows rather than their sum. Results
+come back in the same (window, stats, error) form as run_backfill.
+'''
+import asyncio
+import inspect
+from concurrent.futures import ThreadPoolExecutor
+from sys import exc_info
+from traceback import format_exc
+
+from fastavro.write import Writer
+
+from mongo_avro.backfill import report
+from mongo_avro.metrics import BATCH_SIZE
+from mongo_avro.rolling import CountingFile
+
+# Windows with a cursor in flight at once
+CONCURRENCY = 16
+
+
+class AvroSink(object):
+    '''Avro file a window is written to, one batch of documents at a time.
+    open_file(file_name) returns a context manager giving a writable binary
+    file and convert(documents) yields the records of a batch.'''
+
+    def __init__(self, open_file, file_name, schema, convert, **options):
+        self.file_name = file_name
+        self.convert = convert
+        self.records = 0
+        self._context = open_file(file_name)
+        self._out = CountingFile(self._context.__enter__())
+        self._writer = Writer(self._out, schema, **options)
+
+    def write(self, documents):
+        for record in self.convert(documents):
+            self._writer.write(record)
+            self.records += 1
+
+    # Finishes the file, returning the records and bytes written
+    def close(self):
+        self._writer.flush()
+        self._context.__exit__(None, None, None)
+        return {'records': self.records, 'bytes': self._out.bytes}
+
+    # Abandons the file after a failure, closing it with the failure's
+    # (type, value, traceback)
+    def abort(self, exc_type, exc_value, traceback):
+        self._context.__exit__(exc_type, exc_value, traceback)
+
+
+# Streams find(query, projection) into the sink open_sink(window) returns,
+# encoding each batch on executor, and returns the sink's stats
+async def export_window(collection, query, open_sink, window, executor,
+        projection=None, limit=None, batch_size=BATCH_SIZE):
+    loop = asyncio.get_running_loop()
+    sink = await loop.run_in_executor(executor, open_sink, window)
+    try:
+        cursor = collection.find(query, projection).batch_size(batch_size)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        batch = []
+        async for document in cursor:
+            batch.append(document)
+            if len(batch) >= batch_size:
+                await loop.run_in_executor(executor, sink.write, batch)
+                batch = []
+        if batch:
+            await loop.run_in_executor(executor, sink.write, batch)
+    except BaseException:
+        # Closing the file may be a blocking HDFS call too
+        await loop.run_in_executor(executor, sink.abort, *exc_info())
+        raise
+    return await loop.run_in_executor(executor, sink.close)
+
+# Closes an async client, whose close() is a coroutine in pymongo's
+# AsyncMongoClient and a plain method in Motor
+async def close_client(client):
+    closed = client.close()
+    if inspect.isawaitable(closed):
+        await closed
+
+# Exports every window on an event loop. connect() is called on the loop and
+# returns the async collection, whose client is closed once every window is
+# done, query_for(window) the window's query and open_sink(window) its
+# AvroSink; workers threads do the encoding.
+def run_async_backfill(connect, query_for, open_sink, windows,
+        concurrency=CONCURRENCY, workers=None, **find_options):
+    async def backfill():
+        collection = connect()
+        semaphore = asyncio.Semaphore(concurrency)
+        executor = ThreadPoolExecutor(workers or concurrency)
+
+        async def run(window):
+            async with semaphore:
+                try:
+                    stats = await export_window(collection, query_for(window),
+                        open_sink, window, executor, **find_options)
+                    return window, stats, None
+                except Exception:
+                    return window, None, format_exc()
+
+        results = []
+        try:
+            for result in asyncio.as_completed(
+                    [run(window) for window in windows]):
+                results.append(report(await result))
+        finally:
+            executor.shutdown()
+            await close_client(collection.database.client)
+        return results
+
+    loop = asyncio.new_event_loop()
+    try:
+        results = loop.run_until_complete(backfill())
+    finally:
+        loop.close()
+    results.sort(key=lambda result: result[0], reverse=True)
+    return results
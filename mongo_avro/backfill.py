@@ -0,0 +1,67 @@
+'''Runs day partitioned exports one after another or spread over a pool of
+worker processes, and summarises which partitions succeeded or failed.
+'''
+from datetime import timedelta
+from multiprocessing import Pool
+from traceback import format_exc
+
+
+# Walks back from endtime yielding (starttime, endtime) windows of span days
+def day_windows(endtime, days, span=1):
+    for i in range(days):
+        starttime = endtime - timedelta(span)
+        yield starttime, endtime
+        endtime = starttime
+
+# Exports a single window, capturing the failure instead of raising so that
+# one bad day does not take the rest of the backfill down with it
+def run_window(job):
+    export, window = job
+    try:
+        return window, export(*window), None
+    except Exception:
+        return window, None, format_exc()
+
+# Exports every window, in process when processes is 1, otherwise over a pool
+# whose workers each call initializer first (e.g. to open their own clients)
+def run_backfill(export, windows, processes=1, initializer=None):
+    jobs = [(export, window) for window in windows]
+    results = []
+    if processes == 1:
+        for job in jobs:
+            results.append(report(run_window(job)))
+    else:
+        pool = Pool(processes, initializer)
+        try:
+            for result in pool.imap_unordered(run_window, jobs):
+                results.append(report(result))
+        finally:
+            pool.close()
+            pool.join()
+    results.sort(key=lambda result: result[0], reverse=True)
+    return results
+
+# Prints one progress line for a finished window
+def report(result):
+    (starttime, endtime), stats, error = result
+    if error is None:
+        print('{} ok     {records} records, {bytes} bytes'.format(
+            starttime.strftime('%Y_%m_%d'), **stats))
+    else:
+        print('{} FAILED {}'.format(
+            starttime.strftime('%Y_%m_%d'), error.strip().splitlines()[-1]))
+    return result
+
+# Prints the per day outcome of a backfill and returns the failed windows
+def summarize(results):
+    failed = [window for window, stats, error in results if error is not None]
+    records = sum(stats['records'] for window, stats, error in results
+        if error is None)
+    print('Backfill: {} succeeded, {} failed, {} records'.format(
+        len(results) - len(failed), len(failed), records))
+    for starttime, endtime in failed:
+        print('  failed: {}'.format(starttime.strftime('%Y_%m_%d')))
+    for window, stats, error in results:
+        if error is not None:
+            print(error)
+    return failed
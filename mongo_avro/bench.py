@@ -0,0 +1,261 @@
+'''Repeatable benchmark of the export stages over synthetic psPreds data.
+
+Documents from mongo_avro.synthetic are loaded into a local mongod, or into
+the in-process MemoryCollection when no --mongo-uri is given, and each stage
+of a feature export is timed on its own: feature key inference and schema
+build, symbol normalization, the Mongo fetch, field plan layout with avro
+encoding, and the sink write. Every stage reports records/s and MB/s, and
+the whole run is saved as JSON so a later run can be compared against it
+with --baseline.
+
+    python -m mongo_avro.bench --features 2000 --documents 20000
+'''
+import json
+from argparse import ArgumentParser
+from datetime import datetime
+from io import BytesIO
+from os import (
+    fsync,
+    makedirs,
+    path,
+    remove)
+from platform import python_version
+from tempfile import mkstemp
+from time import process_time
+from timeit import default_timer
+
+import fastavro
+from bson import BSON
+from fastavro import writer
+
+from mongo_avro.codecs import CODECS, SYNC_INTERVAL
+from mongo_avro.inference import feature_keys
+from mongo_avro.metrics import BATCH_SIZE
+from mongo_avro.rawbson import RAW_CODEC_OPTIONS
+from mongo_avro.symbols import rename_duplicates, to_symbol
+from mongo_avro.synthetic import (
+    MODEL,
+    MemoryCollection,
+    feature_names,
+    generate_predictions)
+from mongo_avro.timestamps import EpochConverter, TIMESTAMP_MILLIS, logical_unit
+from mongo_avro.vector import LAYOUTS, choose_layout
+
+RESULTS_DIRECTORY = 'bench_results'
+PROJECTION = {'WCT':1,'VISIT_NUMBER':1,'features':1,'_id':1}
+METADATA = (
+    ('WCT', EpochConverter('WCT', logical_unit(TIMESTAMP_MILLIS))),
+    ('VISIT_NUMBER', lambda prediction: prediction['VISIT_NUMBER']))
+# Documents inserted per round trip when loading a mongod
+LOAD_CHUNK_SIZE = 1000
+
+
+class Measurement(object):
+    '''Wall and CPU time of one stage and the records and bytes it
+    handled.'''
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.records = 0
+        self.bytes = 0
+
+    def __enter__(self):
+        self._wall = default_timer()
+        self._cpu = process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds += default_timer() - self._wall
+        self.cpu_seconds += process_time() - self._cpu
+
+    def as_dict(self):
+        seconds = self.seconds or float('nan')
+        return {
+            'seconds': self.seconds,
+            'cpu_seconds': self.cpu_seconds,
+            'records': self.records,
+            'bytes': self.bytes,
+            'records_per_second': self.records / seconds,
+            'mb_per_second': self.bytes / seconds / (1 << 20)}
+
+
+# Returns the synthetic collection, in a mongod at mongo_uri (replacing the
+# database's preds collection) or in process
+def load_collection(documents, mongo_uri=None, database='psPredsBench'):
+    if mongo_uri is None:
+        return MemoryCollection(documents)
+    from pymongo import MongoClient
+    collection = MongoClient(mongo_uri)[database]['preds']
+    collection.drop()
+    chunk = []
+    for document in documents:
+        chunk.append(document)
+        if len(chunk) >= LOAD_CHUNK_SIZE:
+            collection.insert_many(chunk)
+            chunk = []
+    if chunk:
+        collection.insert_many(chunk)
+    return collection
+
+# Returns the avro schema of the feature fields named by symbols
+def build_schema(symbols):
+    fields = [{'name': symbol, 'type': ['float', 'null']}
+        for symbol in symbols.values()]
+    fields.append({'name': 'WCT', 'type': [TIMESTAMP_MILLIS, 'null']})
+    fields.append({'name': 'VISIT_NUMBER', 'type': ['int', 'null']})
+    return {'type': 'record', 'name': 'Transform', 'fields': fields}
+
+# Runs every stage once, returning their Measurements by name
+def run_stages(collection, sample_size=None, raw=True, codec='null',
+        sync_interval=SYNC_INTERVAL, directory='.', layout='flat'):
+    stages = {}
+    query = {'modelName': MODEL}
+
+    with Measurement('schema') as stage:
+        keys = feature_keys(collection, query, sample_size)
+        stage.records = len(keys)
+    stages[stage.name] = stage
+
+    to_symbol.cache_clear()
+    with Measurement('symbols') as stage:
+        symbols = rename_duplicates(
+            dict((key, to_symbol(key)) for key in keys))
+        schema = build_schema(symbols)
+        stage.records = len(symbols)
+    stages[stage.name] = stage
+
+    if raw:
+        collection = collection.with_options(codec_options=RAW_CODEC_OPTIONS)
+    with Measurement('fetch') as stage:
+        documents = list(collection.find(query, PROJECTION)
+            .batch_size(BATCH_SIZE))
+        stage.records = len(documents)
+    stage.bytes = sum(len(getattr(document, 'raw', None) or
+        BSON.encode(document)) for document in documents)
+    stages[stage.name] = stage
+
+    out = BytesIO()
+    with Measurement('encode') as stage:
+        plan, fetched = choose_layout(schema, METADATA, symbols, layout,
+            documents)
+        writer(out, plan.schema, plan.rows(fetched, BATCH_SIZE),
+            codec=codec, sync_interval=sync_interval,
+            metadata=plan.file_metadata)
+        stage.records = len(documents)
+        stage.bytes = out.tell()
+    stages[stage.name] = stage
+
+    handle, file_name = mkstemp(suffix='.avro', dir=directory)
+    try:
+        with Measurement('write') as stage:
+            with open(handle, 'wb') as sink:
+                sink.write(out.getvalue())
+                sink.flush()
+                fsync(sink.fileno())
+            stage.records = len(documents)
+            stage.bytes = len(out.getvalue())
+        stages[stage.name] = stage
+    finally:
+        remove(file_name)
+    return stages
+
+# Runs the stages repeat times and keeps each stage's fastest run
+def benchmark(collection, repeat=3, **options):
+    best = {}
+    for run in range(repeat):
+        for name, stage in run_stages(collection, **options).items():
+            if name not in best or stage.seconds < best[name].seconds:
+                best[name] = stage
+    return best
+
+# Prints each stage, with its change in records/s against baseline results
+def print_results(results, baseline=None):
+    print('{:<8} {:>10} {:>10} {:>14} {:>10} {:>9}'.format(
+        'stage', 'seconds', 'cpu s', 'records/s', 'MB/s', 'vs base'))
+    for name, stage in results['stages'].items():
+        change = ''
+        before = ((baseline or {}).get('stages') or {}).get(name)
+        if before and before['records_per_second']:
+            change = '{:+.1%}'.format(stage['records_per_second'] /
+                before['records_per_second'] - 1)
+        print('{:<8} {:>10.3f} {:>10.3f} {:>14.0f} {:>10.2f} {:>9}'.format(
+            name, stage['seconds'], stage['cpu_seconds'],
+            stage['records_per_second'], stage['mb_per_second'], change))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--features', type=int, default=1000,
+        help='distinct feature keys')
+    parser.add_argument('--documents', type=int, default=10000,
+        help='prediction documents')
+    parser.add_argument('--density', type=float, default=0.8,
+        help='fraction of the feature keys each document carries')
+    parser.add_argument('--messiness', type=float, default=0.5,
+        help='fraction of feature keys with units, >>> values and +++ '
+             'derivations')
+    parser.add_argument('--nesting', type=int, default=2,
+        help='result keys down to the prediction values, 2 as in psPreds')
+    parser.add_argument('--sample-size', type=int,
+        help='documents sampled when inferring the feature keys')
+    parser.add_argument('--decoded', action='store_true',
+        help='fetch fully decoded documents instead of raw BSON')
+    parser.add_argument('--layout', default='flat', choices=LAYOUTS,
+        help='feature layout of the encoded records')
+    parser.add_argument('--codec', default='null', choices=CODECS,
+        help='avro block compression codec')
+    parser.add_argument('--sync-interval', type=int, default=SYNC_INTERVAL,
+        help='uncompressed bytes per avro block')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='runs per stage, the fastest is kept')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mongo-uri',
+        help='load the documents into this mongod (its psPredsBench '
+             'database) instead of an in-process collection')
+    parser.add_argument('--output',
+        help='results file (default {}/<time>.json)'.format(
+            RESULTS_DIRECTORY))
+    parser.add_argument('--baseline',
+        help='earlier results file to compare against')
+    args = parser.parse_args()
+
+    config = dict((key, getattr(args, key)) for key in (
+        'features', 'documents', 'density', 'messiness', 'nesting',
+        'sample_size', 'decoded', 'layout', 'codec', 'sync_interval',
+        'repeat', 'seed'))
+    config['store'] = 'mongod' if args.mongo_uri else 'memory'
+    keys = feature_names(args.features, args.messiness, args.seed)
+    collection = load_collection(
+        generate_predictions(args.documents, keys, args.density,
+            args.nesting, args.seed),
+        args.mongo_uri)
+    stages = benchmark(collection, args.repeat,
+        sample_size=args.sample_size, raw=not args.decoded,
+        codec=args.codec, sync_interval=args.sync_interval,
+        layout=args.layout)
+
+    started = datetime.utcnow()
+    results = {
+        'time': started.isoformat() + 'Z',
+        'config': config,
+        'versions': {
+            'python': python_version(),
+            'fastavro': fastavro.__version__},
+        'stages': dict((name, stages[name].as_dict())
+            for name in ('schema', 'symbols', 'fetch', 'encode', 'write'))}
+    output = args.output or path.join(RESULTS_DIRECTORY,
+        started.strftime('%Y%m%dT%H%M%S') + '.json')
+    directory = path.dirname(output)
+    if directory and not path.exists(directory):
+        makedirs(directory)
+    with open(output, 'w') as out:
+        json.dump(results, out, indent=2, sort_keys=True)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_results(results, baseline)
+    print('Saved {}'.format(output))
@@ -0,0 +1,100 @@
+'''Keeps a per model export watermark in a local state file so incremental
+runs only read the slice of psPreds.preds that was not exported yet.
+
+A watermark is the end of the last committed partition plus the largest
+(WCT, _id) exported in it; _id breaks ties between documents sharing a WCT.
+It is only advanced after a partition's file has been fully written.
+'''
+from datetime import timedelta
+from functools import partial
+from os import (
+    getpid,
+    makedirs,
+    path,
+    rename)
+
+from bson import json_util
+
+from mongo_avro.backfill import report, run_window
+
+# Watermarks come back naive like the endtimes they are compared with,
+# whatever the driver's default
+JSON_OPTIONS = json_util.JSONOptions(tz_aware=False)
+
+
+class Checkpoint(object):
+
+    def __init__(self, file_name='.export_state.json'):
+        self.file_name = file_name
+        self.state = {}
+        if path.exists(file_name):
+            with open(file_name) as state_file:
+                self.state = json_util.loads(state_file.read(),
+                    json_options=JSON_OPTIONS)
+
+    # Returns {'endtime', 'WCT', '_id'} for model, or None before its first
+    # committed partition
+    def get(self, model):
+        return self.state.get(model)
+
+    # Records a committed partition and persists the state file atomically
+    def commit(self, model, endtime, last=None):
+        mark = dict(self.state.get(model) or {})
+        mark['endtime'] = endtime
+        if last is not None:
+            mark['WCT'], mark['_id'] = last
+        self.state[model] = mark
+        directory = path.dirname(self.file_name)
+        if directory and not path.exists(directory):
+            makedirs(directory)
+        temporary = '{}.{}.tmp'.format(self.file_name, getpid())
+        with open(temporary, 'w') as out:
+            out.write(json_util.dumps(self.state, indent=2, sort_keys=True,
+                json_options=JSON_OPTIONS))
+        rename(temporary, self.file_name)
+
+
+# Query clause selecting documents after the watermark's (WCT, _id)
+def after_watermark(mark):
+    if not mark or 'WCT' not in mark:
+        return {}
+    return {'$or': [
+        {'WCT': {'$gt': mark['WCT']}},
+        {'WCT': mark['WCT'], '_id': {'$gt': mark['_id']}}]}
+
+# Passes predictions through while keeping the largest (WCT, _id) seen in
+# stats['last']
+def track_watermark(predictions, stats):
+    last = stats.get('last')
+    for prediction in predictions:
+        current = (prediction['WCT'], prediction['_id'])
+        if last is None or current > last:
+            last = stats['last'] = current
+        yield prediction
+
+# Yields (starttime, endtime) windows of span days moving forward in time
+def forward_windows(starttime, endtime, span=1):
+    while starttime < endtime:
+        yield starttime, min(endtime, starttime + timedelta(span))
+        starttime = starttime + timedelta(span)
+
+# Exports every window from the model's watermark (or starttime on the first
+# run) up to endtime in order, committing the watermark after each one and
+# stopping at the first failure so no partition is ever skipped. export is
+# called as export(starttime, endtime, after=watermark) and must return stats
+# carrying the 'last' (WCT, _id) it wrote.
+def run_incremental(checkpoint, model, export, starttime, endtime, span=1):
+    mark = checkpoint.get(model)
+    if mark is not None:
+        starttime = mark['endtime']
+    results = []
+    for window in forward_windows(starttime, endtime, span):
+        result = report(run_window((partial(export, after=mark), window)))
+        results.append(result)
+        (window_start, window_end), stats, error = result
+        if error is not None:
+            break
+        checkpoint.commit(model, window_end, stats.get('last'))
+        mark = checkpoint.get(model)
+    results.sort(key=lambda result: result[0], reverse=True)
+    return results
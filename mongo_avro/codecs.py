@@ -0,0 +1,69 @@
+'''Avro codec and block size settings shared by the exporters, and a small
+benchmark to pick them from a sample partition rather than by guessing.
+
+Feature transform records are hundreds of mostly repeating floats, so the
+codec and the sync interval (the uncompressed bytes gathered into each
+compressed block) make a large difference to what ships over WebHDFS.
+snappy and zstandard need python-snappy and zstandard installed.
+'''
+from io import BytesIO
+from timeit import default_timer
+
+from fastavro import reader, writer
+
+CODECS = ('null', 'deflate', 'snappy', 'zstandard')
+# fastavro's default block size in bytes
+SYNC_INTERVAL = 16000
+
+
+# Returns the codec and sync_interval writer options set by AVRO_CODEC and
+# AVRO_SYNC_INTERVAL in environ
+def avro_options(environ):
+    return {
+        'codec': environ.get('AVRO_CODEC', 'null'),
+        'sync_interval': int(
+            environ.get('AVRO_SYNC_INTERVAL', SYNC_INTERVAL))}
+
+# Writes records in memory with each codec, returning a list of
+# {'codec', 'bytes', 'encode', 'decode'} with times in seconds, or an 'error'
+# for codecs that are not installed
+def benchmark_codecs(schema, records, codecs=CODECS,
+        sync_interval=SYNC_INTERVAL):
+    records = list(records)
+    results = []
+    for codec in codecs:
+        result = {'codec': codec}
+        out = BytesIO()
+        try:
+            start = default_timer()
+            writer(out, schema, records, codec=codec,
+                sync_interval=sync_interval)
+            result['encode'] = default_timer() - start
+        except ValueError as error:
+            result['error'] = str(error)
+            results.append(result)
+            continue
+        result['bytes'] = out.tell()
+        out.seek(0)
+        start = default_timer()
+        for record in reader(out):
+            pass
+        result['decode'] = default_timer() - start
+        results.append(result)
+    return results
+
+# Prints benchmark results as a table, relative to the first codec's size
+def print_benchmark(results, records):
+    print('{} records'.format(records))
+    print('{:<10} {:>14} {:>7} {:>10} {:>10}'.format(
+        'codec', 'bytes', 'ratio', 'encode s', 'decode s'))
+    baseline = None
+    for result in results:
+        if 'error' in result:
+            print('{:<10} {}'.format(result['codec'], result['error']))
+            continue
+        baseline = baseline or result['bytes']
+        print('{:<10} {:>14} {:>7.2f} {:>10.3f} {:>10.3f}'.format(
+            result['codec'], result['bytes'],
+            float(result['bytes']) / baseline,
+            result['encode'], result['decode']))
@@ -0,0 +1,464 @@
+'''The export engine the fastavro_mongo scripts are configurations of.
+
+An Exporter reads a window of documents from a Source (query and
+projection), turns them into avro records with a Transform (features laid
+out through a field plan, or reshaped predictions) and writes them through a
+Sink (local files, HDFS files or parts, or parquet).
+
+Mongo and HDFS clients are opened on first use through the shared
+connections and then reused by every partition and job in the process, so a
+script that only writes locally never touches HDFS and configuring a job
+costs nothing until it runs. A forked worker notices it is in a new process
+and opens its own clients. hdfs is only imported by the HDFS sink.
+'''
+from os import (
+    close,
+    environ,
+    getpid,
+    makedirs,
+    path,
+    remove)
+from tempfile import mkstemp
+
+from fastavro import writer
+from yaml import safe_load as yaml_load
+
+from mongo_avro.checkpoint import after_watermark, track_watermark
+from mongo_avro.metrics import BATCH_SIZE, Metrics
+from mongo_avro.pipeline import Pipeline
+from mongo_avro.plan import plan_for
+from mongo_avro.rawbson import RAW_CODEC_OPTIONS
+from mongo_avro.rolling import HDFS_BLOCK_SIZE, RollingAvroWriter
+
+# MONGO_HOST points the export at another server, e.g. a local mongod for
+# testing, which is used without authentication when there are no creds
+MONGO_HOST = environ.get('MONGO_HOST', 'uphsvlndc058.uphs.upenn.edu')
+MONGO_PORT = 27017
+CREDS_FILE = 'mongo_creds.yml'
+HDFS_URL = 'http://localhost:14000'
+HDFS_USER = 'cloudera'
+# Feature keys missing from the schema named in a window's log line
+UNKNOWN_KEYS_LOGGED = 20
+
+
+class Connections(object):
+    '''Mongo and HDFS clients opened on first use and shared by everything in
+    the process.'''
+
+    def __init__(self, mongo_host=MONGO_HOST, mongo_port=MONGO_PORT,
+            creds_file=CREDS_FILE, hdfs_url=HDFS_URL, hdfs_user=HDFS_USER):
+        self.mongo_host = mongo_host
+        self.mongo_port = mongo_port
+        self.creds_file = creds_file
+        self.hdfs_url = hdfs_url
+        self.hdfs_user = hdfs_user
+        self.reset()
+
+    # Credentials from creds_file, None when there is none
+    @property
+    def creds(self):
+        if not path.exists(self.creds_file):
+            return None
+        with open(self.creds_file) as credsfile:
+            return yaml_load(credsfile)
+
+    def mongo(self):
+        self._check_process()
+        if self._mongo is None:
+            from pymongo import MongoClient
+            creds = self.creds or {}
+            self._mongo = MongoClient(host=self.mongo_host,
+                port=self.mongo_port, username=creds.get('user'),
+                password=creds.get('pass'))
+        return self._mongo
+
+    # Collection named '<database>.<collection>'
+    def collection(self, name):
+        database, collection = name.split('.', 1)
+        return self.mongo()[database][collection]
+
+    # New async client, on pymongo's AsyncMongoClient or Motor with older
+    # drivers; it belongs to the running event loop so it is not shared
+    def open_async_mongo(self):
+        try:
+            from pymongo import AsyncMongoClient
+        except ImportError:
+            from motor.motor_asyncio import (
+                AsyncIOMotorClient as AsyncMongoClient)
+        creds = self.creds or {}
+        return AsyncMongoClient(host=self.mongo_host, port=self.mongo_port,
+            username=creds.get('user'), password=creds.get('pass'))
+
+    def hdfs(self):
+        self._check_process()
+        if self._hdfs is None:
+            from hdfs import InsecureClient
+            from mongo_avro.upload import pooled_session
+            self._hdfs = InsecureClient(self.hdfs_url, user=self.hdfs_user,
+                session=pooled_session())
+        return self._hdfs
+
+    # Forgets the clients so the next use opens new ones
+    def reset(self):
+        self._mongo = None
+        self._hdfs = None
+        self._pid = getpid()
+
+    # Clients are not fork safe, so a forked worker opens its own
+    def _check_process(self):
+        if self._pid != getpid():
+            self.reset()
+
+connections = Connections()
+
+
+class Source(object):
+    '''Selects the documents matching query in a WCT window of collection,
+    projected to projection. pipeline(query, limit), when given, returns an
+    aggregation run instead of find. raw reads them as RawBSONDocuments.'''
+
+    def __init__(self, query, projection, collection='psPreds.preds',
+            pipeline=None, raw=False, start='$gte', connections=connections):
+        self.base_query = query
+        self.projection = projection
+        self.collection_name = collection
+        self.pipeline = pipeline
+        self.raw = raw
+        self.start = start
+        self.connections = connections
+
+    def collection(self):
+        collection = self.connections.collection(self.collection_name)
+        if self.raw:
+            collection = collection.with_options(
+                codec_options=RAW_CODEC_OPTIONS)
+        return collection
+
+    # Query selecting the window past the after watermark
+    def query(self, starttime, endtime, after=None):
+        q = dict(self.base_query)
+        q['WCT'] = {self.start: starttime, '$lt': endtime}
+        q.update(after_watermark(after))
+        return q
+
+    def find(self, starttime, endtime, limit=None, after=None,
+            batch_size=BATCH_SIZE):
+        return self.find_query(
+            self.query(starttime, endtime, after), limit, batch_size)
+
+    def find_query(self, q, limit=None, batch_size=BATCH_SIZE):
+        if self.pipeline is not None:
+            return self.collection().aggregate(
+                self.pipeline(q, limit), batchSize=batch_size)
+        r = self.collection().find(q, self.projection).batch_size(batch_size)
+        return r if limit is None else r.limit(limit)
+
+
+class FeatureTransform(object):
+    '''Lays feature documents out through the field plan of a schema built
+    from their sampled feature keys and cached by schema_cache. build(keys)
+    returns (schema, keys mapping feature keys to field names or None).
+    layout 'vector' or 'packed' writes the features as one vector per record
+    instead of a field each, 'sparse' only the ones a record has and 'auto'
+    sparse or vector records by each window's density, never flat fields
+    (see mongo_avro.vector).'''
+
+    def __init__(self, schema_cache, model, sample_keys, build, metadata,
+            overrides=None, layout='flat'):
+        self.schema_cache = schema_cache
+        self.model = model
+        self.sample_keys = sample_keys
+        self.build = build
+        self.metadata = metadata
+        self.overrides = overrides
+        self.layout = layout
+        self._plan = None
+
+    # Returns (schema, feature keys to field names)
+    def load(self, window=None):
+        return self.schema_cache.load(
+            self.model,
+            lambda: self.sample_keys(window),
+            self.build,
+            self.overrides)
+
+    def schema(self, window=None):
+        return self.load(window)[0]
+
+    # Returns (field plan or feature layout, documents); the 'auto' layout
+    # is picked by laying out the first of the documents
+    def plan(self, documents=()):
+        schema, keys = self.load()
+        if self.layout == 'flat':
+            return plan_for(schema, self.metadata, keys), documents
+        from mongo_avro.vector import choose_layout
+        return choose_layout(schema, self.metadata, keys, self.layout,
+            documents)
+
+    # Returns the (schema, records, avro file metadata) documents are
+    # written as
+    def prepare(self, documents):
+        plan, documents = self.plan(documents)
+        plan.unknown.clear()
+        self._plan = plan
+        return (plan.schema, plan.rows(documents, BATCH_SIZE),
+            plan.file_metadata)
+
+    # Feature keys the documents last prepared had and the schema lacks,
+    # complete once their records have been written
+    def unknown(self):
+        return set() if self._plan is None else set(self._plan.unknown)
+
+
+class PredictionTransform(object):
+    '''Reshapes prediction documents with to_record into a fixed schema.'''
+
+    def __init__(self, schema, to_record):
+        self._schema = schema
+        self.to_record = to_record
+
+    def schema(self, window=None):
+        return self._schema
+
+    def records(self, documents):
+        to_record = self.to_record
+        for document in documents:
+            yield to_record(document)
+
+    def prepare(self, documents):
+        return self._schema, self.records(documents), None
+
+
+class LocalSink(object):
+    '''Writes avro files on the local filesystem.'''
+
+    def __init__(self, **options):
+        self.options = options
+
+    def open(self, file_name):
+        _make_directory(file_name)
+        return open(file_name, 'wb')
+
+    # Writes records to file_name, with metadata in its header, handing the
+    # encoded blocks to pipeline's writer thread when there is one
+    def write(self, file_name, schema, records, pipeline=None,
+            metadata=None):
+        stats = {'records': 0, 'bytes': 0}
+        with self.open(file_name) as out:
+            if pipeline is not None:
+                with pipeline.sink(out) as staged:
+                    writer(staged, schema, _counted(records, stats),
+                        metadata=metadata, **self.options)
+            else:
+                writer(out, schema, _counted(records, stats),
+                    metadata=metadata, **self.options)
+            stats['bytes'] = out.tell()
+        return stats
+
+
+class ParquetFileSink(object):
+    '''Writes parquet files with the avro schema's columns on the local
+    filesystem. pyarrow is only imported when a file is written.'''
+
+    def __init__(self, **options):
+        self.options = options
+
+    def write(self, file_name, schema, records, pipeline=None,
+            metadata=None):
+        from mongo_avro.parquet import ParquetSink
+        _make_directory(file_name)
+        stats = {'records': 0, 'bytes': 0}
+        with ParquetSink(file_name, schema, metadata=metadata,
+                **self.options) as sink:
+            for record in _counted(records, stats):
+                sink.write(record)
+        stats['bytes'] = path.getsize(file_name)
+        return stats
+
+
+class HdfsSink(object):
+    '''Streams avro files to HDFS through the shared client.'''
+
+    def __init__(self, connections=connections, **options):
+        self.connections = connections
+        self.options = options
+
+    def open(self, file_name):
+        return self.connections.hdfs().write(file_name, overwrite=True)
+
+    # Writes records to file_name, with metadata in its header, through
+    # AvroWriter or, when there is a pipeline, hands the encoded blocks to
+    # its writer thread
+    def write(self, file_name, schema, records, pipeline=None,
+            metadata=None):
+        stats = {'records': 0, 'bytes': 0}
+        if pipeline is not None:
+            with self.open(file_name) as out:
+                with pipeline.sink(out) as staged:
+                    writer(staged, schema, _counted(records, stats),
+                        metadata=metadata, **self.options)
+        else:
+            from hdfs.ext.avro import AvroWriter
+            with AvroWriter(self.connections.hdfs(), file_name,
+                    schema=schema, overwrite=True, metadata=metadata,
+                    **self.options) as avro_writer:
+                for record in _counted(records, stats):
+                    avro_writer.write(record)
+        stats['bytes'] = self.size(file_name)
+        return stats
+
+    def size(self, file_name):
+        return self.connections.hdfs().status(file_name)['length']
+
+    def remove(self, file_name):
+        self.connections.hdfs().delete(file_name)
+
+
+class HdfsPartsSink(object):
+    '''Writes each file as <file_name>_partNNNN.avro parts on HDFS holding
+    at most max_bytes or max_records each, plus a manifest listing them, so
+    file_name is a base name without extension. Parts are streamed to HDFS,
+    where a part cut short by an error is removed, or with uploads staged
+    locally and uploaded that many at a time, each retried up to retries
+    times, and the manifest is written once they all succeeded.'''
+
+    def __init__(self, connections=connections, max_bytes=HDFS_BLOCK_SIZE,
+            max_records=None, uploads=None, retries=None, **options):
+        self.connections = connections
+        self.max_bytes = max_bytes
+        self.max_records = max_records
+        self.uploads = uploads
+        self.retries = retries
+        self.options = options
+
+    def write(self, file_name, schema, records, pipeline=None,
+            metadata=None):
+        hdfs = HdfsSink(self.connections)
+        if not self.uploads:
+            return self._write_parts(hdfs.open, hdfs.remove, file_name,
+                schema, records, metadata).stats
+        from mongo_avro.upload import RETRIES, Uploader
+        retries = RETRIES if self.retries is None else self.retries
+        with Uploader(self.connections.hdfs(), self.uploads,
+                retries) as uploader:
+            writer = self._write_parts(uploader.open_staged, None, file_name,
+                schema, records, metadata, manifest=False)
+        # Only listed once every part is on HDFS
+        writer.write_manifest(hdfs.open)
+        return writer.stats
+
+    def _write_parts(self, open_file, remove_file, base_name, schema,
+            records, metadata, manifest=True):
+        with RollingAvroWriter(open_file, base_name, schema, self.max_bytes,
+                self.max_records, metadata=metadata,
+                remove_file=remove_file, manifest=manifest,
+                **self.options) as writer:
+            for record in records:
+                writer.write(record)
+        return writer
+
+
+class HdfsParquetSink(object):
+    '''Writes parquet files with the avro schema's columns to HDFS. The
+    parquet writer needs a file it can seek and close, which the HDFS
+    client's streaming writer is not, so each file is written to a local
+    temporary file in directory and then uploaded.'''
+
+    def __init__(self, connections=connections, directory=None, **options):
+        self.connections = connections
+        self.directory = directory
+        self.options = options
+
+    def write(self, file_name, schema, records, pipeline=None,
+            metadata=None):
+        from mongo_avro.parquet import ParquetSink
+        stats = {'records': 0, 'bytes': 0}
+        handle, local_path = mkstemp(suffix='.parquet', dir=self.directory)
+        close(handle)
+        try:
+            with ParquetSink(local_path, schema, metadata=metadata,
+                    **self.options) as sink:
+                for record in _counted(records, stats):
+                    sink.write(record)
+            stats['bytes'] = path.getsize(local_path)
+            with open(local_path, 'rb') as data:
+                self.connections.hdfs().write(file_name, data,
+                    overwrite=True)
+        finally:
+            remove(local_path)
+        return stats
+
+
+# Returns the HDFS sink a partition is written through and the extension of
+# its file name: a parquet file given parquet (ParquetSink options),
+# _partNNNN.avro parts and a manifest given parts (max_bytes/max_records) or
+# uploads, otherwise one avro file. avro holds the avro writer options.
+def hdfs_sink(avro, parts=None, uploads=None, retries=None, parquet=None,
+        connections=connections):
+    if parquet is not None:
+        return HdfsParquetSink(connections, **parquet), '.parquet'
+    if uploads or parts is not None:
+        return HdfsPartsSink(connections, uploads=uploads, retries=retries,
+            **dict(avro, **(parts or {}))), ''
+    return HdfsSink(connections, **avro), '.avro'
+
+
+class Exporter(object):
+    '''Exports windows of source through transform into sink, naming each
+    window's file with name_for(starttime, endtime). A pipeline_depth
+    overlaps the fetch, encoding and writes of a window through a Pipeline
+    that deep.'''
+
+    def __init__(self, source, transform, sink, name_for, pipeline_depth=0):
+        self.source = source
+        self.transform = transform
+        self.sink = sink
+        self.name_for = name_for
+        self.pipeline_depth = pipeline_depth
+
+    # Exports one window, returning the records and bytes written, the
+    # 'last' (WCT, _id) watermark when documents carry _id, the fetch and
+    # window stage 'metrics' and, for feature transforms, the
+    # 'unknown_keys' the schema dropped, which are also logged. query, when given, is read instead of the
+    # window's own query, e.g. one sub-range of it.
+    def export(self, starttime, endtime, limit=None, after=None, query=None):
+        mark = {}
+        metrics = Metrics()
+        with metrics.measure('window') as window:
+            if query is None:
+                query = self.source.query(starttime, endtime, after)
+            documents = metrics.fetch(self.source.find_query(query, limit))
+            if self.source.projection.get('_id', 1):
+                documents = track_watermark(documents, mark)
+            pipeline = None
+            if self.pipeline_depth:
+                pipeline = Pipeline(self.pipeline_depth, BATCH_SIZE)
+                documents = pipeline.fetch(documents)
+            schema, records, file_metadata = self.transform.prepare(
+                documents)
+            stats = self.sink.write(self.name_for(starttime, endtime),
+                schema, records, pipeline, file_metadata)
+            if pipeline is not None:
+                pipeline.report(metrics)
+        window.records = stats['records']
+        window.bytes_written = stats['bytes']
+        stats.update(mark, metrics=metrics.state())
+        unknown = getattr(self.transform, 'unknown', None)
+        if unknown is not None:
+            stats['unknown_keys'] = sorted(unknown())
+            if stats['unknown_keys']:
+                metrics.log('unknown_keys', starttime=str(starttime),
+                    endtime=str(endtime), count=len(stats['unknown_keys']),
+                    keys=stats['unknown_keys'][:UNKNOWN_KEYS_LOGGED])
+        return stats
+
+
+def _make_directory(file_name):
+    directory = path.dirname(file_name)
+    if directory and not path.exists(directory):
+        makedirs(directory)
+
+def _counted(records, stats):
+    for record in records:
+        stats['records'] += 1
+        yield record
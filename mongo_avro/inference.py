@@ -0,0 +1,37 @@
+'''Infers the feature key set of a model with a server side aggregation, so
+the full union of keys over many documents costs one small response rather
+than pulling whole documents to the client.
+'''
+from collections import OrderedDict
+
+# BSON $type names that float() turns into an avro float
+NUMERIC_TYPES = frozenset(
+    ('double', 'int', 'long', 'decimal', 'bool', 'null'))
+
+
+# Returns an ordered {feature key: set of observed BSON type names} over the
+# documents matching query, or over a random sample of sample_size of them
+def feature_key_types(collection, query, sample_size=None):
+    pipeline = [{'$match': query}]
+    if sample_size:
+        pipeline.append({'$sample': {'size': sample_size}})
+    pipeline.extend([
+        {'$project': {'_id': 0, 'features': {'$objectToArray': '$features'}}},
+        {'$unwind': '$features'},
+        {'$group': {
+            '_id': '$features.k',
+            'types': {'$addToSet': {'$type': '$features.v'}}}},
+        {'$sort': {'_id': 1}}])
+    return OrderedDict(
+        (result['_id'], set(result['types']))
+        for result in collection.aggregate(pipeline, allowDiskUse=True))
+
+# Returns the sorted feature keys, refusing keys that cannot be written as
+# avro floats
+def feature_keys(collection, query, sample_size=None):
+    key_types = feature_key_types(collection, query, sample_size)
+    for key, types in key_types.items():
+        if not types <= NUMERIC_TYPES:
+            raise TypeError('feature \'%s\' has non numeric values of type %s'
+                % (key, ', '.join(sorted(types - NUMERIC_TYPES))))
+    return list(key_types)
@@ -0,0 +1,290 @@
+'''Per stage metrics of an export job, replacing the print only timer()s.
+
+Each stage keeps its wall and CPU seconds, the documents fetched and, when
+they were read as raw BSON, bytes read from Mongo, the records and bytes written, and the latency of every
+batch (or timed block), from which p50/p99 are reported. A window exported
+in a worker process returns its stages in stats['metrics'] and the job adds
+them up with collect(), so pooled backfills report the same totals as
+sequential ones.
+
+Jobs that run on, like the tail, also set gauges such as their lag, which
+hold the latest value rather than a total.
+
+Every timed block and the final summary are logged as one JSON object per
+line on the mongo_avro.metrics logger. emit() also writes the summary as a
+Prometheus textfile (for node_exporter's textfile collector) and/or a JSON
+file, atomically, when METRICS_TEXTFILE or METRICS_JSON name one.
+'''
+import json
+from contextlib import contextmanager
+from datetime import datetime
+from logging import basicConfig, getLogger
+from os import (
+    getpid,
+    makedirs,
+    path,
+    rename)
+from time import time
+from timeit import default_timer
+try:
+    from time import process_time
+except ImportError:
+    from time import clock as process_time
+
+logger = getLogger('mongo_avro.metrics')
+
+# Documents pulled per cursor round trip while streaming an export, and per
+# fetch batch whose latency is recorded
+BATCH_SIZE = 500
+QUANTILES = (0.5, 0.99)
+PREFIX = 'mongo_avro_'
+
+# Prometheus gauges written per stage: (summary key, name, help)
+GAUGES = (
+    ('seconds', 'stage_seconds', 'Wall seconds spent in the stage'),
+    ('cpu_seconds', 'stage_cpu_seconds', 'CPU seconds spent in the stage'),
+    ('documents', 'stage_documents', 'Mongo documents fetched'),
+    ('bytes_read', 'stage_bytes_read', 'BSON bytes read from Mongo'),
+    ('records', 'stage_records', 'Avro records written'),
+    ('bytes_written', 'stage_bytes_written', 'Bytes written to the sink'),
+    ('records_per_second', 'stage_records_per_second',
+        'Records written per wall second'),
+    ('documents_per_second', 'stage_documents_per_second',
+        'Documents fetched per wall second'))
+
+
+# Nearest rank percentile of sorted values, None when there are none
+def percentile(values, fraction):
+    if not values:
+        return None
+    rank = int(round(fraction * (len(values) - 1)))
+    return values[rank]
+
+
+class Stage(object):
+    '''Totals of one stage of an export.'''
+
+    COUNTS = ('seconds', 'cpu_seconds', 'documents', 'raw_documents',
+        'bytes_read', 'records', 'bytes_written')
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.documents = 0
+        self.raw_documents = 0
+        self.bytes_read = 0
+        self.records = 0
+        self.bytes_written = 0
+        self.latencies = []
+
+    # Raw totals and latencies, for adding up across processes
+    def state(self):
+        state = dict((count, getattr(self, count)) for count in self.COUNTS)
+        state['latencies'] = list(self.latencies)
+        return state
+
+    def merge(self, state):
+        for count in self.COUNTS:
+            setattr(self, count, getattr(self, count) + state.get(count, 0))
+        self.latencies.extend(state.get('latencies', ()))
+
+    def summary(self):
+        summary = dict((count, getattr(self, count)) for count in self.COUNTS)
+        if self.raw_documents < self.documents:
+            # Decoded documents no longer tell their BSON size
+            summary['bytes_read'] = None
+        seconds = self.seconds
+        summary['records_per_second'] = (
+            self.records / seconds if seconds else 0.0)
+        summary['documents_per_second'] = (
+            self.documents / seconds if seconds else 0.0)
+        latencies = sorted(self.latencies)
+        summary['batches'] = len(latencies)
+        for quantile in QUANTILES:
+            summary['p{:g}_seconds'.format(quantile * 100)] = percentile(
+                latencies, quantile)
+        return summary
+
+
+class Metrics(object):
+    '''Stages of one export job. textfile and json_file, when given, are
+    where emit() writes the summary.'''
+
+    def __init__(self, job='export', textfile=None, json_file=None):
+        self.job = job
+        self.textfile = textfile
+        self.json_file = json_file
+        self.stages = {}
+        self.gauges = {}
+        self.started = datetime.utcnow()
+
+    def stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = Stage(name)
+        return self.stages[name]
+
+    # Sets gauge name, e.g. 'tail_lag_seconds', to its latest value
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    # Times the block into stage name, recording it as one latency
+    @contextmanager
+    def measure(self, name):
+        stage = self.stage(name)
+        wall, cpu = default_timer(), process_time()
+        try:
+            yield stage
+        finally:
+            elapsed = default_timer() - wall
+            stage.seconds += elapsed
+            stage.cpu_seconds += process_time() - cpu
+            stage.latencies.append(elapsed)
+
+    # measure() for a labelled block of a script, e.g. 'Export:', printing
+    # its wall and CPU time and logging it
+    @contextmanager
+    def timer(self, label):
+        name = label.rstrip(':').strip().lower()
+        wall, cpu = default_timer(), process_time()
+        with self.measure(name):
+            yield
+        wall, cpu = default_timer() - wall, process_time() - cpu
+        print('{} {:.3f}s wall {:.3f}s cpu'.format(label, wall, cpu))
+        self.log('timer', stage=name, seconds=wall, cpu_seconds=cpu)
+
+    # Iterates documents, counting them and the BSON bytes of those read as
+    # raw BSON into the fetch stage and timing each batch_size documents the
+    # cursor hands over. Decoded documents are not re-encoded to size them,
+    # so a stage fetching them reports no bytes_read.
+    def fetch(self, documents, name='fetch', batch_size=BATCH_SIZE):
+        stage = self.stage(name)
+        documents = iter(documents)
+        batch = count = raw = size = 0
+        cpu = 0.0
+        while True:
+            wall, started = default_timer(), process_time()
+            try:
+                document = next(documents)
+            except StopIteration:
+                document = None
+            batch += default_timer() - wall
+            cpu += process_time() - started
+            if document is None:
+                self._batch(stage, batch, count, raw, size, cpu)
+                return
+            count += 1
+            data = getattr(document, 'raw', None)
+            if data is not None:
+                raw += 1
+                size += len(data)
+            if count == batch_size:
+                self._batch(stage, batch, count, raw, size, cpu)
+                batch = count = raw = size = 0
+                cpu = 0.0
+            yield document
+
+    def _batch(self, stage, elapsed, count, raw, size, cpu):
+        stage.seconds += elapsed
+        stage.cpu_seconds += cpu
+        stage.documents += count
+        stage.raw_documents += raw
+        stage.bytes_read += size
+        if count:
+            stage.latencies.append(elapsed)
+
+    # Adds an export's records and bytes to stage name, along with the stages
+    # it measured in stats['metrics'], which is removed
+    def add(self, stats, name='export'):
+        for stage_name, state in (stats.pop('metrics', None) or {}).items():
+            self.stage(stage_name).merge(state)
+        stage = self.stage(name)
+        stage.records += stats.get('records', 0)
+        stage.bytes_written += stats.get('bytes', 0)
+
+    # add()s every successful (window, stats, error) result
+    def collect(self, results, name='export'):
+        for window, stats, error in results:
+            if error is None:
+                self.add(stats, name)
+        return results
+
+    # Raw stage states, for returning from a worker in stats['metrics']
+    def state(self):
+        return dict((name, stage.state())
+            for name, stage in self.stages.items())
+
+    def summary(self):
+        return {
+            'job': self.job,
+            'started': self.started.isoformat() + 'Z',
+            'finished': time(),
+            'stages': dict((name, stage.summary())
+                for name, stage in self.stages.items()),
+            'gauges': dict(self.gauges)}
+
+    def log(self, event, **fields):
+        fields.update(event=event, job=self.job)
+        logger.info(json.dumps(fields, sort_keys=True))
+
+    # Logs the summary and writes the configured textfile and JSON file
+    def emit(self):
+        summary = self.summary()
+        self.log('summary', **summary)
+        if self.textfile:
+            _write_atomic(self.textfile, prometheus_text(summary))
+        if self.json_file:
+            _write_atomic(self.json_file,
+                json.dumps(summary, indent=2, sort_keys=True))
+        return summary
+
+
+# Returns the Metrics of job writing to METRICS_TEXTFILE and METRICS_JSON
+def job_metrics(job, environ):
+    return Metrics(job, environ.get('METRICS_TEXTFILE'),
+        environ.get('METRICS_JSON'))
+
+# Sends the JSON log lines to stderr at LOG_LEVEL (INFO by default)
+def configure_logging(environ):
+    basicConfig(level=environ.get('LOG_LEVEL', 'INFO'), format='%(message)s')
+
+# Renders a summary in the Prometheus text exposition format
+def prometheus_text(summary):
+    job = summary['job']
+    stages = sorted(summary['stages'].items())
+    lines = []
+    for key, name, description in GAUGES:
+        lines.append('# HELP {}{} {}'.format(PREFIX, name, description))
+        lines.append('# TYPE {}{} gauge'.format(PREFIX, name))
+        for stage, values in stages:
+            if values[key] is None:
+                continue
+            lines.append('{}{}{{job="{}",stage="{}"}} {}'.format(
+                PREFIX, name, job, stage, values[key]))
+    name = PREFIX + 'stage_batch_latency_seconds'
+    lines.append('# HELP {} Wall seconds per fetch batch or timed '
+        'block'.format(name))
+    lines.append('# TYPE {} gauge'.format(name))
+    for stage, values in stages:
+        for quantile in QUANTILES:
+            value = values['p{:g}_seconds'.format(quantile * 100)]
+            if value is not None:
+                lines.append('{}{{job="{}",stage="{}",quantile="{:g}"}} {}'
+                    .format(name, job, stage, quantile, value))
+    for gauge, value in sorted(summary.get('gauges', {}).items()):
+        lines.append('# TYPE {}{} gauge'.format(PREFIX, gauge))
+        lines.append('{}{}{{job="{}"}} {}'.format(PREFIX, gauge, job, value))
+    name = PREFIX + 'last_run_timestamp_seconds'
+    lines.append('# HELP {} Epoch seconds the job last finished'.format(name))
+    lines.append('# TYPE {} gauge'.format(name))
+    lines.append('{}{{job="{}"}} {}'.format(name, job, summary['finished']))
+    return '\n'.join(lines) + '\n'
+
+def _write_atomic(file_name, text):
+    directory = path.dirname(file_name)
+    if directory and not path.exists(directory):
+        makedirs(directory)
+    temporary = '{}.{}.tmp'.format(file_name, getpid())
+    with open(temporary, 'w') as out:
+        out.write(text)
+    rename(temporary, file_name)
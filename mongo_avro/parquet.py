@@ -0,0 +1,125 @@
+'''Writes the exporters' rows as Parquet rather than avro.
+
+The avro schema from generate_avro_schema is translated to an Arrow schema,
+rows are gathered into record batches of chunk_size and every row_group_size
+rows are written out as one row group, so Spark can prune the thousands of
+feature columns and push predicates down instead of reading every record
+whole. Needs pyarrow, which is only imported when a Parquet sink is used.
+'''
+# Rows per Parquet row group
+ROW_GROUP_SIZE = 10000
+# Rows turned into an Arrow record batch at a time
+CHUNK_SIZE = 1000
+COMPRESSION = 'snappy'
+
+# pyarrow type factories of the avro primitive types
+ARROW_PRIMITIVES = {
+    'boolean': 'bool_',
+    'int': 'int32',
+    'long': 'int64',
+    'float': 'float32',
+    'double': 'float64',
+    'bytes': 'binary',
+    'string': 'string'}
+
+# Arrow timestamp units of the avro logical types
+ARROW_TIME_UNITS = {
+    'timestamp-millis': 'ms',
+    'timestamp-micros': 'us'}
+
+
+# Returns the (pyarrow type, nullable) an avro field type is stored as
+def arrow_type(avro_type):
+    import pyarrow
+    if isinstance(avro_type, list):
+        branches = [branch for branch in avro_type if branch != 'null']
+        if len(branches) != 1:
+            raise TypeError('cannot store union {!r} in parquet'.format(
+                avro_type))
+        return arrow_type(branches[0])[0], len(branches) < len(avro_type)
+    if isinstance(avro_type, dict):
+        unit = ARROW_TIME_UNITS.get(avro_type.get('logicalType'))
+        if unit is not None:
+            return pyarrow.timestamp(unit), False
+        if avro_type['type'] == 'array':
+            return pyarrow.list_(arrow_type(avro_type['items'])[0]), False
+        return arrow_type(avro_type['type'])
+    if avro_type == 'null':
+        # e.g. input_events of the transform schemas, always null
+        return pyarrow.null(), True
+    return getattr(pyarrow, ARROW_PRIMITIVES[avro_type])(), False
+
+# Translates an avro record schema into an Arrow schema with the same columns
+def arrow_schema(avro_schema):
+    import pyarrow
+    fields = []
+    for field in avro_schema['fields']:
+        field_type, nullable = arrow_type(field['type'])
+        fields.append(pyarrow.field(field['name'], field_type, nullable))
+    return pyarrow.schema(fields)
+
+
+class ParquetSink(object):
+    '''Writer taking the same records as the avro writers and writing them to
+    out, a file name or a seekable binary file (not the streaming writer of
+    hdfs_client.write(), see engine.HdfsParquetSink). metadata is kept in
+    the file's schema metadata.'''
+
+    def __init__(self, out, schema, row_group_size=ROW_GROUP_SIZE,
+            compression=COMPRESSION, chunk_size=CHUNK_SIZE, metadata=None):
+        import pyarrow.parquet
+        self.schema = arrow_schema(schema)
+        if metadata:
+            self.schema = self.schema.with_metadata(metadata)
+        self.names = tuple(self.schema.names)
+        self.row_group_size = row_group_size
+        self.chunk_size = chunk_size
+        self._rows = []
+        self._batches = []
+        self._pending = 0
+        self._writer = pyarrow.parquet.ParquetWriter(
+            out, self.schema, compression=compression)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, record):
+        self._rows.append([record.get(name) for name in self.names])
+        rows = len(self._rows)
+        if (rows >= self.chunk_size or
+                self._pending + rows >= self.row_group_size):
+            self._batch()
+            if self._pending >= self.row_group_size:
+                self.flush()
+
+    # Writes everything gathered so far as one row group
+    def flush(self):
+        import pyarrow
+        self._batch()
+        if not self._batches:
+            return
+        self._writer.write_table(pyarrow.Table.from_batches(self._batches),
+            self.row_group_size)
+        self._batches = []
+        self._pending = 0
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+
+    # Turns the gathered rows into a record batch so their python values can
+    # be released
+    def _batch(self):
+        import pyarrow
+        if not self._rows:
+            return
+        columns = zip(*self._rows)
+        arrays = [pyarrow.array(column, type=field.type)
+            for column, field in zip(columns, self.schema)]
+        self._batches.append(
+            pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema))
+        self._pending += len(self._rows)
+        self._rows = []
@@ -0,0 +1,195 @@
+'''Overlaps the Mongo fetch, the conversion and avro encoding, and the output
+writes of one partition by running them as threads joined by bounded queues.
+
+The fetch thread pulls cursor batches and hands them on in chunks, the
+calling thread converts and encodes records, and a writer thread takes the
+encoded avro blocks and writes them to disk or HDFS. Queues hold at most
+depth items, so a slow stage holds the others back instead of letting
+documents pile up in memory. Each stage keeps its busy and idle (waiting on
+a queue) time, and report() logs them through the export's Metrics, showing
+which stage the others were waiting for.
+'''
+from contextlib import contextmanager
+from itertools import islice
+from threading import Event, Thread
+from timeit import default_timer
+try:
+    from queue import Empty, Full, Queue
+except ImportError:
+    from Queue import Empty, Full, Queue
+
+# Chunks or blocks each queue holds before its producer waits
+QUEUE_DEPTH = 8
+# Documents handed from the fetch thread to the conversion at a time
+CHUNK_SIZE = 500
+# Seconds between checks for a stopped pipeline while blocked on a queue
+POLL = 0.1
+
+_DONE = object()
+
+
+class Stage(object):
+    '''Busy and idle seconds of one pipeline stage.'''
+
+    def __init__(self, name):
+        self.name = name
+        self.busy = 0.0
+        self.idle = 0.0
+
+    def summary(self):
+        total = self.busy + self.idle
+        return {
+            'stage': self.name,
+            'busy_seconds': self.busy,
+            'idle_seconds': self.idle,
+            'busy_fraction': self.busy / total if total else 0.0}
+
+
+class _Failure(object):
+
+    def __init__(self, error):
+        self.error = error
+
+
+class QueueFile(object):
+    '''Write only file object passing each write to the writer thread.'''
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+    def write(self, data):
+        self.pipeline._put(self.pipeline._blocks, bytes(data),
+            self.pipeline.encode_stage)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def seekable(self):
+        return False
+
+
+class Pipeline(object):
+    '''Runs fetch(documents) and sink(out) on threads around the calling
+    thread, which does the conversion and encoding.'''
+
+    def __init__(self, depth=QUEUE_DEPTH, chunk_size=CHUNK_SIZE):
+        self.depth = depth
+        self.chunk_size = chunk_size
+        self.fetch_stage = Stage('fetch')
+        self.encode_stage = Stage('encode')
+        self.write_stage = Stage('write')
+        self._stopped = Event()
+        self._blocks = Queue(depth)
+        self._started = default_timer()
+
+    @property
+    def stages(self):
+        return self.fetch_stage, self.encode_stage, self.write_stage
+
+    # Iterates documents, reading them ahead on the fetch thread
+    def fetch(self, documents):
+        chunks = Queue(self.depth)
+        thread = Thread(target=self._fetch, args=(iter(documents), chunks))
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                chunk = self._get(chunks, self.encode_stage)
+                if chunk is _DONE:
+                    return
+                if isinstance(chunk, _Failure):
+                    raise chunk.error
+                for document in chunk:
+                    yield document
+        finally:
+            self._stopped.set()
+            thread.join()
+            self._stopped.clear()
+
+    # Context manager giving a file object whose writes reach out through the
+    # writer thread; leaving it waits for every write and raises a failed one
+    @contextmanager
+    def sink(self, out):
+        failures = []
+        thread = Thread(target=self._write, args=(out, failures))
+        thread.daemon = True
+        thread.start()
+        try:
+            yield QueueFile(self)
+        except BaseException:
+            self._stopped.set()
+            raise
+        finally:
+            self._put(self._blocks, _DONE, self.encode_stage, force=True)
+            thread.join()
+        if failures:
+            raise failures[0]
+
+    # Logs each stage's busy and idle time as a 'pipeline' event of metrics,
+    # the encode stage's busy time being whatever it did not spend waiting
+    def report(self, metrics):
+        self.encode_stage.busy = max(0.0,
+            default_timer() - self._started - self.encode_stage.idle)
+        for stage in self.stages:
+            metrics.log('pipeline', **stage.summary())
+
+    def _fetch(self, documents, chunks):
+        stage = self.fetch_stage
+        try:
+            while not self._stopped.is_set():
+                start = default_timer()
+                chunk = list(islice(documents, self.chunk_size))
+                stage.busy += default_timer() - start
+                if not chunk:
+                    break
+                self._put(chunks, chunk, stage)
+        except Exception as error:
+            self._put(chunks, _Failure(error), stage)
+            return
+        self._put(chunks, _DONE, stage)
+
+    def _write(self, out, failures):
+        stage = self.write_stage
+        while True:
+            block = self._get(self._blocks, stage, wait=True)
+            if block is _DONE:
+                return
+            if failures:
+                continue
+            start = default_timer()
+            try:
+                out.write(block)
+            except Exception as error:
+                failures.append(error)
+                self._stopped.set()
+            stage.busy += default_timer() - start
+
+    # Puts item, counting the wait as idle; unless force is set, gives up
+    # once the pipeline is stopped
+    def _put(self, queue, item, stage, force=False):
+        start = default_timer()
+        try:
+            while True:
+                try:
+                    queue.put(item, timeout=POLL)
+                    return
+                except Full:
+                    if self._stopped.is_set() and not force:
+                        return
+        finally:
+            stage.idle += default_timer() - start
+
+    # Gets an item, counting the wait as idle; unless wait is set, gives up
+    # with _DONE once the pipeline is stopped
+    def _get(self, queue, stage, wait=False):
+        start = default_timer()
+        try:
+            while True:
+                try:
+                    return queue.get(timeout=POLL)
+                except Empty:
+                    if self._stopped.is_set() and not wait:
+                        return _DONE
+        finally:
+            stage.idle += default_timer() - start
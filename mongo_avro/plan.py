@@ -0,0 +1,152 @@
+'''Compiles an avro schema into a field plan once, so each Mongo document is
+laid out straight into a list of values in schema field order, zipped into
+the one dict fastavro encodes, instead of being rebuilt through several
+intermediate dicts.
+'''
+from collections import OrderedDict
+from itertools import islice
+
+from mongo_avro.rawbson import read_features
+
+# Compiled plans and layouts kept per process
+CACHE_SIZE = 32
+
+
+class PlanCache(object):
+    '''The plans or layouts compiled most recently, at most size of them,
+    keyed on the schema, metadata and keys (and any options) each was
+    compiled from. Holding on to the schema keeps its id, part of the key,
+    from being reused while its entry is cached.'''
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self._entries = OrderedDict()
+
+    # Returns the entry of these inputs, calling compile() on a miss
+    def get(self, compile, schema, metadata, keys=None, *options):
+        key = (id(schema), tuple(metadata),
+            None if keys is None else frozenset(keys.items())) + options
+        try:
+            entry = self._entries.pop(key)
+        except KeyError:
+            entry = (schema, compile())
+            if len(self._entries) >= self.size:
+                self._entries.popitem(last=False)
+        self._entries[key] = entry
+        return entry[1]
+
+    def clear(self):
+        self._entries.clear()
+
+
+_plans = PlanCache()
+
+
+class FieldPlan(object):
+    '''Maps Mongo feature keys and metadata converters to avro field
+    positions.
+
+    metadata is a sequence of (field name, converter) pairs, each converter
+    taking the Mongo document or naming another metadata field whose value is
+    reused, so it is only computed once per record. keys maps Mongo feature
+    keys to field names and defaults to every non metadata field under its
+    own name. Features a document lacks are left as missing.'''
+
+    # Avro file metadata written along with the rows, none for flat rows
+    file_metadata = None
+
+    def __init__(self, schema, metadata, keys=None, missing=None):
+        self.schema = schema
+        self.missing = missing
+        self.names = tuple(field['name'] for field in schema['fields'])
+        self.width = len(self.names)
+        self.index = dict(
+            (name, position) for position, name in enumerate(self.names))
+        self.metadata = tuple(
+            (self.index[name], convert) for name, convert in metadata
+            if callable(convert) and not hasattr(convert, 'batch'))
+        self.batched = tuple(
+            (self.index[name], convert) for name, convert in metadata
+            if hasattr(convert, 'batch'))
+        self.copies = tuple(
+            (self.index[name], self.index[convert])
+            for name, convert in metadata if not callable(convert))
+        if keys is None:
+            metadata_names = set(name for name, convert in metadata)
+            keys = dict((name, name) for name in self.names
+                if name not in metadata_names)
+        self.features = dict(
+            (key, self.index[name]) for key, name in keys.items())
+        self.unknown = set()
+
+    # Lays a Mongo document out as a record; feature keys missing from the
+    # schema are skipped and collected in unknown, which the FeatureTransform
+    # clears and reports per window. Documents read as
+    # RawBSONDocument have only their features subdocument decoded
+    def row(self, document):
+        return dict(zip(self.names, self.values(document)))
+
+    # The document's values in schema field order
+    def values(self, document):
+        values = self._layout(document)
+        for position, convert in self.batched:
+            values[position] = convert(document)
+        for position, source in self.copies:
+            values[position] = values[source]
+        return values
+
+    # Lays documents out as records. fastavro encodes plain dicts faster than
+    # any mapping wrapped around the value lists, so they are built here
+    def rows(self, documents, chunk_size=None):
+        names = self.names
+        for values in self.value_lists(documents, chunk_size):
+            yield dict(zip(names, values))
+
+    # values() of each document. With a chunk_size, converters that support
+    # it (e.g. timestamps) convert a whole chunk of documents in one call
+    def value_lists(self, documents, chunk_size=None):
+        if not chunk_size or not self.batched:
+            values = self.values
+            for document in documents:
+                yield values(document)
+            return
+        documents = iter(documents)
+        while True:
+            chunk = list(islice(documents, chunk_size))
+            if not chunk:
+                return
+            layouts = [self._layout(document) for document in chunk]
+            for position, convert in self.batched:
+                for values, value in zip(layouts, convert.batch(chunk)):
+                    values[position] = value
+            for values in layouts:
+                for position, source in self.copies:
+                    values[position] = values[source]
+                yield values
+
+    def _layout(self, document):
+        values = [self.missing] * self.width
+        raw = getattr(document['features'], 'raw', None)
+        if raw is not None:
+            self.unknown.update(read_features(raw, self.features, values))
+        else:
+            self._layout_features(document['features'], values)
+        for position, convert in self.metadata:
+            values[position] = convert(document)
+        return values
+
+    def _layout_features(self, document_features, values):
+        features = self.features
+        for key, value in document_features.items():
+            position = features.get(key)
+            if position is None:
+                self.unknown.add(key)
+            elif value is not None:
+                values[position] = float(value)
+
+
+# Returns the plan compiled for schema, metadata and keys, compiling it on
+# first use
+def plan_for(schema, metadata, keys=None):
+    return _plans.get(lambda: FieldPlan(schema, metadata, keys), schema,
+        metadata, keys)
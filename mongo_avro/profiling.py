@@ -0,0 +1,186 @@
+'''Opt-in profiling of exports, switched on without editing the scripts.
+
+With a directory set (--profile or EXPORT_PROFILE) every partition a
+wrapped export writes runs under cProfile and between two tracemalloc
+snapshots. Each partition leaves a <partition>.<pid>.prof file for pstats,
+snakeviz and the like, and a <partition>.<pid>.alloc.txt listing the
+source lines that allocated the most memory while it ran. Both are
+produced in whichever process exported the partition, so pooled backfills
+profile their workers too.
+
+cProfile only sees the thread the export runs on. For the pipeline's fetch
+and writer threads, or for an overall picture of the run, a sampling
+interval (--profile-sample or EXPORT_PROFILE_SAMPLE seconds) samples every
+thread's stack of the main process. The samples are written as
+sample.<pid>.folded, in the collapsed format flamegraph.pl and speedscope
+read.
+'''
+import cProfile
+import json
+import sys
+from collections import Counter
+from contextlib import contextmanager
+from functools import partial
+from logging import getLogger
+from os import (
+    getpid,
+    makedirs,
+    path)
+from threading import Event, Thread, current_thread
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+logger = getLogger('mongo_avro.profiling')
+
+# Allocating source lines listed per partition
+TOP_ALLOCATIONS = 25
+# Frames kept per traceback by tracemalloc
+TRACEMALLOC_FRAMES = 1
+
+
+class Profiler(object):
+    '''Profiles exports into directory, or does nothing when directory is
+    None. sample_interval seconds, when set, enables the stack sampler.'''
+
+    def __init__(self, directory=None, sample_interval=0,
+            top=TOP_ALLOCATIONS):
+        self.directory = directory
+        self.sample_interval = sample_interval
+        self.top = top
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    # Returns export(starttime, endtime, ...) profiled per partition, as a
+    # picklable callable pool workers can run
+    def wrap(self, export):
+        if not self.enabled:
+            return export
+        return partial(run_profiled, self, export)
+
+    # Profiles the block as partition name, writing its .prof and top
+    # allocations
+    @contextmanager
+    def partition(self, name):
+        if not self.enabled:
+            yield
+            return
+        base = self._path('{}.{}'.format(name, getpid()))
+        started_tracing = False
+        before = None
+        if tracemalloc is not None:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+                started_tracing = True
+            before = tracemalloc.take_snapshot()
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(base + '.prof')
+            if before is not None:
+                after = tracemalloc.take_snapshot()
+                self._write_allocations(base + '.alloc.txt', name,
+                    after.compare_to(before, 'lineno')[:self.top])
+                if started_tracing:
+                    tracemalloc.stop()
+            logger.info(json.dumps({
+                'event': 'profile', 'partition': name, 'profile':
+                    base + '.prof'}, sort_keys=True))
+
+    # Samples every thread's stack while the block runs, when sampling is on
+    @contextmanager
+    def sampling(self):
+        if not self.enabled or not self.sample_interval:
+            yield
+            return
+        sampler = StackSampler(self.sample_interval)
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            file_name = self._path('sample.{}.folded'.format(getpid()))
+            sampler.write(file_name)
+            logger.info(json.dumps({
+                'event': 'sample', 'samples': sampler.samples,
+                'profile': file_name}, sort_keys=True))
+
+    def _path(self, file_name):
+        if not path.exists(self.directory):
+            try:
+                makedirs(self.directory)
+            except OSError:
+                # Another worker made it first
+                pass
+        return path.join(self.directory, file_name)
+
+    def _write_allocations(self, file_name, name, statistics):
+        with open(file_name, 'w') as out:
+            out.write('Top {} allocating lines while exporting {}\n'.format(
+                len(statistics), name))
+            for statistic in statistics:
+                out.write('{}\n'.format(statistic))
+        if statistics:
+            logger.info(json.dumps({
+                'event': 'allocations', 'partition': name,
+                'top': str(statistics[0])}, sort_keys=True))
+
+
+class StackSampler(object):
+    '''Thread counting the stacks of the process's other threads every
+    interval seconds.'''
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stopped = Event()
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    # Writes the stacks as 'outer;...;inner count' lines
+    def write(self, file_name):
+        with open(file_name, 'w') as out:
+            for stack, count in self.stacks.most_common():
+                out.write('{} {}\n'.format(stack, count))
+
+    def _run(self):
+        me = current_thread().ident
+        while not self._stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    self.stacks[_folded(frame)] += 1
+            self.samples += 1
+
+
+def _folded(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{}:{}'.format(
+            path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+# Runs export for the starttime partition under profiler
+def run_profiled(profiler, export, starttime, endtime, *args, **kwargs):
+    with profiler.partition(starttime.strftime('%Y_%m_%d')):
+        return export(starttime, endtime, *args, **kwargs)
+
+# Returns the Profiler set up by EXPORT_PROFILE and EXPORT_PROFILE_SAMPLE
+def profiler_from_environ(environ):
+    return Profiler(environ.get('EXPORT_PROFILE'),
+        float(environ.get('EXPORT_PROFILE_SAMPLE', 0)))
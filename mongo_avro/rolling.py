@@ -0,0 +1,144 @@
+'''Splits one export into <base>_partNNNN.avro files of a target size.
+
+A busy day no longer lands in one huge file read by a single Spark task, and
+each part is capped in size, so splits downstream are even and no writer
+holds more than one part open. Parts are closed once they reach max_bytes,
+by default one HDFS block, or max_records. When the export finishes,
+<base>_manifest.json lists every part with its record and byte counts and is
+the authoritative list of files for the export.
+'''
+import json
+from io import RawIOBase
+
+from fastavro.write import Writer
+
+from mongo_avro.codecs import SYNC_INTERVAL
+
+# Default HDFS block size, and the default size of a part
+HDFS_BLOCK_SIZE = 128 << 20
+
+
+class CountingFile(RawIOBase):
+    '''Write only file object passing bytes through to out and counting
+    them, since HDFS upload streams cannot tell their size.'''
+
+    def __init__(self, out):
+        self.out = out
+        self.bytes = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.out.write(data)
+        self.bytes += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.bytes
+
+
+class RollingAvroWriter(object):
+    '''Avro writer spreading records over parts opened through
+    open_file(file_name), which returns a context manager giving a writable
+    binary file, e.g. partial(hdfs_client.write, overwrite=True) or
+    partial(open, mode='wb'). When the export fails, the part being written
+    is closed with the error and, given remove_file(file_name), removed so
+    no truncated part is left behind. With manifest=False the manifest is
+    left for the caller to write_manifest() once the parts are in place,
+    e.g. after their uploads finished.'''
+
+    def __init__(self, open_file, base_name, schema, max_bytes=HDFS_BLOCK_SIZE,
+            max_records=None, codec='null', sync_interval=SYNC_INTERVAL,
+            metadata=None, remove_file=None, manifest=True):
+        self.open_file = open_file
+        self.base_name = base_name
+        self.schema = schema
+        self.max_bytes = max_bytes
+        self.max_records = max_records
+        self.codec = codec
+        self.sync_interval = sync_interval
+        self.metadata = metadata
+        self.remove_file = remove_file
+        self.manifest = manifest
+        self.parts = []
+        self._context = None
+        self._out = None
+        self._writer = None
+        self._records = 0
+
+    def __enter__(self):
+        return self
+
+    # Closes the open part and, unless the export failed or manifest is
+    # False, writes the manifest
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self._close_part()
+            if self.manifest:
+                self.write_manifest()
+        else:
+            self._abort_part(exc_type, exc_value, traceback)
+
+    @property
+    def manifest_name(self):
+        return '{}_manifest.json'.format(self.base_name)
+
+    # Records and bytes written over every closed part
+    @property
+    def stats(self):
+        return {
+            'records': sum(part['records'] for part in self.parts),
+            'bytes': sum(part['bytes'] for part in self.parts),
+            'parts': len(self.parts)}
+
+    def write(self, record):
+        if self._writer is None:
+            self._open_part()
+        self._writer.write(record)
+        self._records += 1
+        if (self._out.bytes >= self.max_bytes or
+                self.max_records and self._records >= self.max_records):
+            self._close_part()
+
+    def close(self):
+        self.__exit__(None, None, None)
+
+    def _open_part(self):
+        file_name = '{}_part{:04d}.avro'.format(
+            self.base_name, len(self.parts))
+        self._context = self.open_file(file_name)
+        self._out = CountingFile(self._context.__enter__())
+        self._writer = Writer(self._out, self.schema, codec=self.codec,
+            sync_interval=self.sync_interval, metadata=self.metadata)
+        self.parts.append({'file': file_name, 'records': 0, 'bytes': 0})
+        self._records = 0
+
+    def _close_part(self):
+        if self._writer is None:
+            return
+        self._writer.flush()
+        self._context.__exit__(None, None, None)
+        self.parts[-1].update(records=self._records, bytes=self._out.bytes)
+        self._context = self._out = self._writer = None
+
+    # Closes the open part with the export's error and removes it
+    def _abort_part(self, *exc_info):
+        if self._writer is None:
+            return
+        file_name = self.parts.pop()['file']
+        context = self._context
+        self._context = self._out = self._writer = None
+        try:
+            context.__exit__(*exc_info)
+        finally:
+            if self.remove_file is not None:
+                self.remove_file(file_name)
+
+    # Writes the manifest of the closed parts through open_file, by default
+    # the one the parts were opened with
+    def write_manifest(self, open_file=None):
+        manifest = dict(self.stats, parts=self.parts)
+        with (open_file or self.open_file)(self.manifest_name) as out:
+            out.write(json.dumps(manifest, indent=2, sort_keys=True)
+                .encode('utf-8'))
@@ -0,0 +1,109 @@
+'''Caches generated avro schemas in memory for the life of a process and on
+disk across runs, keyed by model name and a fingerprint of the feature keys
+the schema was built from.
+
+On disk each entry is a <model>.<kind>.avsc schema, an optional
+<model>.<kind>.symbols.json feature key to field name table, and a
+<model>.<kind>.fingerprint file written last so a half written entry is never
+trusted.
+'''
+from hashlib import sha1
+from json import dump, load
+from os import (
+    getpid,
+    makedirs,
+    path,
+    rename)
+
+
+# Stable digest of a feature key set, any manual symbol overrides and the
+# version of the code building the schema
+def fingerprint(keys, overrides=None, version=1):
+    digest = sha1(str(version).encode('utf-8') + b'\0')
+    for key in sorted(keys):
+        digest.update(key.encode('utf-8') + b'\0')
+    for key in sorted(overrides or {}):
+        digest.update(key.encode('utf-8') + b'\1' +
+            overrides[key].encode('utf-8') + b'\0')
+    return digest.hexdigest()
+
+
+class SchemaCache(object):
+
+    # Bump version whenever the schema built from the same keys changes
+    def __init__(self, kind, directory='.schema_cache', version=1):
+        self.kind = kind
+        self.version = version
+        self.directory = directory
+        self._memory = {}
+
+    # Returns (schema, symbols) for model. Feature keys are sampled at most
+    # once per process and the schema is rebuilt only when they changed
+    def load(self, model, sample_keys, build, overrides=None):
+        if model in self._memory:
+            return self._memory[model]
+        keys = sample_keys()
+        digest = fingerprint(keys, overrides, self.version)
+        entry = self._read(model, digest)
+        if entry is None:
+            entry = build(keys)
+            self._write(model, digest, entry)
+        self._memory[model] = entry
+        return entry
+
+    # Returns the feature symbols last persisted for model whatever their
+    # fingerprint, so a rebuilt schema can keep existing field names
+    def previous_symbols(self, model):
+        try:
+            with open(self._path(model, 'symbols.json')) as symbols_file:
+                return load(symbols_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+    # Drops the in memory entries so the next load samples Mongo again
+    def clear(self):
+        self._memory.clear()
+
+    def _path(self, model, extension):
+        return path.join(
+            self.directory, '{}.{}.{}'.format(model, self.kind, extension))
+
+    def _read(self, model, digest):
+        try:
+            with open(self._path(model, 'fingerprint')) as fingerprint_file:
+                if fingerprint_file.read().strip() != digest:
+                    return None
+            with open(self._path(model, 'avsc')) as schema_file:
+                schema = load(schema_file)
+            symbols = None
+            if path.exists(self._path(model, 'symbols.json')):
+                with open(self._path(model, 'symbols.json')) as symbols_file:
+                    symbols = load(symbols_file)
+        except (IOError, OSError, ValueError):
+            return None
+        return schema, symbols
+
+    def _write(self, model, digest, entry):
+        schema, symbols = entry
+        if not path.exists(self.directory):
+            try:
+                makedirs(self.directory)
+            except OSError:
+                if not path.isdir(self.directory):
+                    raise
+        self._replace(model, 'avsc', schema)
+        if symbols is not None:
+            self._replace(model, 'symbols.json', symbols)
+        self._replace(model, 'fingerprint', digest)
+
+    # Writes through a temporary file so concurrent workers never read a
+    # partially written entry
+    def _replace(self, model, extension, content):
+        target = self._path(model, extension)
+        temporary = '{}.{}.tmp'.format(target, getpid())
+        with open(temporary, 'w') as out:
+            if extension == 'fingerprint':
+                out.write(content)
+            else:
+                dump(content, out, indent=2, sort_keys=True)
+        rename(temporary, target)
@@ -0,0 +1,151 @@
+'''The sepsis model's psPreds documents as the export scripts read them.
+
+Sampling their feature keys, the avro fields every transform and prediction
+record carries and shaping a prediction document as a record live here, so
+the scripts only say which provenance, input_events type and record name
+they write.
+'''
+from mongo_avro.aggregate import prediction_pipeline
+from mongo_avro.engine import connections
+from mongo_avro.inference import feature_keys
+from mongo_avro.timestamps import (
+    EpochConverter,
+    TIMESTAMP_MILLIS,
+    logical_unit,
+    to_epoch)
+
+# Model whose predictions are exported
+MODEL = 'sepsismodel'
+# Model whose documents define the feature fields of the schema
+SCHEMA_MODEL = 'sepsismodel_noEpoch'
+# Documents sampled when inferring the feature keys, None scans every match
+SCHEMA_SAMPLE_SIZE = 10000
+# Epoch unit of the valid_on/created_on fields
+TIME_UNIT = logical_unit(TIMESTAMP_MILLIS)
+
+PREDICT_PROVENANCE = ['psPredsExtract', 'PredictSepsis']
+TRANSFORM_PROVENANCE = ['psPredsExtract', 'TransformSepsis']
+
+RECORD_DOC = ('The transform is either scalar or vector (array). The ' +
+    'indices are held in key value pairs in the schema.  The types ' +
+    'of the values are unique to the transform component.  ' +
+    'Typically the values will be floats.')
+
+# Fields a prediction record carries after the common ones
+PREDICTION_FIELDS = (
+    {
+        'name': 'Prediction',
+        'doc': 'Prediction type could be a classification or regression.',
+        'type': 'float'
+    },
+    {
+        'name': 'Score',
+        'doc': 'Prediction type could be a classification, regression, or a string txt.',
+        'type': 'float'
+    },
+    {
+        'name': 'heuristic_rule',
+        'doc': 'True or False to report the predicted outcome.  The Data Scientist can create heuristic rules that determines if the predictive is reported or not.  True=Report, False=Do not report.',
+        'type': 'boolean'
+    })
+
+
+# Infers the feature keys over a sample of the schema and exported models'
+# documents, or over every exported document in window when one is given
+def sample_feature_keys(window=None, connections=connections):
+    psPreds = connections.collection('psPreds.preds')
+    if window is None:
+        q = {'modelName':{'$in':[SCHEMA_MODEL, MODEL]}}
+        return feature_keys(psPreds, q, SCHEMA_SAMPLE_SIZE)
+    starttime, endtime = window
+    q = {'modelName':MODEL,
+         'WCT':{'$gte':starttime,'$lt':endtime}}
+    return feature_keys(psPreds, q)
+
+# The prediction's event ids its output was computed from
+def input_event_ids(prediction):
+    return str(prediction['_id'])
+
+# Avro fields of a transform record filled from the Mongo document rather
+# than its features, as FieldPlan metadata
+def transform_metadata(provenance=TRANSFORM_PROVENANCE,
+        input_events=input_event_ids):
+    return (
+        ('event_id', lambda prediction: str(prediction['_id'])),
+        ('valid_on', EpochConverter('WCT', TIME_UNIT)),
+        ('created_on', 'valid_on'),
+        ('input_events', input_events),
+        ('patient_id', lambda prediction: prediction['VISIT_NUMBER']),
+        ('provenance', lambda prediction: provenance))
+
+# The event, time, patient and provenance fields of every record
+def common_fields(input_events_type='string'):
+    fields = []
+    fields.append({
+        'name': 'event_id',
+        'type': 'string'})
+    fields.append({
+        'name': 'valid_on',
+        'type': [TIMESTAMP_MILLIS, 'null']})
+    fields.append({
+        'name': 'created_on',
+        'type': [TIMESTAMP_MILLIS, 'null']})
+    fields.append({
+        'name': 'input_events',
+        'type': input_events_type,
+        'doc': 'Array of the penn signal event_ids that we\'re used as input into the transform output'})
+    fields.append({'name': 'patient_id', 'type': ['int', 'null']})
+    fields.append({
+        'name': 'provenance',
+        'type':{
+            'type': 'array',
+            'items': {
+                'name': 'source',
+                'type': 'string'
+            }}
+        })
+    return fields
+
+# Record schema of the given name and fields
+def record_schema(name, fields):
+    return {
+        'type': 'record',
+        'name': name,
+        'doc': RECORD_DOC,
+        'fields': fields
+    }
+
+# Transform schema of the given feature fields followed by the common ones
+def transform_schema(feature_fields, input_events_type='string'):
+    return record_schema('Transform',
+        list(feature_fields) + common_fields(input_events_type))
+
+# The prediction schema has no feature fields, so it is built without
+# querying Mongo
+def prediction_schema(name='Predictions', input_events_type='string'):
+    return record_schema(name,
+        common_fields(input_events_type) + [dict(field)
+            for field in PREDICTION_FIELDS])
+
+# Shapes a prediction as an avro record, passing through the ones the
+# aggregate fetch already shaped
+def to_record(prediction, provenance=PREDICT_PROVENANCE,
+        input_events=input_event_ids):
+    if 'event_id' in prediction:
+        return prediction
+    data = {}
+    data['event_id'] = 'pred_' + str(prediction['_id'])
+    time = to_epoch(prediction['WCT'], TIME_UNIT)
+    data['valid_on'] = time
+    data['created_on'] = time
+    data['input_events'] = input_events(prediction)
+    data['patient_id'] = prediction['VISIT_NUMBER']
+    data['provenance'] = provenance
+    data['Prediction'] = float(prediction['result']['result']['predict'])
+    data['Score'] = float(prediction['result']['result']['score'])
+    data['heuristic_rule'] = prediction['result']['result']['heuristic_alert']
+    return data
+
+# Aggregation reshaping the predictions in Mongo, for FETCH_MODE=aggregate
+def aggregate_pipeline(q, limit, provenance=PREDICT_PROVENANCE, sort=None):
+    return prediction_pipeline(q, provenance, TIME_UNIT, limit, sort=sort)
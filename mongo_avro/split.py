@@ -0,0 +1,107 @@
+'''Cuts one heavy window into sub-ranges of roughly equal size, so a single
+day can be read over several cursors by several workers.
+
+$bucketAuto on the split field (WCT or _id) gives the boundaries in one
+small aggregation. Documents sharing a value always land in the same bucket,
+so the sub-ranges never overlap and together select exactly what the window
+did. Each worker writes its sub-range as a part; parts written with a
+shared sync marker can then be concatenated block for block into a single
+avro file in sub-range order without decoding anything.
+'''
+from multiprocessing import Pool
+from shutil import copyfileobj
+
+from mongo_avro.backfill import run_window
+from mongo_avro.metrics import Metrics
+
+# Bytes read at a time while merging parts
+MERGE_CHUNK_SIZE = 1 << 20
+
+
+# Returns parts (low, high) ranges of field splitting the documents matching
+# query into roughly equal counts. The first low and the last high are None,
+# leaving the ends to query.
+def split_ranges(collection, query, field, parts):
+    pipeline = [
+        {'$match': query},
+        {'$bucketAuto': {'groupBy': '$' + field, 'buckets': parts}}]
+    lows = [bucket['_id']['min']
+        for bucket in collection.aggregate(pipeline, allowDiskUse=True)]
+    boundaries = [None] + lows[1:] + [None]
+    return list(zip(boundaries, boundaries[1:]))
+
+# Narrows query to the low <= field < high range, None leaving an end open
+def range_query(query, field, low, high):
+    q = dict(query)
+    bounds = dict(q.get(field) or {})
+    if low is not None:
+        bounds['$gte'] = low
+    if high is not None:
+        bounds['$lt'] = high
+    if bounds:
+        q[field] = bounds
+    return q
+
+# Runs export(index, low, high) for every range, in process when processes
+# is 1, otherwise over a pool, and returns their stats in range order. The
+# first failure is raised once every range has finished.
+def run_ranges(export, ranges, processes=1, initializer=None):
+    jobs = [(export, (index, low, high))
+        for index, (low, high) in enumerate(ranges)]
+    if processes == 1:
+        results = [run_window(job) for job in jobs]
+    else:
+        pool = Pool(processes, initializer)
+        try:
+            results = pool.map(run_window, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    for window, stats, error in results:
+        if error is not None:
+            raise RuntimeError('part {} failed\n{}'.format(window[0], error))
+    return [stats for window, stats, error in results]
+
+# Adds the stats of parts together, keeping the largest watermark and
+# adding up the stages the parts measured in their 'metrics'
+def combine_stats(part_stats):
+    stats = {'records': 0, 'bytes': 0, 'parts': len(part_stats)}
+    metrics = Metrics()
+    unknown = set()
+    for part in part_stats:
+        stats['records'] += part['records']
+        stats['bytes'] += part['bytes']
+        if part.get('last') is not None and (
+                stats.get('last') is None or part['last'] > stats['last']):
+            stats['last'] = part['last']
+        for name, state in (part.get('metrics') or {}).items():
+            metrics.stage(name).merge(state)
+        if 'unknown_keys' in part:
+            unknown.update(part['unknown_keys'])
+    if metrics.stages:
+        stats['metrics'] = metrics.state()
+    if unknown:
+        stats['unknown_keys'] = sorted(unknown)
+    return stats
+
+# Concatenates avro files written with the same schema, codec and
+# sync_marker into out, keeping only the first file's header
+def merge_avro(file_names, out, sync_marker):
+    for index, file_name in enumerate(file_names):
+        with open(file_name, 'rb') as part:
+            if index:
+                _skip_header(part, sync_marker)
+            copyfileobj(part, out, MERGE_CHUNK_SIZE)
+
+# Moves part just past its header, which ends with the sync marker
+def _skip_header(part, sync_marker):
+    data = b''
+    while True:
+        chunk = part.read(MERGE_CHUNK_SIZE)
+        if not chunk:
+            raise ValueError('avro header without the shared sync marker')
+        data += chunk
+        end = data.find(sync_marker)
+        if end != -1:
+            part.seek(end + len(sync_marker))
+            return
@@ -0,0 +1,148 @@
+'''Normalizes Mongo feature keys into avro/PySpark friendly symbols and
+resolves collisions between them.
+
+All of subs is applied in a single alternation pass (longest key first, as
+the old reversed sorted replace loop did) and the cleanup passes are fused
+into two regexes. The old first_cap/all cap passes ran after lower() and so
+could never match; they are gone without changing any symbol.
+'''
+from functools import lru_cache
+from json import dump, load
+from keyword import iskeyword
+from os import (
+    getpid,
+    makedirs,
+    path,
+    rename)
+from re import (
+    compile as re_compile,
+    escape)
+
+subs = {
+    '(' : '_lp_',
+    ')' : '_rp_',
+    '%' : '_pct_',
+    '\'' : '_squo_',
+    '[' : '_lb_',
+    ']' : '_rb_',
+    '.' : '_dot_',
+    '?' : '_question_',
+    ',' : '_comma_',
+    ':' : '_colon_',
+    ';' : '_semicolon_',
+    '*' : '_asterisk_',
+    '>>>': '_is_',
+    '+++': '_derived_',
+    '+' : '_plus_',
+    '-' : '_hyphen_',
+    '>' : '_gt_',
+    '<' : '_lt_',
+    '/' : '_slash_',
+    ' ' : '_'}
+
+subs_re = re_compile('|'.join(
+    escape(key) for key in sorted(subs, key=len, reverse=True)))
+dunder_re = re_compile('_+')
+edge_re = re_compile('^_|_$') # lead and trail _
+
+# Symbols memoized per process; the persisted SymbolTable covers across runs
+SYMBOL_CACHE_SIZE = 1 << 16
+
+
+def _substitute(match):
+    return subs[match.group(0)]
+
+# Performs normalization on returned key
+@lru_cache(maxsize=SYMBOL_CACHE_SIZE)
+def to_symbol(old):
+    new = subs_re.sub(_substitute, old.lower())
+    new = edge_re.sub('', dunder_re.sub('_', new))
+
+    if iskeyword(new):
+        new = new + '_'
+
+    if not new.isidentifier():
+        raise TypeError('%s is not a valid symbol for \'%s\'' % (new, old))
+    return new
+
+
+class SymbolTable(object):
+    '''Feature key to symbol table persisted as JSON, so keys seen by an
+    earlier partition or run are never normalized again. The file is read
+    on first use.'''
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.dirty = False
+        self._symbols = None
+
+    @property
+    def symbols(self):
+        if self._symbols is None:
+            self._symbols = {}
+            if path.exists(self.file_name):
+                with open(self.file_name) as symbols_file:
+                    self._symbols = load(symbols_file)
+        return self._symbols
+
+    def symbol(self, key):
+        try:
+            return self.symbols[key]
+        except KeyError:
+            symbol = self.symbols[key] = to_symbol(key)
+            self.dirty = True
+            return symbol
+
+    def save(self):
+        if not self.dirty:
+            return
+        directory = path.dirname(self.file_name)
+        if directory and not path.exists(directory):
+            makedirs(directory)
+        temporary = '{}.{}.tmp'.format(self.file_name, getpid())
+        with open(temporary, 'w') as out:
+            dump(self.symbols, out, indent=2, sort_keys=True)
+        rename(temporary, self.file_name)
+        self.dirty = False
+
+
+# Rename duplicate values since they cause conflicts in PySpark. Keys keep
+# their previous assignment when it still derives from their symbol, the
+# rest claim their bare symbol in sorted key order and any that collide get
+# the lowest free _vN suffix, so names never depend on dict order
+def rename_duplicates(symbols, previous=None):
+    completed = {}
+    taken = set()
+    ordered = sorted(symbols)
+    for key in ordered:
+        assigned = (previous or {}).get(key)
+        value = symbols[key]
+        if assigned is None or assigned in taken:
+            continue
+        # Only value itself or value_vN, not another symbol such as
+        # a_valid for a
+        if assigned == value or (assigned.startswith(value + '_v') and
+                assigned[len(value) + 2:].isdigit()):
+            completed[key] = assigned
+            taken.add(assigned)
+
+    deferred = []
+    for key in ordered:
+        if key in completed:
+            continue
+        if symbols[key] in taken:
+            deferred.append(key)
+        else:
+            completed[key] = symbols[key]
+            taken.add(symbols[key])
+
+    suffixes = {}
+    for key in deferred:
+        value = symbols[key]
+        i = suffixes.get(value, 1)
+        while value + '_v' + str(i) in taken:
+            i += 1
+        completed[key] = value + '_v' + str(i)
+        taken.add(completed[key])
+        suffixes[value] = i + 1
+    return {key: completed[key] for key in symbols}
@@ -0,0 +1,295 @@
+'''Synthetic psPreds.preds documents at a controlled scale, and an in-process
+stand-in for the collection, so exporter performance can be measured without
+the clinical server.
+
+Feature keys mimic the real ones: lab and vitals names with units,
+'>>>' value suffixes, '+++' derived features and pairs that differ only by
+case or punctuation and so collide once turned into symbols. The stand-in
+keeps every document BSON encoded and decodes it per batch like a driver
+cursor would, honouring RawBSONDocument codec options.
+'''
+from datetime import datetime, timedelta
+from math import floor
+from random import Random
+
+from bson import BSON, ObjectId, decode_all
+from bson.codec_options import DEFAULT_CODEC_OPTIONS
+
+# Building blocks of the generated feature keys
+NAMES = (
+    'Urine Appearance', 'Lactate', 'WBC', 'Heart Rate', 'Resp Rate',
+    'Temp', 'SBP', 'MAP', 'Creatinine', 'Bilirubin', 'Platelets', 'SpO2',
+    'GCS Total', 'Glucose', 'Sodium', 'Potassium', 'BUN', 'pH')
+UNITS = ('', ' (mmol/L)', ' (%)', ' [K/uL]', ' mg/dL', ' (bpm)')
+VALUES = ('clear', 'Clear', 'cloudy', 'Turbid', 'yellow')
+DERIVED = ('delta', 'max_24h', 'min.6h', 'slope')
+
+MODEL = 'sepsismodel'
+
+
+# Returns count distinct feature keys. messiness is the fraction of them
+# decorated with units, '>>>' values and '+++' derivations rather than plain
+# snake_case names; messy keys include pairs that collide as symbols.
+def feature_names(count, messiness=0.5, seed=0):
+    random = Random(seed)
+    names = []
+    seen = set()
+    while len(names) < count:
+        index = len(names)
+        name = NAMES[index % len(NAMES)]
+        if random.random() < messiness:
+            name += random.choice(UNITS)
+            kind = random.random()
+            if kind < 0.4:
+                name += ' >>> ' + random.choice(VALUES)
+            elif kind < 0.6:
+                name += ' +++ ' + random.choice(DERIVED)
+        else:
+            name = name.lower().replace(' ', '_')
+        if name in seen:
+            name = '{} {}'.format(name, index)
+        seen.add(name)
+        names.append(name)
+    return names
+
+# Returns the 'result' field of a prediction document, with its values
+# depth 'result' keys down counting that field's own, so the default is
+# psPreds' {'result': {'result': {'predict': ...}}}
+def prediction_result(random, depth=2):
+    result = {
+        'predict': random.randint(0, 1),
+        'score': random.random(),
+        'heuristic_alert': random.random() < 0.1}
+    for level in range(depth - 1):
+        result = {'result': result}
+    return result
+
+# Yields count synthetic prediction documents one second apart from start.
+# Each carries about density of the feature keys, as doubles, ints and the
+# odd null, and its values nesting 'result' keys deep.
+def generate_predictions(count, keys, density=0.8, nesting=2, seed=0,
+        start=datetime(2020, 1, 1), model=MODEL):
+    random = Random(seed)
+    for index in range(count):
+        features = {}
+        for key in keys:
+            if random.random() >= density:
+                continue
+            draw = random.random()
+            if draw < 0.7:
+                features[key] = random.gauss(0, 100)
+            elif draw < 0.95:
+                features[key] = random.randint(0, 500)
+            else:
+                features[key] = None
+        yield {
+            '_id': ObjectId(),
+            'modelName': model,
+            'WCT': start + timedelta(seconds=index),
+            'VISIT_NUMBER': random.randint(1, 1 << 30),
+            'features': features,
+            'result': prediction_result(random, nesting)}
+
+
+class MemoryCursor(object):
+    '''Cursor over BSON encoded documents, decoded a batch at a time.'''
+
+    def __init__(self, encoded, codec_options, batch_size=101):
+        self.encoded = encoded
+        self.codec_options = codec_options
+        self._batch_size = batch_size
+        self._limit = None
+
+    def batch_size(self, batch_size):
+        self._batch_size = batch_size
+        return self
+
+    def limit(self, limit):
+        self._limit = limit or None
+        return self
+
+    def __iter__(self):
+        encoded = self.encoded[:self._limit]
+        for start in range(0, len(encoded), self._batch_size):
+            batch = b''.join(encoded[start:start + self._batch_size])
+            for document in decode_all(batch, self.codec_options):
+                yield document
+
+
+class MemoryCollection(object):
+    '''Stand-in for psPreds.preds answering the finds the exporters make,
+    the feature key aggregation of mongo_avro.inference and the
+    $match/$limit/$project pipelines of mongo_avro.aggregate.'''
+
+    def __init__(self, documents=(), codec_options=DEFAULT_CODEC_OPTIONS):
+        self.documents = []
+        self.codec_options = codec_options
+        self.insert_many(documents)
+
+    def insert_many(self, documents):
+        self.documents.extend(documents)
+
+    def with_options(self, codec_options=None):
+        collection = MemoryCollection(codec_options=codec_options)
+        collection.documents = self.documents
+        return collection
+
+    # BSON bytes of the documents matching query, projected to projection
+    def encoded(self, query=None, projection=None):
+        return [BSON.encode(_project(document, projection))
+            for document in self.documents if _matches(document, query)]
+
+    def find(self, query=None, projection=None):
+        return MemoryCursor(
+            self.encoded(query, projection), self.codec_options)
+
+    def aggregate(self, pipeline, **options):
+        stages = [list(stage)[0] for stage in pipeline]
+        if '$group' in stages:
+            return self._feature_types(pipeline, stages)
+        documents = self.documents
+        for stage in pipeline:
+            (operator, spec), = stage.items()
+            if operator == '$match':
+                documents = [document for document in documents
+                    if _matches(document, spec)]
+            elif operator == '$limit':
+                documents = documents[:spec]
+            elif operator == '$project':
+                documents = [_reshape(document, spec)
+                    for document in documents]
+            else:
+                raise NotImplementedError(
+                    'unsupported pipeline stage ' + operator)
+        return MemoryCursor([BSON.encode(document) for document in documents],
+            self.codec_options, options.get('batchSize', 101))
+
+    # Types of every feature key, as the feature key aggregation returns them
+    def _feature_types(self, pipeline, stages):
+        query = pipeline[0].get('$match')
+        documents = [document for document in self.documents
+            if _matches(document, query)]
+        if '$sample' in stages:
+            size = pipeline[stages.index('$sample')]['$sample']['size']
+            documents = Random(0).sample(
+                documents, min(size, len(documents)))
+        types = {}
+        for document in documents:
+            for key, value in document.get('features', {}).items():
+                types.setdefault(key, set()).add(_type_name(value))
+        return iter([{'_id': key, 'types': list(types[key])}
+            for key in sorted(types)])
+
+
+# Aggregation operators of the prediction pipeline, on evaluated arguments
+_OPERATORS = {
+    '$concat': lambda *strings: ''.join(strings),
+    '$toString': str,
+    '$toDouble': float,
+    '$toLong': int,
+    '$floor': floor,
+    '$divide': lambda dividend, divisor: dividend / float(divisor),
+    '$multiply': lambda *factors: _product(factors),
+    '$subtract': lambda minuend, subtrahend: _subtract(minuend, subtrahend)}
+
+_TYPE_NAMES = ((bool, 'bool'), (float, 'double'), (int, 'int'),
+    (type(None), 'null'))
+
+def _type_name(value):
+    for python_type, name in _TYPE_NAMES:
+        if isinstance(value, python_type):
+            return name
+    return type(value).__name__
+
+# Comparison operators of the queries, on the field's value and operand
+_COMPARISONS = {
+    '$in': lambda value, operand: value in operand,
+    '$gt': lambda value, operand: value > operand,
+    '$gte': lambda value, operand: value >= operand,
+    '$lt': lambda value, operand: value < operand,
+    '$lte': lambda value, operand: value <= operand}
+
+# Top level equality, _COMPARISONS and $and/$or matching, enough for the
+# queries the exporters build including their watermark clauses; other
+# operators raise rather than match everything
+def _matches(document, query):
+    for field, condition in (query or {}).items():
+        if field == '$or':
+            if not any(_matches(document, clause) for clause in condition):
+                return False
+            continue
+        if field == '$and':
+            if not all(_matches(document, clause) for clause in condition):
+                return False
+            continue
+        if field.startswith('$'):
+            raise NotImplementedError('unsupported query operator ' + field)
+        value = document.get(field)
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+            continue
+        for operator, operand in condition.items():
+            if operator not in _COMPARISONS:
+                raise NotImplementedError(
+                    'unsupported query operator ' + operator)
+            if not _COMPARISONS[operator](value, operand):
+                return False
+    return True
+
+# Evaluates a $project expression: '$a.b' field paths, $literal and the
+# _OPERATORS, with anything else a constant
+def _evaluate(document, expression):
+    if isinstance(expression, str) and expression.startswith('$'):
+        value = document
+        for field in expression[1:].split('.'):
+            value = value.get(field) if isinstance(value, dict) else None
+        return value
+    if not isinstance(expression, dict):
+        return expression
+    (operator, operand), = expression.items()
+    if operator == '$literal':
+        return operand
+    if operator not in _OPERATORS:
+        raise NotImplementedError('unsupported operator ' + operator)
+    if not isinstance(operand, list):
+        operand = [operand]
+    return _OPERATORS[operator](
+        *[_evaluate(document, argument) for argument in operand])
+
+def _product(factors):
+    product = 1
+    for factor in factors:
+        product *= factor
+    return product
+
+# Dates subtract to milliseconds, as in Mongo
+def _subtract(minuend, subtrahend):
+    difference = minuend - subtrahend
+    if isinstance(difference, timedelta):
+        return difference // timedelta(milliseconds=1)
+    return difference
+
+# Applies a $project stage; fields set to 1 are kept, _id unless excluded
+def _reshape(document, spec):
+    reshaped = {}
+    if spec.get('_id', 1) == 1 and '_id' in document:
+        reshaped['_id'] = document['_id']
+    for field, expression in spec.items():
+        if expression == 0:
+            continue
+        if expression == 1:
+            if field in document:
+                reshaped[field] = document[field]
+        else:
+            reshaped[field] = _evaluate(document, expression)
+    return reshaped
+
+def _project(document, projection):
+    if not projection:
+        return document
+    included = [field for field, keep in projection.items() if keep]
+    if projection.get('_id', 1) and '_id' not in included:
+        included.append('_id')
+    return dict((field, document[field]) for field in included
+        if field in document)
@@ -0,0 +1,162 @@
+'''Continuously exports new predictions as they land by polling with a rising
+(WCT, _id) cursor and appending them to a rolling local avro file.
+
+Each poll only asks for documents after the last exported (WCT, _id), so no
+range is ever queried twice. Every poll that wrote something flushes a
+complete avro block, so readers see new records within a poll interval, and
+files are closed and rotated once they reach a size or an age. The exported
+watermark is committed through a Checkpoint after each flush, so a restarted
+tail carries on where the last one stopped.
+'''
+from datetime import datetime
+from os import (
+    makedirs,
+    path)
+from time import (
+    sleep,
+    time)
+
+from fastavro.write import Writer
+
+from mongo_avro.checkpoint import after_watermark
+from mongo_avro.codecs import SYNC_INTERVAL
+from mongo_avro.timestamps import EPOCH
+
+# Sort giving a rising (WCT, _id) cursor
+TAIL_SORT = [('WCT', 1), ('_id', 1)]
+
+
+# Narrows query to the documents past the watermark
+def tail_query(query, mark):
+    q = dict(query)
+    q.update(after_watermark(mark))
+    return q
+
+
+class RollingAvroFile(object):
+    '''Avro file opened lazily on the first record and rotated to a new
+    <prefix>_<YYYYmmdd_HHMMSS>_<NNNN>.avro once it holds max_bytes or is
+    max_seconds old.'''
+
+    def __init__(self, directory, prefix, schema, max_bytes=128 << 20,
+            max_seconds=3600, codec='null', sync_interval=SYNC_INTERVAL):
+        self.directory = directory
+        self.prefix = prefix
+        self.schema = schema
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.codec = codec
+        self.sync_interval = sync_interval
+        self.parts = 0
+        self.file_name = None
+        self._out = None
+        self._writer = None
+        self._opened = None
+
+    def write(self, record):
+        if self._writer is None:
+            self._open()
+        self._writer.write(record)
+
+    # Flushes the current block so readers can see it, then rotates the file
+    # if it grew too large or too old
+    def flush(self):
+        if self._writer is None:
+            return
+        self._writer.flush()
+        self._out.flush()
+        if (self._out.tell() >= self.max_bytes or
+                time() - self._opened >= self.max_seconds):
+            self.close()
+
+    def close(self):
+        if self._writer is None:
+            return
+        self._writer.flush()
+        self._out.close()
+        self._out = self._writer = None
+
+    def _open(self):
+        if not path.exists(self.directory):
+            makedirs(self.directory)
+        self.file_name = path.join(self.directory, '{}_{}_{:04d}.avro'.format(
+            self.prefix, datetime.utcnow().strftime('%Y%m%d_%H%M%S'),
+            self.parts))
+        self._out = open(self.file_name, 'wb')
+        self._writer = Writer(self._out, self.schema, codec=self.codec,
+            sync_interval=self.sync_interval)
+        self._opened = time()
+        self.parts += 1
+
+
+class Tail(object):
+    '''Polls find_predictions(after) for documents past the watermark, in
+    (WCT, _id) order, writing each one through convert into output. With
+    metrics, the records of every poll are added to its 'tail' stage, the
+    lag is kept in its tail_lag_seconds gauge and both are emitted after
+    each poll.'''
+
+    def __init__(self, find_predictions, convert, output, checkpoint, key,
+            poll_interval=1.0, metrics=None):
+        self.find_predictions = find_predictions
+        self.convert = convert
+        self.output = output
+        self.checkpoint = checkpoint
+        self.key = key
+        self.poll_interval = poll_interval
+        self.metrics = metrics
+        self.mark = checkpoint.get(key)
+        self.records = 0
+
+    # Seconds between now and the newest exported WCT, None before the
+    # first record
+    @property
+    def lag(self):
+        if not self.mark or 'WCT' not in self.mark:
+            return None
+        newest = (self.mark['WCT'] - EPOCH).total_seconds()
+        return time() - newest
+
+    # Exports everything past the watermark once, returning the record count
+    def poll(self):
+        records, last = 0, None
+        for prediction in self.find_predictions(self.mark):
+            self.output.write(self.convert(prediction))
+            last = (prediction['WCT'], prediction['_id'])
+            records += 1
+        self.output.flush()
+        if last is not None:
+            self.checkpoint.commit(self.key, last[0], last)
+            self.mark = self.checkpoint.get(self.key)
+            self.records += records
+        return records
+
+    # Polls until stop() is true, printing throughput and lag as it goes and
+    # emitting the metrics after every poll, empty or not, and once it stops
+    def run(self, stop=lambda: False):
+        try:
+            while not stop():
+                started = time()
+                records = self.poll()
+                lag = self.lag
+                if records:
+                    print('Tail: {} records, lag {:.1f}s'.format(records, lag))
+                self._record(records, lag)
+                if not records:
+                    sleep(max(0, self.poll_interval - (time() - started)))
+        finally:
+            self.output.close()
+            if self.metrics is not None:
+                self.metrics.emit()
+
+    # Adds a poll's records and the lag, which keeps growing while polls
+    # come back empty, to the metrics and emits them
+    def _record(self, records, lag):
+        if self.metrics is None:
+            return
+        self.metrics.stage('tail').records += records
+        if lag is not None:
+            self.metrics.gauge('tail_lag_seconds', lag)
+        if records:
+            self.metrics.log('tail', records=records, lag_seconds=lag)
+        self.metrics.emit()
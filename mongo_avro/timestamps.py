@@ -0,0 +1,75 @@
+'''Converts Mongo WCT datetimes to epoch integers shared by every exporter.
+
+pymongo hands back naive datetimes in UTC, so the conversion is plain
+arithmetic against the epoch rather than a trip through strings or the local
+timezone, and gives the same answer on python 2 and 3. The unit is explicit
+and follows the logical type the schema declares.
+'''
+from datetime import datetime
+
+EPOCH = datetime(1970, 1, 1)
+
+# Ticks per second of each output unit
+UNITS = {'seconds': 1, 'millis': 1000, 'micros': 1000000}
+
+LOGICAL_TYPE_UNITS = {
+    'time-millis': 'millis',
+    'time-micros': 'micros',
+    'timestamp-millis': 'millis',
+    'timestamp-micros': 'micros'}
+
+# Avro type of the valid_on/created_on style epoch fields
+TIMESTAMP_MILLIS = {'type': 'long', 'logicalType': 'timestamp-millis'}
+
+
+# Returns the unit a (possibly nullable union) avro type stores epochs in
+def logical_unit(avro_type):
+    if isinstance(avro_type, list):
+        for branch in avro_type:
+            if branch != 'null':
+                return logical_unit(branch)
+    if isinstance(avro_type, dict):
+        return LOGICAL_TYPE_UNITS.get(avro_type.get('logicalType'), 'seconds')
+    return 'seconds'
+
+def _naive_utc(date):
+    offset = date.utcoffset()
+    if offset is None:
+        return date
+    return date.replace(tzinfo=None) - offset
+
+# Converts a naive UTC (or timezone aware) datetime to an epoch integer
+def to_epoch(date, unit='millis'):
+    delta = _naive_utc(date) - EPOCH
+    micros = ((delta.days * 86400 + delta.seconds) * 1000000 +
+        delta.microseconds)
+    return micros // (1000000 // UNITS[unit])
+
+# Converts a chunk of datetimes at once through numpy datetime64 when numpy
+# is available
+def to_epoch_batch(dates, unit='millis'):
+    try:
+        import numpy
+    except ImportError:
+        return [to_epoch(date, unit) for date in dates]
+    micros = numpy.array(
+        [_naive_utc(date) for date in dates], dtype='datetime64[us]')
+    ticks = micros.astype('int64') // (1000000 // UNITS[unit])
+    return ticks.tolist()
+
+
+class EpochConverter(object):
+    '''Field plan converter turning document[key] into an epoch integer,
+    either one document at a time or for a whole chunk of documents.'''
+
+    def __init__(self, key, unit='millis'):
+        self.key = key
+        self.unit = unit
+
+    def __call__(self, document):
+        return to_epoch(document[self.key], self.unit)
+
+    def batch(self, documents):
+        key = self.key
+        return to_epoch_batch([document[key] for document in documents],
+            self.unit)
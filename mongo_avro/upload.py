@@ -0,0 +1,126 @@
+'''Stages export files locally and pushes them to HDFS on a thread pool.
+
+Streaming through AvroWriter ties a whole day's encoding to one HTTP request
+that advances in step with the Mongo cursor. Here each file is written to a
+local staging directory first and, once closed, uploaded by one of uploads
+threads while encoding carries on with the next part. All threads share the
+client's keep-alive session, so throughput is bounded by the HttpFS gateway
+rather than one TCP stream. A failed upload is retried with exponential
+backoff before the export is failed.
+'''
+import json
+from contextlib import contextmanager
+from logging import getLogger
+from multiprocessing.pool import ThreadPool
+from os import (
+    getpid,
+    makedirs,
+    path,
+    remove,
+    rmdir)
+from time import sleep
+
+from hdfs.util import HdfsError
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+
+logger = getLogger('mongo_avro.upload')
+
+STAGING_DIRECTORY = '.staging'
+# Parallel uploads per export
+UPLOADS = 4
+# Attempts after the first one before an upload fails
+RETRIES = 3
+# Keep-alive connections a pooled session holds per host
+CONNECTIONS = 16
+
+
+# Returns a requests session keeping up to connections connections per host
+# alive, for sharing one HDFS client across upload threads
+def pooled_session(connections=CONNECTIONS):
+    session = Session()
+    adapter = HTTPAdapter(pool_connections=connections,
+        pool_maxsize=connections)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class Uploader(object):
+    '''Uploads files staged through open_staged to HDFS with client, at
+    most uploads at a time. Leaving the with block waits for every upload
+    and raises the first failure, or when the block itself raised logs the
+    failures along with it. Staged files left over either way are
+    removed.'''
+
+    def __init__(self, client, uploads=UPLOADS, retries=RETRIES, backoff=1.0,
+            directory=STAGING_DIRECTORY):
+        self.client = client
+        self.retries = retries
+        self.backoff = backoff
+        self.directory = directory
+        self.uploaded = []
+        self._pool = ThreadPool(uploads)
+        self._pending = []
+        self._staged = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._pool.close()
+        self._pool.join()
+        try:
+            for hdfs_path, result in self._pending:
+                try:
+                    self.uploaded.append(result.get())
+                except Exception as error:
+                    if exc_type is None:
+                        raise
+                    logger.error(json.dumps({
+                        'event': 'upload_failed', 'file': hdfs_path,
+                        'error': repr(error)}, sort_keys=True))
+        finally:
+            self._remove_staged()
+
+    # Context manager giving a local binary file standing in for hdfs_path,
+    # whose upload starts as soon as it is closed
+    @contextmanager
+    def open_staged(self, hdfs_path):
+        if not path.exists(self.directory):
+            makedirs(self.directory)
+        local_path = path.join(self.directory, '{}.{}'.format(
+            getpid(), hdfs_path.replace('/', '__')))
+        self._staged.append(local_path)
+        with open(local_path, 'wb') as out:
+            yield out
+        self._pending.append((hdfs_path,
+            self._pool.apply_async(self._upload, (local_path, hdfs_path))))
+
+    # Uploads local_path and removes it, returning (hdfs_path, bytes)
+    def _upload(self, local_path, hdfs_path):
+        size = path.getsize(local_path)
+        for attempt in range(self.retries + 1):
+            try:
+                with open(local_path, 'rb') as data:
+                    self.client.write(hdfs_path, data, overwrite=True)
+                break
+            except (HdfsError, RequestException):
+                if attempt == self.retries:
+                    raise
+                sleep(self.backoff * 2 ** attempt)
+        remove(local_path)
+        return hdfs_path, size
+
+    # Removes the staged files that were not uploaded, and the staging
+    # directory once no other export uses it
+    def _remove_staged(self):
+        for local_path in self._staged:
+            if path.exists(local_path):
+                remove(local_path)
+        try:
+            rmdir(self.directory)
+        except OSError:
+            # Missing, or still holding another export's files
+            pass
@@ -0,0 +1,277 @@
+'''Vector and sparse layouts of the feature records.
+
+The flat layout gives every feature its own ['float', 'null'] field, so each
+record pays a union branch per feature and the schema is as wide as the
+feature dictionary. The vector layout keeps the metadata fields and carries
+the features as
+
+    features       array<float>, or for the packed layout bytes of little
+                   endian float32
+    feature_nulls  bytes, bit i % 8 of byte i // 8 set when feature i is
+                   null or missing
+
+in the order of the flat schema's feature fields. The sparse layout carries
+only the features a record has, as
+
+    indices        array<int>, positions in that order
+    values         array<float>, their values
+
+That order is written once into the avro file metadata, as a JSON list of
+field names under FEATURES_KEY, with a fingerprint of it under VERSION_KEY
+so readers can tell whether two files share a dictionary before stacking
+them. Null and missing features are NaN in a vector and left out of sparse
+records, as are NaN values stored in Mongo.
+
+The 'auto' layout lays a sample of each partition's documents out first and
+writes sparse records when fewer than SPARSE_DENSITY of the dictionary's
+features are present, vectors otherwise. It only picks among these
+dictionary layouts and never 'flat', however dense a partition is, so every
+file an 'auto' export writes carries its dictionary and reads back through
+read_matrix(), which loads a file of any of these layouts as its dictionary,
+metadata records and a features matrix.
+'''
+import json
+from hashlib import sha1
+from itertools import chain, compress, islice
+from logging import getLogger
+from operator import eq, ne
+from struct import Struct
+
+from fastavro import reader
+
+from mongo_avro.plan import FieldPlan, PlanCache, plan_for
+
+logger = getLogger('mongo_avro.vector')
+
+# 'flat' fields, 'vector' float arrays, 'packed' float32 bytes, 'sparse'
+# indices and values, or 'auto' sparse or vector by density, never flat
+LAYOUTS = ('flat', 'vector', 'packed', 'sparse', 'auto')
+LAYOUT_KEY = 'mongo_avro.layout'
+FEATURES_KEY = 'mongo_avro.features'
+VERSION_KEY = 'mongo_avro.features.version'
+# Bump whenever vectors are laid out differently for the same dictionary
+VERSION = 1
+# Fraction of the dictionary present below which 'auto' writes sparse records
+SPARSE_DENSITY = 0.3
+# Documents of a partition whose density decides its layout
+DENSITY_SAMPLE_SIZE = 1000
+
+NAN = float('nan')
+# Null flags to the binary digits of the bitmap
+_DIGITS = bytes.maketrans(b'\0\1', b'01')
+
+_layouts = PlanCache()
+
+
+class VectorLayout(object):
+    '''Lays documents out as the metadata fields of a flat feature schema
+    plus its features as one vector. metadata and keys are those of the
+    schema's FieldPlan; the 'packed' layout stores the vectors as float32
+    bytes.'''
+
+    def __init__(self, schema, metadata, keys=None, layout='vector'):
+        metadata_names = set(name for name, convert in metadata)
+        features = [field for field in schema['fields']
+            if field['name'] not in metadata_names]
+        others = [field for field in schema['fields']
+            if field['name'] in metadata_names]
+        self.dictionary = tuple(field['name'] for field in features)
+        self.layout = layout
+        self.packed = layout == 'packed'
+        # Features first, so a laid out row is sliced into the vector and
+        # the metadata values
+        self.plan = FieldPlan(dict(schema, fields=features + others),
+            metadata, keys, missing=NAN)
+        self.schema = self._record_schema(schema, others)
+        self.names = tuple(field['name'] for field in self.schema['fields'])
+        self.width = len(self.names)
+        self.index = dict(
+            (name, position) for position, name in enumerate(self.names))
+        self.version = dictionary_version(self.dictionary)
+        self.file_metadata = {
+            LAYOUT_KEY: layout,
+            FEATURES_KEY: json.dumps(self.dictionary),
+            VERSION_KEY: self.version}
+        self._pack = Struct('<{}f'.format(len(self.dictionary))).pack
+
+    # Feature keys missing from the dictionary
+    @property
+    def unknown(self):
+        return self.plan.unknown
+
+    def rows(self, documents, chunk_size=None):
+        size = len(self.dictionary)
+        pack = self._pack if self.packed else None
+        names = self.names
+        for laid_out in self.plan.value_lists(documents, chunk_size):
+            vector = laid_out[:size]
+            values = laid_out[size:]
+            values.append(vector if pack is None else pack(*vector))
+            values.append(null_bitmap(vector))
+            yield dict(zip(names, values))
+
+    # Fraction of the dictionary's features present in documents
+    def density(self, documents):
+        size = len(self.dictionary)
+        present = rows = 0
+        for laid_out in self.plan.value_lists(documents):
+            vector = laid_out[:size]
+            present += sum(map(eq, vector, vector))
+            rows += 1
+        if not rows or not size:
+            return 1.0
+        return present / float(rows * size)
+
+    def _record_schema(self, schema, fields):
+        return vector_schema(schema, fields, self.packed)
+
+
+class SparseLayout(VectorLayout):
+    '''Lays documents out as the metadata fields of a flat feature schema
+    plus the positions and values of the features they have.'''
+
+    def __init__(self, schema, metadata, keys=None):
+        super(SparseLayout, self).__init__(schema, metadata, keys, 'sparse')
+
+    def rows(self, documents, chunk_size=None):
+        size = len(self.dictionary)
+        positions = range(size)
+        names = self.names
+        for laid_out in self.plan.value_lists(documents, chunk_size):
+            vector = laid_out[:size]
+            present = list(map(eq, vector, vector))
+            values = laid_out[size:]
+            values.append(list(compress(positions, present)))
+            values.append(list(compress(vector, present)))
+            yield dict(zip(names, values))
+
+    def _record_schema(self, schema, fields):
+        return sparse_schema(schema, fields)
+
+
+# Returns schema with fields, its metadata fields, followed by the feature
+# vector and null bitmap
+def vector_schema(schema, fields, packed=False):
+    fields = list(fields)
+    fields.append({
+        'name': 'features',
+        'doc': 'Feature values in the order of the file\'s ' + FEATURES_KEY +
+            ' metadata, NaN when null',
+        'type': 'bytes' if packed else {'type': 'array', 'items': 'float'}})
+    fields.append({
+        'name': 'feature_nulls',
+        'doc': 'Bitmap of the null features, lowest bit first',
+        'type': 'bytes'})
+    return dict(schema, fields=fields)
+
+# Returns schema with fields, its metadata fields, followed by the present
+# features' positions and values
+def sparse_schema(schema, fields):
+    fields = list(fields)
+    fields.append({
+        'name': 'indices',
+        'doc': 'Positions of the present features in the file\'s ' +
+            FEATURES_KEY + ' metadata',
+        'type': {'type': 'array', 'items': 'int'}})
+    fields.append({
+        'name': 'values',
+        'doc': 'Values of the present features',
+        'type': {'type': 'array', 'items': 'float'}})
+    return dict(schema, fields=fields)
+
+# Fingerprint of the feature names in order
+def dictionary_version(names):
+    digest = sha1(str(VERSION).encode('utf-8') + b'\0')
+    for name in names:
+        digest.update(name.encode('utf-8') + b'\0')
+    return digest.hexdigest()
+
+# Bitmap of the NaN entries of vector
+def null_bitmap(vector):
+    size = (len(vector) + 7) // 8
+    flags = bytes(map(ne, vector, vector))
+    if b'\1' not in flags:
+        return bytes(size)
+    return int(flags.translate(_DIGITS)[::-1], 2).to_bytes(size, 'little')
+
+# Returns the field plan of schema for the 'flat' layout, or its vector or
+# sparse layout for metadata and keys compiled on first use
+def layout_for(schema, metadata, keys=None, layout='flat'):
+    if layout == 'flat':
+        return plan_for(schema, metadata, keys)
+    if layout == 'auto':
+        raise ValueError('the auto layout is chosen per partition, '
+            'see choose_layout')
+    if layout not in LAYOUTS:
+        raise ValueError('unknown feature layout {!r}'.format(layout))
+    if layout == 'sparse':
+        compile = lambda: SparseLayout(schema, metadata, keys)
+    else:
+        compile = lambda: VectorLayout(schema, metadata, keys, layout)
+    return _layouts.get(compile, schema, metadata, keys, layout)
+
+# Returns (layout_for(layout), documents). For 'auto' the first sample_size
+# documents are laid out to measure their density, which picks 'sparse'
+# below threshold and 'vector' otherwise, never 'flat' so the file keeps its
+# dictionary; the documents returned still start with them.
+def choose_layout(schema, metadata, keys, layout, documents,
+        threshold=SPARSE_DENSITY, sample_size=DENSITY_SAMPLE_SIZE):
+    if layout != 'auto':
+        return layout_for(schema, metadata, keys, layout), documents
+    documents = iter(documents)
+    sample = list(islice(documents, sample_size))
+    density = layout_for(schema, metadata, keys, 'vector').density(sample)
+    layout = 'sparse' if density < threshold else 'vector'
+    logger.info(json.dumps({
+        'event': 'layout', 'layout': layout, 'density': density,
+        'sample': len(sample)}, sort_keys=True))
+    return layout_for(schema, metadata, keys, layout), chain(sample, documents)
+
+# Reads a vector or sparse layout avro file back as (feature names,
+# metadata records, features matrix). The matrix is a float32 numpy array
+# with NaN for nulls when numpy is installed, a list of float lists
+# otherwise.
+def read_matrix(fo):
+    avro_reader = reader(fo)
+    names = json.loads(avro_reader.metadata[FEATURES_KEY])
+    layout = avro_reader.metadata.get(LAYOUT_KEY)
+    records = []
+    vectors = []
+    for record in avro_reader:
+        if layout == 'sparse':
+            vectors.append((record.pop('indices'), record.pop('values')))
+        else:
+            vectors.append(record.pop('features'))
+            del record['feature_nulls']
+        records.append(record)
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    if layout == 'sparse':
+        return names, records, _scatter(vectors, len(names), numpy)
+    if numpy is None:
+        if layout == 'packed':
+            unpack = Struct('<{}f'.format(len(names))).unpack
+            vectors = [list(unpack(vector)) for vector in vectors]
+        return names, records, vectors
+    if layout == 'packed':
+        matrix = numpy.frombuffer(b''.join(vectors), '<f4')
+    else:
+        matrix = numpy.array(vectors, dtype='float32')
+    return names, records, matrix.reshape(len(vectors), len(names))
+
+# Matrix of sparse (indices, values) rows, NaN where a feature is absent
+def _scatter(rows, width, numpy=None):
+    if numpy is None:
+        matrix = []
+        for indices, values in rows:
+            vector = [NAN] * width
+            for index, value in zip(indices, values):
+                vector[index] = value
+            matrix.append(vector)
+        return matrix
+    matrix = numpy.full((len(rows), width), NAN, dtype='float32')
+    for row, (indices, values) in enumerate(rows):
+        matrix[row, indices] = values
+    return matrix
@@ -0,0 +1,107 @@
+from contextlib import contextmanager
+from datetime import datetime
+from io import BytesIO
+from threading import current_thread
+
+from fastavro import reader
+
+from mongo_avro.aio import AvroSink, run_async_backfill
+
+SCHEMA = {'type': 'record', 'name': 'Prediction', 'fields': [
+    {'name': 'window', 'type': 'int'},
+    {'name': 'index', 'type': 'int'}]}
+
+
+class Cursor(object):
+    '''Async cursor over documents, failing once it reaches failing.'''
+
+    def __init__(self, documents, failing=None):
+        self.documents = documents
+        self.failing = failing
+
+    def batch_size(self, batch_size):
+        return self
+
+    def limit(self, limit):
+        self.documents = self.documents[:limit]
+        return self
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for index, document in enumerate(self.documents):
+            if index == self.failing:
+                raise RuntimeError('cursor lost')
+            yield document
+
+
+class Client(object):
+    '''Async client whose close() is a coroutine, as in pymongo.'''
+
+    def __init__(self):
+        self.closed = False
+
+    async def close(self):
+        self.closed = True
+
+
+class Database(object):
+
+    def __init__(self):
+        self.client = Client()
+
+
+class Collection(object):
+    '''Async collection answering a window's find with count documents,
+    failing in window failing.'''
+
+    def __init__(self, count, failing=None):
+        self.count = count
+        self.failing = failing
+        self.database = Database()
+
+    def find(self, query, projection=None):
+        window = query['window']
+        return Cursor([{'window': window, 'index': index}
+            for index in range(self.count)],
+            3 if window == self.failing else None)
+
+
+def test_windows_are_written_and_the_client_closed():
+    collection = Collection(7)
+    files = {}
+    aborted = []
+
+    @contextmanager
+    def open_file(file_name):
+        out = BytesIO()
+        try:
+            yield out
+        except BaseException:
+            aborted.append((file_name, current_thread().name))
+            raise
+        files[file_name] = out.getvalue()
+
+    def open_sink(window):
+        return AvroSink(open_file, 'window{}.avro'.format(window[0].day),
+            SCHEMA, lambda documents: documents)
+
+    windows = [(datetime(2020, 1, day), datetime(2020, 1, day + 1))
+        for day in (1, 2, 3)]
+    collection.failing = 2
+    results = run_async_backfill(lambda: collection,
+        lambda window: {'window': window[0].day}, open_sink, windows,
+        concurrency=2, limit=5, batch_size=2)
+    assert [window for window, stats, error in results] == windows[::-1]
+    assert [stats for window, stats, error in results
+            if window != windows[1]] == [
+        {'records': 5, 'bytes': len(files['window3.avro'])},
+        {'records': 5, 'bytes': len(files['window1.avro'])}]
+    assert [record['index'] for record in reader(
+        BytesIO(files['window1.avro']))] == [0, 1, 2, 3, 4]
+    assert 'cursor lost' in results[1][2]
+    # The failed window's file was closed off the event loop's thread
+    assert [file_name for file_name, thread in aborted] == ['window2.avro']
+    assert aborted[0][1] != current_thread().name
+    assert collection.database.client.closed
@@ -0,0 +1,36 @@
+from datetime import datetime
+
+from bson import ObjectId
+
+from mongo_avro.checkpoint import Checkpoint, run_incremental
+
+
+def test_watermark_round_trips_through_the_state_file(tmp_path):
+    file_name = str(tmp_path / 'state' / 'export_state.json')
+    last = (datetime(2020, 1, 1, 12, 30, 15, 250000), ObjectId())
+    Checkpoint(file_name).commit('sepsismodel', datetime(2020, 1, 2), last)
+    mark = Checkpoint(file_name).get('sepsismodel')
+    assert mark == {
+        'endtime': datetime(2020, 1, 2), 'WCT': last[0], '_id': last[1]}
+    assert mark['endtime'].tzinfo is None
+    assert mark['WCT'].tzinfo is None
+
+
+def test_incremental_run_resumes_from_the_restored_watermark(tmp_path):
+    file_name = str(tmp_path / 'export_state.json')
+    windows = []
+
+    def export(starttime, endtime, after=None):
+        windows.append((starttime, endtime, after))
+        return {'records': 1, 'bytes': 1,
+            'last': (starttime, ObjectId())}
+
+    run_incremental(Checkpoint(file_name), 'sepsismodel', export,
+        datetime(2020, 1, 1), datetime(2020, 1, 3))
+    run_incremental(Checkpoint(file_name), 'sepsismodel', export,
+        datetime(2020, 1, 1), datetime(2020, 1, 4))
+    assert [window[:2] for window in windows] == [
+        (datetime(2020, 1, 1), datetime(2020, 1, 2)),
+        (datetime(2020, 1, 2), datetime(2020, 1, 3)),
+        (datetime(2020, 1, 3), datetime(2020, 1, 4))]
+    assert windows[2][2]['WCT'] == datetime(2020, 1, 2)
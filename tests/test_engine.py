@@ -0,0 +1,107 @@
+from contextlib import contextmanager
+from io import BytesIO
+from time import sleep
+
+import pyarrow.parquet
+import pytest
+from hdfs.util import HdfsError
+
+from mongo_avro.engine import HdfsParquetSink, HdfsPartsSink
+
+SCHEMA = {'type': 'record', 'name': 'Prediction', 'fields': [
+    {'name': 'event_id', 'type': 'string'},
+    {'name': 'Score', 'type': ['double', 'null']}]}
+
+
+class Client(object):
+    '''HDFS client stand in keeping written files in memory.'''
+
+    def __init__(self):
+        self.files = {}
+
+    def write(self, hdfs_path, data, overwrite=False):
+        self.files[hdfs_path] = data.read()
+
+
+class Connections(object):
+
+    def __init__(self):
+        self.client = Client()
+
+    def hdfs(self):
+        return self.client
+
+
+def test_parquet_files_are_uploaded_to_hdfs(tmp_path):
+    connections = Connections()
+    sink = HdfsParquetSink(connections, str(tmp_path))
+    records = [{'event_id': 'pred_{}'.format(index), 'Score': index / 4.0}
+        for index in range(5)] + [{'event_id': 'pred_5', 'Score': None}]
+    stats = sink.write('transforms/day.parquet', SCHEMA, iter(records),
+        metadata={'mongo_avro.layout': 'flat'})
+    data = connections.client.files['transforms/day.parquet']
+    assert stats == {'records': 6, 'bytes': len(data)}
+    table = pyarrow.parquet.read_table(BytesIO(data))
+    assert table.to_pylist() == records
+    assert table.schema.metadata[b'mongo_avro.layout'] == b'flat'
+    # The local copy is removed once uploaded
+    assert list(tmp_path.iterdir()) == []
+
+
+class RecordingClient(object):
+    '''HDFS client stand in recording the order files complete in, failing
+    uploads of the paths in failing.'''
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.files = {}
+        self.order = []
+
+    def write(self, hdfs_path, data=None, overwrite=False):
+        if data is None:
+            return self._stream(hdfs_path)
+        if hdfs_path in self.failing:
+            raise HdfsError('gateway down')
+        if hdfs_path.endswith('.avro'):
+            # Slow part uploads, which a manifest uploaded alongside
+            # them would overtake
+            sleep(0.05)
+        self._store(hdfs_path, data.read())
+
+    @contextmanager
+    def _stream(self, hdfs_path):
+        out = BytesIO()
+        yield out
+        self._store(hdfs_path, out.getvalue())
+
+    def _store(self, hdfs_path, data):
+        self.files[hdfs_path] = data
+        self.order.append(hdfs_path)
+
+
+def test_manifest_is_written_after_every_part_upload(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    connections = Connections()
+    connections.client = RecordingClient()
+    sink = HdfsPartsSink(connections, max_records=2, uploads=4, retries=0)
+    records = [{'event_id': 'pred_{}'.format(index), 'Score': None}
+        for index in range(5)]
+    stats = sink.write('preds/day', SCHEMA, iter(records))
+    assert stats == dict(stats, records=5, parts=3)
+    assert connections.client.order[-1] == 'preds/day_manifest.json'
+    assert sorted(connections.client.order[:-1]) == [
+        'preds/day_part0000.avro', 'preds/day_part0001.avro',
+        'preds/day_part0002.avro']
+
+
+def test_manifest_is_not_written_when_a_part_upload_fails(tmp_path,
+        monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    connections = Connections()
+    connections.client = RecordingClient(['preds/day_part0001.avro'])
+    sink = HdfsPartsSink(connections, max_records=2, uploads=3, retries=0)
+    records = [{'event_id': 'pred_{}'.format(index), 'Score': None}
+        for index in range(5)]
+    with pytest.raises(HdfsError):
+        sink.write('preds/day', SCHEMA, iter(records))
+    assert 'preds/day_manifest.json' not in connections.client.files
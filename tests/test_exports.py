@@ -0,0 +1,157 @@
+import json
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from io import BytesIO
+from os import path
+
+import pytest
+from fastavro import reader
+
+import fastavro_mongo_hdfs_preds as preds
+import fastavro_mongo_hdfs_transform_normalized as normalized
+from mongo_avro.engine import connections
+from mongo_avro.upload import STAGING_DIRECTORY
+from mongo_avro.synthetic import (
+    MemoryCollection,
+    feature_names,
+    generate_predictions)
+
+DAY = datetime(2020, 1, 1)
+
+
+class Client(object):
+    '''HDFS client stand in keeping written files in memory.'''
+
+    def __init__(self):
+        self.files = {}
+
+    def write(self, hdfs_path, data=None, overwrite=False, **options):
+        if data is None:
+            return self._stream(hdfs_path)
+        self.files[hdfs_path] = data.read()
+
+    @contextmanager
+    def _stream(self, hdfs_path):
+        out = BytesIO()
+        yield out
+        self.files[hdfs_path] = out.getvalue()
+
+    def status(self, hdfs_path):
+        return {'length': len(self.files[hdfs_path])}
+
+    def delete(self, hdfs_path):
+        self.files.pop(hdfs_path, None)
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    documents = list(generate_predictions(
+        40, feature_names(6, messiness=0), start=DAY))
+    collection = MemoryCollection(documents)
+    client = Client()
+    monkeypatch.setattr(connections, 'collection', lambda name: collection)
+    monkeypatch.setattr(connections, 'hdfs', lambda: client)
+    normalized.schema_cache.clear()
+    return client
+
+
+def records(data):
+    return list(reader(BytesIO(data)))
+
+
+def test_normalized_day_is_streamed_to_one_file(client):
+    stats = normalized.export_day(DAY, DAY + timedelta(1), limit=30)
+    data = client.files['transforms_test/2020/01/2020_01_01_transform.avro']
+    assert stats['records'] == len(records(data)) == 30
+    assert stats['bytes'] == len(data)
+    assert stats['last'][0] == DAY + timedelta(seconds=29)
+    assert stats['metrics']['window']['records'] == 30
+
+
+def test_normalized_day_is_cut_into_parts(client):
+    stats = normalized.export_day(DAY, DAY + timedelta(1),
+        parts={'max_bytes': 1 << 30, 'max_records': 16})
+    base_name = 'transforms_test/2020/01/2020_01_01_transform'
+    manifest = json.loads(client.files[base_name + '_manifest.json'])
+    assert [part['records'] for part in manifest['parts']] == [16, 16, 8]
+    assert sum(len(records(client.files[part['file']]))
+        for part in manifest['parts']) == stats['records'] == 40
+
+
+def test_normalized_day_is_written_as_parquet(client):
+    import pyarrow.parquet
+    stats = normalized.export_day(DAY, DAY + timedelta(1),
+        parquet={'row_group_size': 10})
+    data = client.files['transforms_test/2020/01/2020_01_01_transform.parquet']
+    assert pyarrow.parquet.read_table(BytesIO(data)).num_rows == 40
+    assert stats['records'] == 40
+
+
+def test_prediction_day_is_streamed_to_one_file(client):
+    stats = preds.export_day(DAY, DAY + timedelta(1), limit=5)
+    data = client.files['predictions/2020/01/2020_01_01_predict.avro']
+    assert [record['event_id'] for record in records(data)] == [
+        'pred_' + str(document['_id']) for document in
+        connections.collection('psPreds.preds').documents[:5]]
+    assert stats['records'] == 5
+
+
+def test_feature_keys_missing_from_the_schema_are_reported(client, caplog):
+    normalized.generate_avro_schema()
+    documents = connections.collection('psPreds.preds').documents
+    documents[3]['features']['extra_v1'] = 1.0
+    caplog.set_level('INFO', 'mongo_avro.metrics')
+    stats = normalized.export_day(DAY, DAY + timedelta(1))
+    assert stats['unknown_keys'] == ['extra_v1']
+    logged = [json.loads(record.getMessage()) for record in caplog.records]
+    assert [(line['count'], line['keys']) for line in logged
+        if line['event'] == 'unknown_keys'] == [(1, ['extra_v1'])]
+    # Each window reports only its own
+    documents[3]['features'].pop('extra_v1')
+    stats = normalized.export_day(DAY, DAY + timedelta(1))
+    assert stats['unknown_keys'] == []
+
+
+def split_at(*boundaries):
+    boundaries = (None,) + boundaries + (None,)
+    return lambda collection, query, field, parts: list(
+        zip(boundaries, boundaries[1:]))
+
+
+def test_split_day_is_merged_and_its_staged_parts_removed(client,
+        monkeypatch):
+    monkeypatch.setattr(normalized, 'split_ranges',
+        split_at(DAY + timedelta(seconds=10), DAY + timedelta(seconds=25)))
+    stats = normalized.export_day_split(DAY, DAY + timedelta(1), processes=1)
+    data = client.files['transforms_test/2020/01/2020_01_01_transform.avro']
+    assert [record['valid_on'].replace(tzinfo=None)
+        for record in records(data)] == [
+        DAY + timedelta(seconds=index) for index in range(40)]
+    assert stats['records'] == 40 and stats['parts'] == 3
+    assert not path.exists(STAGING_DIRECTORY)
+
+
+def test_failed_split_day_removes_its_staged_parts(client, monkeypatch):
+    monkeypatch.setattr(normalized, 'split_ranges',
+        split_at(DAY + timedelta(seconds=10), DAY + timedelta(seconds=25)))
+    documents = connections.collection('psPreds.preds').documents
+    del documents[30]['VISIT_NUMBER']
+    with pytest.raises(RuntimeError):
+        normalized.export_day_split(DAY, DAY + timedelta(1), processes=1)
+    assert not path.exists(STAGING_DIRECTORY)
+    assert client.files == {}
+
+
+def test_split_day_refuses_a_limit(client):
+    with pytest.raises(ValueError):
+        normalized.export_day_split(DAY, DAY + timedelta(1), 100)
+
+
+def test_pipelined_day_logs_its_stages(client, caplog):
+    caplog.set_level('INFO', 'mongo_avro.metrics')
+    stats = normalized.export_day(DAY, DAY + timedelta(1), depth=2)
+    assert stats['records'] == 40
+    logged = [json.loads(record.getMessage()) for record in caplog.records]
+    assert [line['stage'] for line in logged
+        if line['event'] == 'pipeline'] == ['fetch', 'encode', 'write']
@@ -0,0 +1,29 @@
+from bson import BSON, decode_all
+
+from mongo_avro.metrics import Metrics, prometheus_text
+from mongo_avro.rawbson import RAW_CODEC_OPTIONS
+
+DOCUMENTS = [{'_id': index, 'features': {'hr': 80.5 + index}}
+    for index in range(5)]
+
+
+def test_raw_documents_count_their_bson_bytes():
+    data = b''.join(BSON.encode(document) for document in DOCUMENTS)
+    metrics = Metrics('raw')
+    assert len(list(metrics.fetch(decode_all(data, RAW_CODEC_OPTIONS),
+        batch_size=2))) == 5
+    summary = metrics.summary()['stages']['fetch']
+    assert summary['documents'] == 5
+    assert summary['bytes_read'] == len(data)
+    assert summary['batches'] == 3
+
+
+def test_decoded_documents_leave_bytes_read_out():
+    metrics = Metrics('decoded')
+    list(metrics.fetch(DOCUMENTS))
+    summary = metrics.summary()
+    assert summary['stages']['fetch']['documents'] == 5
+    assert summary['stages']['fetch']['bytes_read'] is None
+    text = prometheus_text(summary)
+    assert 'mongo_avro_stage_documents{job="decoded",stage="fetch"} 5' in text
+    assert 'stage_bytes_read{' not in text
@@ -0,0 +1,41 @@
+from io import BytesIO
+
+import pyarrow
+import pyarrow.parquet
+
+from mongo_avro.parquet import ParquetSink, arrow_schema
+
+SCHEMA = {'type': 'record', 'name': 'Transform', 'fields': [
+    {'name': 'event_id', 'type': 'string'},
+    {'name': 'valid_on', 'type': [
+        {'type': 'long', 'logicalType': 'timestamp-millis'}, 'null']},
+    {'name': 'input_events', 'type': 'null'},
+    {'name': 'provenance', 'type': {'type': 'array', 'items': 'string'}},
+    {'name': 'Lactate', 'type': ['float', 'null']}]}
+
+
+def test_avro_types_map_to_arrow_columns():
+    schema = arrow_schema(SCHEMA)
+    assert schema.field('event_id').type == pyarrow.string()
+    assert not schema.field('event_id').nullable
+    assert schema.field('valid_on').type == pyarrow.timestamp('ms')
+    assert schema.field('input_events').type == pyarrow.null()
+    assert schema.field('provenance').type == pyarrow.list_(pyarrow.string())
+    assert schema.field('Lactate').nullable
+
+
+def test_records_round_trip_through_parquet():
+    records = [
+        {'event_id': 'e1', 'valid_on': 1500, 'input_events': None,
+         'provenance': ['psPredsExtract'], 'Lactate': 1.5},
+        {'event_id': 'e2', 'valid_on': None, 'input_events': None,
+         'provenance': [], 'Lactate': None}]
+    out = BytesIO()
+    with ParquetSink(out, SCHEMA, chunk_size=1) as sink:
+        for record in records:
+            sink.write(record)
+    out.seek(0)
+    table = pyarrow.parquet.read_table(out)
+    assert table.column('event_id').to_pylist() == ['e1', 'e2']
+    assert table.column('input_events').to_pylist() == [None, None]
+    assert table.column('Lactate').to_pylist() == [1.5, None]
@@ -0,0 +1,37 @@
+from mongo_avro.plan import PlanCache, plan_for
+
+SCHEMA = {'type': 'record', 'name': 'Features', 'fields': [
+    {'name': 'hr', 'type': ['float', 'null']},
+    {'name': 'heart_rate', 'type': ['float', 'null']},
+    {'name': 'patient_id', 'type': 'int'}]}
+METADATA = (('patient_id', lambda document: document['VISIT_NUMBER']),)
+DOCUMENT = {'VISIT_NUMBER': 4, 'features': {'hr': 80.5}}
+
+
+def test_rows_are_plain_dicts_in_field_order():
+    row = plan_for(SCHEMA, METADATA).row(DOCUMENT)
+    assert type(row) is dict
+    assert list(row.items()) == [
+        ('hr', 80.5), ('heart_rate', None), ('patient_id', 4)]
+
+
+def test_plans_are_cached_per_schema_metadata_and_keys():
+    plan = plan_for(SCHEMA, METADATA)
+    assert plan_for(SCHEMA, METADATA) is plan
+    renamed = plan_for(SCHEMA, METADATA, {'hr': 'heart_rate'})
+    assert renamed is not plan
+    assert renamed.row(DOCUMENT)['heart_rate'] == 80.5
+    assert plan_for(SCHEMA, METADATA, {'hr': 'heart_rate'}) is renamed
+    other_metadata = (('patient_id', lambda document: 0),)
+    assert plan_for(SCHEMA, other_metadata) is not plan
+
+
+def test_the_least_recently_used_plan_is_dropped():
+    cache = PlanCache(2)
+    schemas = [dict(SCHEMA) for index in range(3)]
+    compiled = []
+    for schema in schemas + schemas[:1]:
+        cache.get(lambda: compiled.append(schema) or len(compiled),
+            schema, METADATA)
+    assert compiled == schemas + schemas[:1]
+    assert cache.get(lambda: None, schemas[2], METADATA) == 3
@@ -0,0 +1,47 @@
+from bson import BSON, decode_all
+from bson.decimal128 import Decimal128
+from bson.int64 import Int64
+
+from mongo_avro.plan import FieldPlan
+from mongo_avro.rawbson import RAW_CODEC_OPTIONS, read_features
+
+
+FEATURES = {
+    'double': 1.5,
+    'int32': 7,
+    'int64': Int64(1 << 40),
+    'bool': True,
+    'decimal': Decimal128('2.25'),
+    'null': None,
+    'unwanted': 3.0}
+
+
+def test_read_features_matches_the_decoded_document():
+    raw = BSON.encode(FEATURES)
+    keys = [key for key in FEATURES if key != 'unwanted']
+    positions = dict((key, position) for position, key in enumerate(keys))
+    values = [None] * len(keys)
+    unknown = read_features(memoryview(raw), positions, values)
+    decoded = decode_all(raw)[0]
+    assert unknown == ['unwanted']
+    for key in keys:
+        expected = decoded[key]
+        if isinstance(expected, Decimal128):
+            expected = expected.to_decimal()
+        assert values[positions[key]] == (
+            None if expected is None else float(expected))
+
+
+def test_raw_and_decoded_documents_lay_out_the_same_row():
+    schema = {'type': 'record', 'name': 'Transform', 'fields': [
+        {'name': key, 'type': ['float', 'null']} for key in FEATURES] +
+        [{'name': 'VISIT_NUMBER', 'type': 'int'}]}
+    metadata = (('VISIT_NUMBER', lambda document: document['VISIT_NUMBER']),)
+    document = {'VISIT_NUMBER': 12, 'features': dict(FEATURES, extra=1.0)}
+    raw = decode_all(BSON.encode(document), RAW_CODEC_OPTIONS)[0]
+    decoded = dict(document, features=dict(document['features'],
+        decimal=2.25))
+    raw_plan = FieldPlan(schema, metadata)
+    decoded_plan = FieldPlan(schema, metadata)
+    assert raw_plan.row(raw) == decoded_plan.row(decoded)
+    assert raw_plan.unknown == decoded_plan.unknown == set(['extra'])
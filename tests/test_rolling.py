@@ -0,0 +1,47 @@
+import json
+import os
+from functools import partial
+
+import pytest
+from fastavro import reader
+
+from mongo_avro.rolling import RollingAvroWriter
+
+SCHEMA = {'type': 'record', 'name': 'Prediction', 'fields': [
+    {'name': 'event_id', 'type': 'string'},
+    {'name': 'Score', 'type': 'float'}]}
+
+
+def records(count):
+    for index in range(count):
+        yield {'event_id': 'pred_{}'.format(index), 'Score': index / 2.0}
+
+
+def test_parts_hold_every_record_and_are_listed_in_the_manifest(tmp_path):
+    base_name = str(tmp_path / 'day')
+    with RollingAvroWriter(partial(open, mode='wb'), base_name, SCHEMA,
+            max_records=4) as writer:
+        for record in records(10):
+            writer.write(record)
+    with open(writer.manifest_name) as manifest_file:
+        manifest = json.load(manifest_file)
+    assert manifest['records'] == 10
+    assert [part['records'] for part in manifest['parts']] == [4, 4, 2]
+    written = []
+    for part in manifest['parts']:
+        with open(part['file'], 'rb') as part_file:
+            written.extend(reader(part_file))
+        assert os.path.getsize(part['file']) == part['bytes']
+    assert written == list(records(10))
+
+
+def test_failed_export_removes_the_part_being_written(tmp_path):
+    base_name = str(tmp_path / 'day')
+    with pytest.raises(RuntimeError):
+        with RollingAvroWriter(partial(open, mode='wb'), base_name, SCHEMA,
+                max_records=4, remove_file=os.remove) as writer:
+            for record in records(6):
+                writer.write(record)
+            raise RuntimeError('cursor lost')
+    assert sorted(os.listdir(str(tmp_path))) == ['day_part0000.avro']
+    assert [part['records'] for part in writer.parts] == [4]
@@ -0,0 +1,47 @@
+from io import BytesIO
+from os import urandom
+
+import pytest
+from fastavro import reader
+from fastavro.write import Writer
+
+from mongo_avro.split import merge_avro
+
+SCHEMA = {'type': 'record', 'name': 'Part', 'fields': [
+    {'name': 'part', 'type': 'int'},
+    {'name': 'index', 'type': 'int'}]}
+
+
+def write_part(file_name, part, count, sync_marker, codec='deflate'):
+    with open(file_name, 'wb') as out:
+        writer = Writer(out, SCHEMA, codec=codec, sync_interval=64,
+            sync_marker=sync_marker)
+        for index in range(count):
+            writer.write({'part': part, 'index': index})
+        writer.flush()
+
+
+def test_merged_parts_read_back_as_one_file(tmp_path):
+    sync_marker = urandom(16)
+    counts = (50, 0, 7, 120)
+    file_names = []
+    for part, count in enumerate(counts):
+        file_name = str(tmp_path / 'day_part{:04d}.avro'.format(part))
+        write_part(file_name, part, count, sync_marker)
+        file_names.append(file_name)
+    out = BytesIO()
+    merge_avro(file_names, out, sync_marker)
+    out.seek(0)
+    assert [(record['part'], record['index']) for record in reader(out)] == [
+        (part, index) for part, count in enumerate(counts)
+        for index in range(count)]
+
+
+def test_parts_without_the_shared_marker_are_refused(tmp_path):
+    file_names = []
+    for part in range(2):
+        file_name = str(tmp_path / 'day_part{:04d}.avro'.format(part))
+        write_part(file_name, part, 3, urandom(16))
+        file_names.append(file_name)
+    with pytest.raises(ValueError):
+        merge_avro(file_names, BytesIO(), urandom(16))
@@ -0,0 +1,26 @@
+from mongo_avro.symbols import rename_duplicates
+
+
+def test_duplicates_get_the_lowest_free_suffix_in_key_order():
+    symbols = {'b': 'x', 'a': 'x', 'c': 'x', 'd': 'y'}
+    assert rename_duplicates(symbols) == {
+        'a': 'x', 'b': 'x_v1', 'c': 'x_v2', 'd': 'y'}
+
+
+def test_previous_assignments_survive_new_keys():
+    previous = rename_duplicates({'b': 'x', 'c': 'x'})
+    renamed = rename_duplicates({'a': 'x', 'b': 'x', 'c': 'x'}, previous)
+    assert renamed['b'] == previous['b']
+    assert renamed['c'] == previous['c']
+    assert renamed['a'] == 'x_v2'
+    # Renaming again from its own result changes nothing
+    assert rename_duplicates(
+        {'a': 'x', 'b': 'x', 'c': 'x'}, renamed) == renamed
+
+
+def test_previous_name_of_another_symbol_is_not_kept():
+    # a_valid starts with a_v but is not a suffixed a
+    renamed = rename_duplicates({'k': 'a', 'l': 'a_valid'}, {'k': 'a_valid'})
+    assert renamed == {'k': 'a', 'l': 'a_valid'}
+    renamed = rename_duplicates({'k': 'a', 'l': 'a'}, {'k': 'a_v12x'})
+    assert renamed == {'k': 'a', 'l': 'a_v1'}
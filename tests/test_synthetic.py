@@ -0,0 +1,66 @@
+import pytest
+
+from mongo_avro.aggregate import prediction_pipeline
+from mongo_avro.synthetic import (
+    MemoryCollection,
+    feature_names,
+    generate_predictions)
+from mongo_avro.timestamps import to_epoch
+
+PROVENANCE = ['psPredsExtract', 'PredictSepsis']
+
+
+def test_prediction_pipeline_shapes_records_like_the_find_path():
+    documents = list(generate_predictions(5, feature_names(4)))
+    collection = MemoryCollection(documents)
+    query = {'modelName': 'sepsismodel', 'WCT': {'$gt': documents[0]['WCT']}}
+    records = list(collection.aggregate(
+        prediction_pipeline(query, PROVENANCE, 'millis', 3), batchSize=2))
+    assert len(records) == 3
+    for document, record in zip(documents[1:], records):
+        result = document['result']['result']
+        assert record == {
+            '_id': document['_id'],
+            'WCT': document['WCT'],
+            'event_id': 'pred_' + str(document['_id']),
+            'valid_on': to_epoch(document['WCT'], 'millis'),
+            'created_on': to_epoch(document['WCT'], 'millis'),
+            'input_events': str(document['_id']),
+            'patient_id': document['VISIT_NUMBER'],
+            'provenance': PROVENANCE,
+            'Prediction': float(result['predict']),
+            'Score': result['score'],
+            'heuristic_rule': result['heuristic_alert']}
+
+
+def test_seconds_pipeline_floors_to_whole_seconds():
+    documents = list(generate_predictions(2, feature_names(2)))
+    records = list(MemoryCollection(documents).aggregate(
+        prediction_pipeline({}, PROVENANCE, 'seconds')))
+    assert [record['valid_on'] for record in records] == [
+        to_epoch(document['WCT'], 'seconds') for document in documents]
+
+
+def test_default_nesting_is_the_psPreds_shape():
+    document = next(generate_predictions(1, feature_names(2)))
+    assert isinstance(document['result']['result']['predict'], int)
+
+
+def test_watermark_clauses_are_matched():
+    documents = list(generate_predictions(4, feature_names(2)))
+    for document in documents:
+        document['WCT'] = documents[0]['WCT']
+    mark = {'$or': [
+        {'WCT': {'$gt': documents[0]['WCT']}},
+        {'WCT': documents[0]['WCT'], '_id': {'$gt': documents[1]['_id']}}]}
+    records = list(MemoryCollection(documents).find(mark, {'_id': 1}))
+    assert [record['_id'] for record in records] == [
+        document['_id'] for document in documents[2:]]
+
+
+def test_unsupported_query_operators_raise():
+    collection = MemoryCollection(generate_predictions(1, feature_names(2)))
+    with pytest.raises(NotImplementedError):
+        collection.find({'$nor': [{'modelName': 'other'}]})
+    with pytest.raises(NotImplementedError):
+        collection.find({'modelName': {'$ne': 'other'}})
@@ -0,0 +1,76 @@
+from datetime import datetime
+
+from mongo_avro.metrics import Metrics, prometheus_text
+from mongo_avro.tail import Tail
+
+
+class Output(object):
+    '''Collects the records a tail writes.'''
+
+    def __init__(self):
+        self.records = []
+        self.closed = False
+
+    def write(self, record):
+        self.records.append(record)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class Checkpoint(object):
+    '''In memory watermarks.'''
+
+    def __init__(self):
+        self.marks = {}
+
+    def get(self, key):
+        return self.marks.get(key)
+
+    def commit(self, key, watermark, last=None):
+        self.marks[key] = {'WCT': watermark, '_id': last[1]}
+
+
+def test_tail_records_its_polls_and_lag_in_the_metrics():
+    polls = [
+        [{'WCT': datetime(2020, 1, 1), '_id': 1},
+         {'WCT': datetime(2020, 1, 2), '_id': 2}],
+        [{'WCT': datetime(2020, 1, 3), '_id': 3}]]
+    metrics = Metrics('tail_test')
+    output = Output()
+    tail = Tail(lambda mark: polls.pop(0) if polls else [], dict, output,
+        Checkpoint(), 'tail', 0, metrics)
+    tail.run(lambda: not polls)
+    assert [record['_id'] for record in output.records] == [1, 2, 3]
+    assert output.closed
+    assert metrics.stages['tail'].records == 3
+    lag = metrics.gauges['tail_lag_seconds']
+    assert lag > (datetime.utcnow() - datetime(2020, 1, 4)).total_seconds()
+    assert 'mongo_avro_tail_lag_seconds{job="tail_test"}' in prometheus_text(
+        metrics.summary())
+
+
+def test_tail_emits_after_every_poll_and_keeps_the_lag_growing():
+    polls = [[{'WCT': datetime(2020, 1, 1), '_id': 1}], [], []]
+    metrics = Metrics('tail_test')
+    lags = []
+    metrics.emit = lambda: lags.append(metrics.gauges.get('tail_lag_seconds'))
+    tail = Tail(lambda mark: polls.pop(0) if polls else [], dict, Output(),
+        Checkpoint(), 'tail', 0, metrics)
+    tail.run(lambda: not polls)
+    # One emit per poll and the last one as the tail stops
+    assert len(lags) == 4
+    assert lags[0] <= lags[1] <= lags[2]
+    assert metrics.stages['tail'].records == 1
+
+
+def test_tail_aggregate_pipeline_sorts_before_limiting():
+    from mongo_avro.sepsis import aggregate_pipeline
+    from mongo_avro.tail import TAIL_SORT
+    pipeline = aggregate_pipeline({'modelName': 'm'}, 5, sort=TAIL_SORT)
+    assert [list(stage) for stage in pipeline] == [
+        ['$match'], ['$sort'], ['$limit'], ['$project']]
+    assert list(pipeline[1]['$sort'].items()) == TAIL_SORT
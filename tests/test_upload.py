@@ -0,0 +1,137 @@
+import json
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+from hdfs.util import HdfsError
+
+from mongo_avro.engine import Connections
+from mongo_avro.upload import Uploader
+
+
+class Client(object):
+    '''HDFS client stand in keeping uploads in memory and failing those
+    whose path is in failing.'''
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.files = {}
+
+    def write(self, hdfs_path, data, overwrite=False):
+        if hdfs_path in self.failing:
+            raise HdfsError('gateway down')
+        self.files[hdfs_path] = data.read()
+
+
+def test_staged_files_are_uploaded_and_removed(tmp_path):
+    client = Client()
+    directory = str(tmp_path / 'staging')
+    with Uploader(client, 2, 0, 0, directory) as uploader:
+        for index in range(3):
+            with uploader.open_staged('day_part{}.avro'.format(index)) as out:
+                out.write(b'part')
+    assert sorted(uploader.uploaded) == [
+        ('day_part0.avro', 4), ('day_part1.avro', 4), ('day_part2.avro', 4)]
+    assert sorted(client.files) == [
+        'day_part0.avro', 'day_part1.avro', 'day_part2.avro']
+    assert not os.path.exists(directory)
+
+
+def test_failed_upload_is_raised_and_its_file_removed(tmp_path):
+    directory = str(tmp_path / 'staging')
+    with pytest.raises(HdfsError):
+        with Uploader(Client(['day_part1.avro']), 2, 1, 0,
+                directory) as uploader:
+            for index in range(3):
+                with uploader.open_staged(
+                        'day_part{}.avro'.format(index)) as out:
+                    out.write(b'part')
+    assert not os.path.exists(directory)
+
+
+def test_export_failure_wins_over_upload_failures(tmp_path):
+    directory = str(tmp_path / 'staging')
+    with pytest.raises(RuntimeError):
+        with Uploader(Client(['day_part0.avro']), 2, 0, 0,
+                directory) as uploader:
+            with uploader.open_staged('day_part0.avro') as out:
+                out.write(b'part')
+            with uploader.open_staged('day_part1.avro') as out:
+                out.write(b'half a part')
+                raise RuntimeError('cursor lost')
+    assert not os.path.exists(directory)
+
+
+class WebHdfs(BaseHTTPRequestHandler):
+    '''WebHDFS stand in redirecting each CREATE to a data PUT, which fails
+    the first time for the paths in the server's failing set.'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_PUT(self):
+        url = urlsplit(self.path)
+        hdfs_path = url.path[len('/webhdfs/v1'):]
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        server = self.server
+        with server.lock:
+            server.connections.add(self.client_address)
+            server.requests += 1
+        if 'data' not in parse_qs(url.query):
+            self._respond(307, b'', Location='http://{}:{}{}&data=true'
+                .format(*server.server_address + (self.path,)))
+        elif hdfs_path in server.failing:
+            server.failing.discard(hdfs_path)
+            self._respond(500, json.dumps({'RemoteException': {
+                'exception': 'IOException',
+                'message': 'datanode restarting'}}).encode('utf-8'))
+        else:
+            server.files[hdfs_path] = body
+            self._respond(201, b'')
+
+    def _respond(self, status, body, **headers):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def webhdfs():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), WebHdfs)
+    server.lock = Lock()
+    server.connections = set()
+    server.requests = 0
+    server.files = {}
+    server.failing = set()
+    thread = Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_uploads_share_pooled_connections_and_retry(tmp_path, webhdfs):
+    webhdfs.failing.add('/day_part1.avro')
+    client = Connections(hdfs_url='http://{}:{}'.format(
+        *webhdfs.server_address)).hdfs()
+    directory = str(tmp_path / 'staging')
+    with Uploader(client, 2, 1, 0, directory) as uploader:
+        for index in range(6):
+            with uploader.open_staged(
+                    '/day_part{}.avro'.format(index)) as out:
+                out.write('part {}'.format(index).encode('utf-8'))
+    assert webhdfs.files == dict(('/day_part{}.avro'.format(index),
+        'part {}'.format(index).encode('utf-8')) for index in range(6))
+    # Six CREATEs and data PUTs plus the retried ones, over the keep-alive
+    # connections of the two upload threads
+    assert webhdfs.requests == 14
+    assert len(webhdfs.connections) <= 2
+    assert not os.path.exists(directory)
@@ -0,0 +1,83 @@
+import math
+from io import BytesIO
+
+from fastavro import writer
+
+from mongo_avro.vector import (
+    FEATURES_KEY,
+    LAYOUT_KEY,
+    choose_layout,
+    layout_for,
+    read_matrix)
+
+FEATURES = ('hr', 'map', 'temp', 'wbc')
+SCHEMA = {'type': 'record', 'name': 'Features', 'fields': [
+    {'name': name, 'type': ['float', 'null']} for name in FEATURES] +
+    [{'name': 'patient_id', 'type': 'int'}]}
+METADATA = (('patient_id', lambda document: document['VISIT_NUMBER']),)
+DOCUMENTS = [
+    {'VISIT_NUMBER': 1, 'features': {'hr': 80.5, 'temp': 37.25}},
+    {'VISIT_NUMBER': 2, 'features': {'map': None, 'wbc': 11.0}},
+    {'VISIT_NUMBER': 3, 'features': {}}]
+
+
+# Features of documents in dictionary order, None for NaN
+def expected_rows(documents):
+    return [[document['features'].get(name) for name in FEATURES]
+        for document in documents]
+
+
+def written(layout, documents=DOCUMENTS):
+    plan = layout_for(SCHEMA, METADATA, layout=layout)
+    out = BytesIO()
+    writer(out, plan.schema, plan.rows(documents),
+        metadata=plan.file_metadata)
+    out.seek(0)
+    return out
+
+
+def matrix_rows(matrix):
+    matrix = getattr(matrix, 'tolist', lambda: matrix)()
+    return [[None if math.isnan(value) else value for value in row]
+        for row in matrix]
+
+
+def test_read_matrix_round_trips_every_layout():
+    for layout in ('vector', 'packed', 'sparse'):
+        names, records, matrix = read_matrix(written(layout))
+        assert names == list(FEATURES)
+        assert records == [{'patient_id': 1}, {'patient_id': 2},
+            {'patient_id': 3}]
+        assert matrix_rows(matrix) == expected_rows(DOCUMENTS), layout
+
+
+def test_sparse_records_hold_only_the_present_features():
+    from fastavro import reader
+    avro_reader = reader(written('sparse'))
+    assert avro_reader.metadata[LAYOUT_KEY] == 'sparse'
+    assert avro_reader.metadata[FEATURES_KEY] == '["hr", "map", "temp", "wbc"]'
+    assert [(record['indices'], record['values']) for record in avro_reader] \
+        == [([0, 2], [80.5, 37.25]), ([3], [11.0]), ([], [])]
+
+
+def test_auto_picks_sparse_below_the_threshold_and_vector_above():
+    # Three of the eight features are present in the first two documents
+    sample = DOCUMENTS[:2]
+    plan, documents = choose_layout(SCHEMA, METADATA, None, 'auto',
+        iter(sample), threshold=0.5)
+    assert plan.layout == 'sparse'
+    assert list(documents) == sample
+    plan, documents = choose_layout(SCHEMA, METADATA, None, 'auto',
+        iter(sample), threshold=0.25)
+    assert plan.layout == 'vector'
+    assert list(documents) == sample
+
+
+def test_auto_only_samples_the_first_documents_and_never_goes_flat():
+    dense = [{'VISIT_NUMBER': 4,
+        'features': dict((name, 1.0) for name in FEATURES)}]
+    plan, documents = choose_layout(SCHEMA, METADATA, None, 'auto',
+        iter(dense + DOCUMENTS * 10), threshold=0.5, sample_size=1)
+    assert plan.layout == 'vector'
+    assert plan.file_metadata[LAYOUT_KEY] == 'vector'
+    assert len(list(documents)) == 31